@@ -112,8 +112,8 @@ def positiveint(flag):
     return i
 
 
-config.read(soft_mem_limit=int, hard_mem_limit=int, port=int,
-            multi_user=positiveint, serialize_jobs=positiveint,
+config.read(soft_mem_limit=int, hard_mem_limit=int, shmem_threshold=int,
+            port=int, multi_user=positiveint, serialize_jobs=positiveint,
             strict=positiveint, code=exec)
 
 if config.directory.custom_tmp:
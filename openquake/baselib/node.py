@@ -143,6 +143,8 @@ generator. Finally, nodes containing lazy nodes will not be pickleable.
 import io
 import sys
 import copy
+import operator
+import collections
 import types
 import warnings
 import itertools
@@ -807,7 +809,8 @@ def context(fname, node):
 class ValidatingXmlParser(object):
     """
     Validating XML Parser based on Expat. It has two methods `.parse_file`
-    and `.parse_bytes` returning a validated :class:`Node` object.
+    and `.parse_bytes` returning a validated :class:`Node` object and
+    a method `.iterparse` yielding validated nodes in streaming.
 
     :param validators: a dictionary of validation functions
     :param stop: the tag where to stop the parsing (if any)
@@ -815,6 +818,8 @@ class ValidatingXmlParser(object):
     class Exit(Exception):
         """Raised when the parsing is stopped before the end on purpose"""
 
+    _emit = None  # tag of the nodes to yield in iterparse
+
     def __init__(self, validators, stop=None):
         self.validators = validators
         self.stop = stop
@@ -871,6 +876,36 @@ class ValidatingXmlParser(object):
                     self.p.ParseFile(f)
         return self._root
 
+    def iterparse(self, file_or_fname, tag, bufsize=1024 ** 2):
+        """
+        Parse a file or a filename in chunks of `bufsize` bytes and yield
+        the validated nodes with the given tag as soon as they are complete.
+        The yielded nodes are not attached to their parent, so the memory
+        occupation does not depend on the number of nodes in the file.
+        """
+        if hasattr(file_or_fname, 'read'):
+            f = file_or_fname
+            filename = getattr(f, 'name', f.__class__.__name__)
+        else:
+            filename = file_or_fname
+            f = open(file_or_fname, 'rb')
+        self._emit = tag
+        self._emitted = []
+        try:
+            with self._context():
+                self.filename = filename
+                while True:
+                    data = f.read(bufsize)
+                    self.p.Parse(data, not data)
+                    yield from self._emitted
+                    self._emitted.clear()
+                    if not data:
+                        break
+        finally:
+            self._emit = None
+            if f is not file_or_fname:
+                f.close()
+
     def _start_element(self, longname, attrs):
         try:
             xmlns, name = longname.split('}')
@@ -890,7 +925,9 @@ class ValidatingXmlParser(object):
         with context(self.filename, node):
             self._root = self._literalnode(node)
         del self._ancestors[-1]
-        if self._ancestors:
+        if self._emit and striptag(node.tag) == self._emit:
+            self._emitted.append(self._root)  # detached from the parent
+        elif self._ancestors:
             self._ancestors[-1].append(self._root)
 
     def _char_data(self, data):
@@ -937,3 +974,101 @@ class ValidatingXmlParser(object):
             elif n in self.validators:
                 self._set_attrib(node, n, n, v)
         return node
+
+
+# ######################## splitting XML files ######################## #
+
+XmlBlock = collections.namedtuple(
+    'XmlBlock', 'key tag header footer start stop lineno')
+
+
+def _start_tag(name, attrs):
+    return '<%s%s>' % (name, ''.join(' %s=%s' % (n, quoteattr(v))
+                                     for n, v in attrs.items()))
+
+
+def split_xml(fname, splittable, blocksize):
+    """
+    Scan an XML file with a non-validating parser and split the children
+    of the splittable elements in blocks of contiguous elements of
+    around `blocksize` bytes. The blocks can be parsed independently by
+    reading them with :func:`read_xml_block`.
+
+    :param fname: path to an XML file
+    :param splittable: a function (tag, attrib) -> boolean
+    :param blocksize: the approximate size of the blocks in bytes
+    :returns: a list of XmlBlock namedtuples ordered by position
+    """
+    blocks = []
+    stack = []  # triples (name, attrs, marks) with marks=None if not split
+    encoding = []
+    p = ParserCreate()
+
+    def xml_decl(version, enc, standalone):
+        if enc:
+            encoding.append(enc)
+
+    def start(name, attrs):
+        pos = p.CurrentByteIndex, p.CurrentLineNumber
+        parent = stack[-1] if stack else (None, None, None)
+        if parent[2] == 'item':  # inside an item, nothing to split
+            stack.append((name, None, 'item'))
+        elif splittable(name, attrs):
+            if parent[2] is not None:  # close the current run of items
+                parent[2].append(pos + (False,))
+            stack.append((name, attrs, []))
+        elif parent[2] is not None:  # child of a splittable element
+            parent[2].append(pos + (True,))
+            stack.append((name, None, 'item'))
+        else:
+            stack.append((name, attrs, None))
+
+    def end(name):
+        name, attrs, marks = stack.pop()
+        if not isinstance(marks, list) or not marks:
+            return
+        enc = encoding[0] if encoding else 'utf-8'
+        header = ''.join(_start_tag(n, a) for n, a, _ in stack)
+        header += _start_tag(name, attrs)
+        if encoding:
+            header = '<?xml version="1.0" encoding="%s"?>' % enc + header
+        footer = ''.join('</%s>' % n for n, _, _ in reversed(stack))
+        key = len(blocks)  # unique for each splittable element
+        marks.append((p.CurrentByteIndex, None, False))
+        start = None
+        for (byte, lineno, item), (nextbyte, _, nextitem) in zip(
+                marks, marks[1:]):
+            if not item:
+                continue
+            if start is None:
+                start, firstline = byte, lineno
+            if not nextitem or nextbyte - start >= blocksize:
+                blocks.append(XmlBlock(
+                    key, name.split(':')[-1], header.encode(enc),
+                    ('</%s>' % name + footer).encode(enc),
+                    start, nextbyte, firstline))
+                start = None
+
+    p.XmlDeclHandler = xml_decl
+    p.StartElementHandler = start
+    p.EndElementHandler = end
+    with open(fname, 'rb') as f:
+        try:
+            p.ParseFile(f)
+        except ExpatError as err:
+            raise ExpatError('%s: %s: %s' % (fname, err.lineno,
+                                             ErrorString(err.code)))
+    return sorted(blocks, key=operator.attrgetter('start'))
+
+
+def read_xml_block(fname, block):
+    """
+    :param fname: path to the XML file that was split with :func:`split_xml`
+    :param block: an XmlBlock instance
+    :returns: the block as a well-formed XML document (bytes), with the
+              same line numbers of the original file
+    """
+    with open(fname, 'rb') as f:
+        f.seek(block.start)
+        data = f.read(block.stop - block.start)
+    return block.header + b'\n' * (block.lineno - 1) + data + block.footer
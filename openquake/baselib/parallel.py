@@ -184,6 +184,8 @@ import os
 import re
 import ast
 import sys
+import glob
+import mmap
 import time
 import socket
 import signal
@@ -192,6 +194,7 @@ import inspect
 import logging
 import operator
 import traceback
+import tempfile
 import collections
 from unittest import mock
 import multiprocessing.dummy
@@ -209,7 +212,7 @@ from openquake.baselib.performance import (
     Monitor, memory_rss, init_performance)
 from openquake.baselib.general import (
     split_in_blocks, block_splitter, AccumDict, humansize, CallableDict,
-    gettemp)
+    gettemp, fast_agg3)
 
 sys.setrecursionlimit(1200)  # raised a bit to make pickle happier
 # see https://github.com/gem/oq-engine/issues/5230
@@ -221,6 +224,9 @@ try:
     CT = len(psutil.Process().cpu_affinity()) * 2
 except AttributeError:
     CT = psutil.cpu_count() * 2
+# arrays bigger than this are transferred via memory-mapped files
+SHMEM_THRESHOLD = config.memory.get('shmem_threshold', 0) * 1024 ** 2
+SHMEM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
 
 
 @submit.add('no')
@@ -279,28 +285,66 @@ class Pickled(object):
     have a nice string representation and length giving the size
     of the pickled bytestring.
 
+    If `shmem` is nonzero, the contiguous numpy arrays bigger than
+    `shmem_threshold` (in MB, see the [memory] section of openquake.cfg)
+    are not copied in the bytestring but stored in memory-mapped files in
+    /dev/shm; then only the file names travel through the pipes or sockets.
+    The files are removed as soon as they are mapped by the receiver,
+    and the memory is released when the unpickled arrays are garbage
+    collected. This requires pickle protocol 5, i.e. Python 3.8+.
+
     :param obj: the object to pickle
+    :param shmem: the PID of the master process or 0 (no shared memory)
     """
-    def __init__(self, obj):
+    def __init__(self, obj, shmem=0):
         self.clsname = obj.__class__.__name__
         self.calc_id = str(getattr(obj, 'calc_id', ''))  # for monitors
+        self.master_pid = shmem
+        self.shmem = []  # pairs (path, nbytes)
         try:
-            self.pik = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            if shmem and SHMEM_THRESHOLD and hasattr(pickle, 'PickleBuffer'):
+                self.pik = pickle.dumps(obj, 5, buffer_callback=self._dump)
+            else:
+                self.pik = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
         except TypeError as exc:  # can't pickle, show the obj in the message
             raise TypeError('%s: %s' % (exc, obj))
 
+    def _dump(self, buf):
+        # store a big buffer in a memory-mapped file; called by pickle.dumps
+        raw = buf.raw()
+        if raw.nbytes < SHMEM_THRESHOLD:
+            return True  # serialize the buffer in-band
+        # the master removes the files not received in Starmap.shutdown
+        fd, path = tempfile.mkstemp(
+            prefix='oq-shm-%d-' % self.master_pid, dir=SHMEM_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+        self.shmem.append((path, raw.nbytes))
+
     def __repr__(self):
         """String representation of the pickled object"""
         return '<Pickled %s #%s %s>' % (
             self.clsname, self.calc_id, humansize(len(self)))
 
     def __len__(self):
-        """Length of the pickled bytestring"""
-        return len(self.pik)
+        """Length of the pickled bytestring plus the memory-mapped data"""
+        return len(self.pik) + sum(nbytes for _, nbytes in self.shmem)
 
     def unpickle(self):
         """Unpickle the underlying object"""
-        return pickle.loads(self.pik)
+        if not self.shmem:
+            return pickle.loads(self.pik)
+        if not hasattr(self, '_buffers'):  # first time
+            self._buffers = []
+            for path, nbytes in self.shmem:
+                with open(path, 'r+b') as f:
+                    self._buffers.append(mmap.mmap(f.fileno(), nbytes))
+                os.remove(path)  # the mapped memory stays valid
+        return pickle.loads(self.pik, buffers=self._buffers)
+
+    def __getstate__(self):
+        # the mapped buffers are local to the process
+        return {k: v for k, v in vars(self).items() if k != '_buffers'}
 
 
 def get_pickled_sizes(obj):
@@ -325,7 +369,7 @@ def get_pickled_sizes(obj):
         sizes, key=lambda pair: pair[1], reverse=True)
 
 
-def pickle_sequence(objects):
+def pickle_sequence(objects, shmem=0):
     """
     Convert an iterable of objects into a list of pickled objects.
     If the iterable contains copies, the pickling will be done only once.
@@ -333,6 +377,7 @@ def pickle_sequence(objects):
     pickled again.
 
     :param objects: a sequence of objects to pickle
+    :param shmem: passed to :class:`Pickled`
     """
     cache = {}
     out = []
@@ -342,7 +387,7 @@ def pickle_sequence(objects):
             if isinstance(obj, Pickled):  # already pickled
                 cache[obj_id] = obj
             else:  # pickle the object
-                cache[obj_id] = Pickled(obj)
+                cache[obj_id] = Pickled(obj, shmem)
         out.append(cache[obj_id])
     return out
 
@@ -358,6 +403,59 @@ class FakePickle:
         return self.sentbytes
 
 
+class CostModel(dict):
+    """
+    A dictionary task name -> time per unit of weight, learned from the
+    durations and weights of the tasks already completed (the same
+    information stored by :meth:`Monitor.save_task_info`). It is used to
+    estimate the duration of a task before running it:
+
+    >>> cm = CostModel()
+    >>> cm.update('count', weight=10, duration=5)
+    >>> cm.update('count', weight=30, duration=15)
+    >>> cm
+    {'count': 0.5}
+    >>> cm.estimate('count', 100)
+    50.0
+    >>> print(cm.estimate('unknown', 100))
+    None
+    """
+    def __init__(self):
+        self.weight = AccumDict(accum=0.)  # task name -> total weight
+        self.time = AccumDict(accum=0.)  # task name -> total duration
+
+    @classmethod
+    def read(cls, h5):
+        """
+        :param h5: an hdf5.File with a task_info dataset (or not)
+        :returns: a CostModel instance
+        """
+        self = cls()
+        if 'task_info' in h5 and len(h5['task_info']):
+            info = fast_agg3(h5['task_info'][()], 'taskname',
+                             ['weight', 'duration'])
+            for rec in info:
+                self.update(rec['taskname'].decode('utf8'),
+                            rec['weight'], rec['duration'])
+        return self
+
+    def update(self, name, weight, duration):
+        """
+        Update the time per unit of weight of the given task
+        """
+        self.weight[name] += weight
+        self.time[name] += duration
+        if self.weight[name]:
+            self[name] = self.time[name] / self.weight[name]
+
+    def estimate(self, name, weight):
+        """
+        :returns: the expected duration of a task or None if unknown
+        """
+        if name in self:
+            return self[name] * weight
+
+
 class Result(object):
     """
     :param val: value to return or exception instance
@@ -368,18 +466,19 @@ class Result(object):
     func = None
 
     def __init__(self, val, mon, tb_str='', msg=''):
+        shmem = getattr(mon, 'shmem', 0)
         if isinstance(val, dict):
-            self.pik = Pickled(val)
+            self.pik = Pickled(val, shmem)
             self.nbytes = {k: len(Pickled(v)) for k, v in val.items()}
         elif isinstance(val, tuple) and callable(val[0]):
             self.func = val[0]
-            self.pik = pickle_sequence(val[1:])
+            self.pik = pickle_sequence(val[1:], shmem)
             self.nbytes = {'args': sum(len(p) for p in self.pik)}
         elif msg == 'TASK_ENDED':
             self.pik = Pickled(None)
             self.nbytes = {}
         else:
-            self.pik = Pickled(val)
+            self.pik = Pickled(val, shmem)
             self.nbytes = {'tot': len(self.pik)}
         self.mon = mon
         self.tb_str = tb_str
@@ -448,6 +547,42 @@ dummy_mon = Monitor()
 dummy_mon.version = __version__
 dummy_mon.backurl = None
 
+# per-process cache (calc_id, key) -> object, managed by `cached`
+_cache = {}
+
+
+def cached(calc_id, key, func, *args):
+    """
+    :param calc_id: the calculation ID (if None nothing is cached)
+    :param key: a string identifying the object inside the calculation
+    :param func: a function building the object from the arguments
+    :returns: the object, possibly coming from the cache of the process
+
+    Objects like the asset collection or the risk model are the same for
+    all the tasks of a calculation, so a worker can read them only once
+    and keep them in memory for the following tasks. The cache contains
+    the objects of a single calculation and it is cleared as soon as
+    the worker receives a task of a different calculation.
+    """
+    if calc_id is None:
+        return func(*args)
+    try:
+        return _cache[calc_id, key]
+    except KeyError:
+        clear_cache(calc_id)  # remove the objects of other calculations
+        obj = _cache[calc_id, key] = func(*args)
+        return obj
+
+
+def clear_cache(calc_id=None):
+    """
+    Remove from the process cache the objects of the calculations different
+    from the given one; if no calculation is given, clear everything.
+    """
+    for cid, key in list(_cache):
+        if cid != calc_id:
+            del _cache[cid, key]
+
 
 def safely_call(func, args, task_no=0, mon=dummy_mon):
     """
@@ -470,6 +605,7 @@ def safely_call(func, args, task_no=0, mon=dummy_mon):
         assert not isgenfunc, func
         return Result.new(func, args, mon)
     mon = mon.new(operation='total ' + func.__name__, measuremem=True)
+    clear_cache(mon.calc_id)  # release the memory of previous calculations
     mon.weight = getattr(args[0], 'weight', 1.)  # used in task_info
     mon.task_no = task_no
     if mon.inject:
@@ -671,6 +807,11 @@ class Starmap(object):
             cls.pids = []
         if hasattr(cls, 'dask_client'):
             del cls.dask_client
+        clear_cache()
+        # remove the memory-mapped files of the results never received
+        for path in glob.glob(
+                os.path.join(SHMEM_DIR, 'oq-shm-%d-*' % os.getpid())):
+            os.remove(path)
 
     @classmethod
     def apply(cls, task, args, concurrent_tasks=None,
@@ -733,6 +874,7 @@ class Starmap(object):
         except TypeError:  # generators have no len
             self.num_tasks = None
         self.argnames = getargnames(task_func)
+        self.cost_model = CostModel.read(h5)
         self.sent = AccumDict(accum=AccumDict())  # fname -> argname -> nbytes
         self.monitor.inject = (self.argnames[-1].startswith('mon') or
                                self.argnames[-1].endswith('mon'))
@@ -779,6 +921,11 @@ class Starmap(object):
             monitor.backurl = 'tcp://%s:%s' % (
                 config.dbserver.host, self.socket.port)
             monitor.version = __version__
+            # in a processpool big arrays can be sent via shared memory
+            monitor.shmem = (os.getpid() if self.distribute == 'processpool'
+                             else 0)
+        # send to the workers the time per unit of weight learned so far
+        monitor.costs = dict(self.cost_model)
         OQ_TASK_NO = os.environ.get('OQ_TASK_NO')
         if OQ_TASK_NO is not None and self.task_no != int(OQ_TASK_NO):
             self.task_no += 1
@@ -788,7 +935,7 @@ class Starmap(object):
             pickled = isinstance(args[0], Pickled)
             if not pickled:
                 assert not isinstance(args[-1], Monitor)  # sanity check
-                args = pickle_sequence(args)
+                args = pickle_sequence(args, getattr(monitor, 'shmem', 0))
             if func is None:
                 fname = self.task_func.__name__
                 argnames = self.argnames[:-1]
@@ -857,6 +1004,8 @@ class Starmap(object):
                                 'is job %d', res.mon.calc_id, self.calc_id)
             elif res.msg == 'TASK_ENDED':
                 self.todo -= 1
+                self.cost_model.update(res.mon.operation[6:],  # strip 'total'
+                                       res.mon.weight, res.mon.duration)
                 self._submit_many(1)
                 logging.debug('%d tasks todo, %d in queue',
                               self.todo, len(self.task_queue))
@@ -900,7 +1049,13 @@ def split_task(func, *args, duration=1000,
     :param args: arguments of the task function
     :param duration: split the task if it exceeds the duration
     :param weight: weight function for the elements in args[0]
-    :yields: a partial result, 0 or more task objects, 0 or 1 partial result
+    :yields: 0 or 1 partial result, 0 or more task objects, 1 partial result
+
+    If the monitor carries the time per unit of weight learned by the
+    master (see :class:`CostModel`) the subtasks are sent back immediately,
+    so that idle cores can steal them while the current core is working
+    on the last block; otherwise the time per unit of weight is estimated
+    by computing the heaviest element first.
     """
     elements = numpy.array(sorted(args[0], key=weight, reverse=True))
     n = len(elements)
@@ -909,13 +1064,16 @@ def split_task(func, *args, duration=1000,
     if n == 1:
         yield func(*args)
         return
-    first, *other = elements
-    first_weight = weight(first)
-    t0 = time.time()
-    res = func(*([first],) + args[1:])
-    dt = (time.time() - t0) / first_weight  # time per unit of weight
-    yield res
-    blocks = list(block_splitter(other, duration, lambda el: weight(el) * dt))
+    dt = getattr(args[-1], 'costs', {}).get(func.__name__)
+    if dt is None:  # no previous information, estimate the cost
+        first, *elements = elements
+        first_weight = weight(first)
+        t0 = time.time()
+        res = func(*([first],) + args[1:])
+        dt = (time.time() - t0) / first_weight  # time per unit of weight
+        yield res
+    blocks = list(
+        block_splitter(elements, duration, lambda el: weight(el) * dt))
     for block in blocks[:-1]:
         yield (func, block) + args[1:-1]
     yield func(*(blocks[-1],) + args[1:])
@@ -187,6 +187,19 @@ param=yyy
             'nonParametric':
             {'singlePlaneRupture': ['1', '3'], 'multiPlanesRupture': '2'}})
 
+    def test_iterparse(self):
+        xmlfile = io.BytesIO(b"""\
+<assets>
+<asset id="a1"><cost value="1"/></asset>
+<asset id="a2"><cost value="2"/></asset>
+</assets>
+""")
+        parser = n.ValidatingXmlParser({'value': float})
+        nodes = list(parser.iterparse(xmlfile, 'asset', bufsize=16))
+        self.assertEqual([node['id'] for node in nodes], ['a1', 'a2'])
+        self.assertEqual([node.cost['value'] for node in nodes], [1., 2.])
+        self.assertEqual(len(parser._root), 0)  # the assets are detached
+
     def test_can_pickle(self):
         node = n.Node('tag')
         self.assertEqual(pickle.loads(pickle.dumps(node)), node)
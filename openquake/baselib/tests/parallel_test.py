@@ -17,6 +17,7 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import pickle
 import unittest.mock as mock
 import time
 import shutil
@@ -58,6 +59,15 @@ def supertask(text, monitor):
             yield get_length, k * v
 
 
+class Word(object):
+    def __init__(self, text):
+        self.weight = len(text)
+
+
+def sum_lengths(words, monitor):
+    return sum(w.weight for w in words)
+
+
 def countletters(text1, text2, monitor):
     for block in general.block_splitter(text1 + text2, 5):
         yield get_length, ''.join(block)
@@ -153,6 +163,79 @@ class StarmapTestCase(unittest.TestCase):
         parallel.Starmap.shutdown()
 
 
+class SplitTaskTestCase(unittest.TestCase):
+    words = [Word(w) for w in 'hello world ciao mondo'.split()]
+
+    def test_no_costs(self):
+        # the first element is computed to estimate the cost
+        res = list(parallel.split_task(sum_lengths, self.words,
+                                       parallel.Monitor()))
+        self.assertEqual(res[0], 5)
+        self.assertEqual(res[-1] + sum(sum_lengths(*r[1:], None)
+                                       for r in res[1:-1]), 14)
+
+    def test_learned_costs(self):
+        # with the costs coming from the master the subtasks are sent first
+        mon = parallel.Monitor()
+        mon.costs = {'sum_lengths': 1.}  # 1 second per unit of weight
+        res = list(parallel.split_task(sum_lengths, self.words, mon,
+                                       duration=10))
+        subtasks = [r for r in res if isinstance(r, tuple)]
+        self.assertEqual(len(subtasks), 1)
+        self.assertEqual(subtasks[0][0], sum_lengths)
+        self.assertEqual(sum_lengths(subtasks[0][1], mon) + res[-1], 19)
+
+    def test_cost_model(self):
+        tmpdir = tempfile.mkdtemp()
+        tmp = os.path.join(tmpdir, 'calc_1.hdf5')
+        performance.init_performance(tmp)
+        res = parallel.Result(None, parallel.Monitor())
+        with hdf5.File(tmp, 'a') as h5:
+            for weight, duration in [(2, 1), (6, 3)]:
+                mon = parallel.Monitor()
+                mon.weight, mon.duration = weight, duration
+                mon.save_task_info(h5, res, 'get_length')
+            cm = parallel.CostModel.read(h5)
+        self.assertEqual(cm, {'get_length': .5})
+        self.assertEqual(cm.estimate('get_length', 10), 5)
+        shutil.rmtree(tmpdir)
+
+
+class CacheTestCase(unittest.TestCase):
+    def test(self):
+        calls = []
+
+        def read(name):
+            calls.append(name)
+            return name.upper()
+        self.assertEqual(parallel.cached(1, 'x', read, 'x'), 'X')
+        self.assertEqual(parallel.cached(1, 'x', read, 'x'), 'X')
+        self.assertEqual(calls, ['x'])  # read only once
+        # a task of a different calculation clears the cache
+        self.assertEqual(parallel.cached(2, 'y', read, 'y'), 'Y')
+        self.assertEqual(sorted(parallel._cache), [(2, 'y')])
+        # without a calculation ID nothing is cached
+        parallel.cached(None, 'z', read, 'z')
+        self.assertEqual(sorted(parallel._cache), [(2, 'y')])
+        parallel.clear_cache()
+        self.assertEqual(parallel._cache, {})
+
+
+class SharedMemoryTestCase(unittest.TestCase):
+    @unittest.skipUnless(hasattr(pickle, 'PickleBuffer'), 'requires 3.8+')
+    def test(self):
+        big, small = numpy.arange(10000.), numpy.arange(3)
+        with mock.patch.object(parallel, 'SHMEM_THRESHOLD', 1000):
+            pik = parallel.Pickled({'big': big, 'small': small}, os.getpid())
+        [(path, nbytes)] = pik.shmem  # only the big array is in /dev/shm
+        self.assertEqual(nbytes, big.nbytes)
+        self.assertGreater(len(pik), big.nbytes)
+        dic = pickle.loads(pickle.dumps(pik)).unpickle()  # as in a worker
+        numpy.testing.assert_equal(dic['big'], big)
+        numpy.testing.assert_equal(dic['small'], small)
+        self.assertFalse(os.path.exists(path))  # removed after mapping
+
+
 class ThreadPoolTestCase(unittest.TestCase):
     def test(self):
         with mock.patch.dict(os.environ, {'OQ_DISTRIBUTE': 'threadpool'}):
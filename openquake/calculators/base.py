@@ -38,6 +38,7 @@ from openquake.hazardlib.site_amplification import Amplifier
 from openquake.hazardlib.site_amplification import AmplFunction
 
 from openquake.hazardlib.calc.filters import SourceFilter
+from openquake.hazardlib.probability_map import DenseProbabilityMap
 from openquake.hazardlib.source import rupture
 from openquake.hazardlib.shakemap import get_sitecol_shakemap, to_gmfs
 from openquake.risklib import riskinput, riskmodels
@@ -120,6 +121,9 @@ def fix_ones(pmap):
     Here we solve the issue by replacing the unphysical probabilities 1
     with .9999999999999999 (the float64 closest to 1).
     """
+    if isinstance(pmap, DenseProbabilityMap):
+        pmap.array[pmap.array == 1.] = .9999999999999999
+        return pmap
     for sid in pmap:
         array = pmap[sid].array
         array[array == 1.] = .9999999999999999
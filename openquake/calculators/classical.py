@@ -19,11 +19,9 @@ import io
 import os
 import re
 import time
-import copy
 import pprint
 import logging
 import operator
-from datetime import datetime
 import numpy
 try:
     from PIL import Image
@@ -34,9 +32,10 @@ from openquake.baselib.python3compat import encode
 from openquake.baselib.general import (
     AccumDict, DictArray, block_splitter, groupby, humansize, get_array_nbytes)
 from openquake.hazardlib.contexts import ContextMaker, get_effect
-from openquake.hazardlib.calc.filters import split_sources
+from openquake.hazardlib.calc.filters import split_sources, BBoxError
 from openquake.hazardlib.calc.hazard_curve import classical
-from openquake.hazardlib.probability_map import ProbabilityMap
+from openquake.hazardlib.probability_map import (
+    ProbabilityMap, ProbabilityCurve, DenseProbabilityMap)
 from openquake.commonlib import calc, util, logs, readinput
 from openquake.commonlib.source_reader import random_filtered_sources
 from openquake.calculators import getters
@@ -47,6 +46,7 @@ U32 = numpy.uint32
 F32 = numpy.float32
 F64 = numpy.float64
 TWO32 = 2 ** 32
+MAX_ELEMENTS = 5_000_000  # max size of the PoEs arrays in build_hazard
 grp_extreme_dt = numpy.dtype([('grp_id', U16), ('grp_trt', hdf5.vstr),
                              ('extreme_poe', F32)])
 
@@ -65,12 +65,12 @@ You should reduce one or more of the listed parameters.'''
 
 def get_extreme_poe(array, imtls):
     """
-    :param array: array of shape (L, G) with L=num_levels, G=num_gsims
+    :param array: array of shape ([N,] L, G) with L=num_levels, G=num_gsims
     :param imtls: DictArray imt -> levels
     :returns:
         the maximum PoE corresponding to the maximum level for IMTs and GSIMs
     """
-    return max(array[imtls(imt).stop - 1].max() for imt in imtls)
+    return max(array[..., imtls(imt).stop - 1, :].max() for imt in imtls)
 
 
 def classical_split_filter(srcs, srcfilter, gsims, params, monitor):
@@ -107,15 +107,26 @@ def classical_split_filter(srcs, srcfilter, gsims, params, monitor):
     if monitor.calc_id and subtasks:
         msg = 'produced %d subtask(s) with mean weight %d' % (
             subtasks, numpy.mean([b.weight for b in blocks[:-1]]))
-        try:
-            logs.dbcmd('log', monitor.calc_id, datetime.utcnow(), 'DEBUG',
-                       'classical_split_filter#%d' % monitor.task_no, msg)
-        except Exception:
-            # a foreign key error in case of `oq run` is expected
-            print(msg)
+        logs.dblog(monitor.calc_id, 'DEBUG',
+                   'classical_split_filter#%d' % monitor.task_no, msg)
     yield classical(blocks[-1], srcfilter, gsims, params, monitor)
 
 
+def _tile_filters(srcfilter, tiles, srcs):
+    # yield the filters of the tiles intersecting the sources, i.e. having
+    # sites in the bounding box of the sources enlarged by maximum_distance
+    tile_idx, tilefilters = tiles
+    # NB: the area sources are split, since the bounding box of the polygon
+    # does not include the size of the ruptures generated by the points
+    srcs = [s for src in srcs for s in (src if src.code == b'A' else [src])]
+    try:
+        sids = srcfilter.within_bbox(srcs)
+    except BBoxError:  # too large, consider all tiles
+        sids = slice(None)
+    for t in numpy.unique(tile_idx[sids]):
+        yield tilefilters[t]
+
+
 def preclassical(srcs, srcfilter, gsims, params, monitor):
     """
     Split and prefilter the sources
@@ -193,31 +204,57 @@ class ClassicalCalculator(base.HazardCalculator):
         if not dic['pmap']:
             return acc
         if self.oqparam.disagg_by_src:
-            # store the poes for the given source
-            acc[dic['extra']['source_id']] = dic['pmap']
+            # store the poes for the given source; with tiling the source
+            # comes back once per tile, so the tiles are merged
+            srcid = dic['extra']['source_id']
+            if srcid in acc:
+                for grp_id, pmap in dic['pmap'].items():
+                    if grp_id in acc[srcid]:
+                        acc[srcid][grp_id] |= pmap
+                    else:
+                        acc[srcid][grp_id] = pmap
+            else:
+                acc[srcid] = dic['pmap']
 
         trt = dic['extra'].pop('trt')
         self.maxradius = max(self.maxradius, dic['extra'].pop('maxradius'))
         with self.monitor('aggregate curves'):
             extra = dic['extra']
-            self.totrups += extra['totrups']
             d = dic['calc_times']  # srcid -> eff_rups, eff_sites, dt
-            self.calc_times += d
             srcids = set()
             eff_rups = 0
             eff_sites = 0
+            basename = {}  # split source ID -> source ID
             for srcid, rec in d.items():
-                srcids.add(re.sub(r':\d+$', '', srcid))
+                basename[srcid] = re.sub(r':\d+$', '', srcid)
+                srcids.add(basename[srcid])
                 eff_rups += rec[0]
                 if rec[0]:
                     eff_sites += rec[1] / rec[0]
             self.by_task[extra['task_no']] = (
                 eff_rups, eff_sites, sorted(srcids))
+            tiled = [srcid for srcid in d if basename[srcid] in self.tiled]
+            if tiled:
+                # the sources are computed once per tile: count their
+                # ruptures only once and take the maximum number of
+                # effective ruptures over the tiles
+                for srcid in tiled:
+                    self.totrups += self.tiled[basename[srcid]]
+                    self.tiled[basename[srcid]] = 0  # already counted
+                    prev = self.calc_times.get(srcid)
+                    if prev is not None:
+                        d[srcid][0] = max(d[srcid][0] - prev[0], 0)
+                eff_rups = sum(rec[0] for rec in d.values())
+            else:
+                self.totrups += extra['totrups']
+            self.calc_times += d
             for grp_id, pmap in dic['pmap'].items():
-                if pmap and grp_id in acc:
+                if not isinstance(pmap, (ProbabilityMap, DenseProbabilityMap)):
+                    acc.setdefault(grp_id, pmap)  # 0 from preclassical
+                elif acc.get(grp_id):
                     acc[grp_id] |= pmap
                 else:
-                    acc[grp_id] = copy.copy(pmap)
+                    acc[grp_id] = DenseProbabilityMap.from_pmap(pmap)
                 acc.eff_ruptures[trt] += eff_rups
 
             # store rup_data if there are few sites
@@ -227,7 +264,7 @@ class ClassicalCalculator(base.HazardCalculator):
 
     def acc0(self):
         """
-        Initial accumulator, a dict grp_id -> ProbabilityMap(L, G)
+        Initial accumulator, a dict grp_id -> DenseProbabilityMap(L, G)
         """
         zd = AccumDict()
         num_levels = len(self.oqparam.imtls.array)
@@ -392,7 +429,7 @@ class ClassicalCalculator(base.HazardCalculator):
         self.numrups = sum(arr[0] for arr in self.calc_times.values())
         numsites = sum(arr[1] for arr in self.calc_times.values())
         logging.info('Effective number of ruptures: {:_d}/{:_d}'.format(
-            int(self.numrups), self.totrups))
+            int(self.numrups), int(self.totrups)))
         logging.info('Effective number of sites per rupture: %d',
                      numsites / self.numrups)
         if psd:
@@ -445,11 +482,14 @@ class ClassicalCalculator(base.HazardCalculator):
             filter_distance=oq.filter_distance, reqv=oq.get_reqv(),
             pointsource_distance=getattr(oq.pointsource_distance, 'ddic', {}),
             point_rupture_bins=oq.point_rupture_bins,
+            gsim_table_tolerance=oq.gsim_table_tolerance,
             shift_hypo=oq.shift_hypo, max_weight=max_weight,
             collapse_level=oq.collapse_level,
             max_sites_disagg=oq.max_sites_disagg,
             af=self.af)
         srcfilter = self.src_filter(self.datastore.tempname)
+        tiles = self.get_tiles(srcfilter, f2)
+        self.tiled = AccumDict(accum=0)  # source_id -> num_ruptures
         for sg in src_groups:
             gsims = gsims_by_trt[sg.trt]
             param['rescale_weight'] = len(gsims)
@@ -468,7 +508,16 @@ class ClassicalCalculator(base.HazardCalculator):
                     logging.debug('Sending %d source(s) with weight %d',
                                   len(block),
                                   sum(srcweight(src) for src in block))
-                    smap.submit((block, srcfilter, gsims, param), f2)
+                    if tiles is None:
+                        smap.submit((block, srcfilter, gsims, param), f2)
+                        continue
+                    tilefilters = list(
+                        _tile_filters(srcfilter, tiles, block))
+                    if len(tilefilters) > 1:  # used in agg_dicts
+                        for src in block:
+                            self.tiled[src.source_id] += src.num_ruptures
+                    for tilefilter in tilefilters:
+                        smap.submit((block, tilefilter, gsims, param), f2)
 
             w = sum(srcweight(src) for src in sg)
             logging.info('TRT = %s', sg.trt)
@@ -477,29 +526,46 @@ class ClassicalCalculator(base.HazardCalculator):
             logging.info('max_dist={}, gsims={}, weight={:_d}, blocks={}'.
                          format(md, len(gsims), int(w), nb))
 
+    def get_tiles(self, srcfilter, task_func):
+        """
+        :returns:
+            None or a pair (tile_idx, tilefilters) with the tile index of
+            each site and the filters restricted to the sites of each tile,
+            when the number of sites exceeds `max_sites_per_tile`
+        """
+        mspt = self.oqparam.max_sites_per_tile
+        sitecol = self.sitecol.complete
+        N = len(sitecol)
+        if not mspt or N <= mspt or task_func is preclassical:
+            return
+        tiles = sitecol.split_in_tiles(numpy.ceil(N / mspt), by_locality=True)
+        logging.info('Splitting the %d sites in %d tiles', N, len(tiles))
+        tile_idx = numpy.zeros(N, int)
+        for t, tile in enumerate(tiles):
+            tile_idx[tile.sids] = t
+        return tile_idx, [srcfilter.restrict(tile.sids) for tile in tiles]
+
     def save_hazard(self, acc, pmap_by_kind):
         """
         Works by side effect by saving hcurves and hmaps on the datastore
 
         :param acc: ignored
-        :param pmap_by_kind: a dictionary of ProbabilityMaps
+        :param pmap_by_kind: a dictionary kind -> (sids, array)
 
-        kind can be ('hcurves', 'mean'), ('hmaps', 'mean'),  ...
+        kind can be 'hcurves-stats', 'hmaps-stats', 'hcurves-rlzs', ...
+        and the array has shape (N, R, L) for the curves and (N, R, M, P)
+        for the maps.
         """
         with self.monitor('saving statistics'):
-            for kind in pmap_by_kind:  # i.e. kind == 'hcurves-stats'
-                pmaps = pmap_by_kind[kind]
-                if kind in ('hmaps-rlzs', 'hmaps-stats'):
-                    # pmaps is a list of R pmaps
-                    dset = self.datastore.getitem(kind)
-                    for r, pmap in enumerate(pmaps):
-                        for s in pmap:
-                            dset[s, r] = pmap[s].array  # shape (M, P)
-                elif kind in ('hcurves-rlzs', 'hcurves-stats'):
-                    dset = self.datastore.getitem(kind)
-                    for r, pmap in enumerate(pmaps):
-                        for s in pmap:
-                            dset[s, r] = pmap[s].array.reshape(self.M, self.L1)
+            for kind, (sids, array) in pmap_by_kind.items():
+                dset = self.datastore.getitem(kind)
+                # read and write a contiguous slice, much faster than
+                # assigning a list of sids
+                slc = slice(sids[0], sids[-1] + 1)
+                data = dset[slc]
+                data[sids - sids[0]] = array.reshape(
+                    (len(array),) + dset.shape[1:])
+                dset[slc] = data
             self.datastore.flush()
 
     def post_execute(self, pmap_by_key):
@@ -530,9 +596,7 @@ class ClassicalCalculator(base.HazardCalculator):
                     trt = self.full_lt.trt_by_grp[key]
                     name = 'poes/grp-%02d' % key
                     self.datastore[name] = pmap
-                    extreme = max(
-                        get_extreme_poe(pmap[sid].array, oq.imtls)
-                        for sid in pmap)
+                    extreme = get_extreme_poe(pmap.array, oq.imtls)
                     data.append((key, trt, extreme))
         if oq.hazard_calculation_id is None and 'poes' in self.datastore:
             self.datastore['disagg_by_grp'] = numpy.array(
@@ -653,13 +717,13 @@ def build_hazard(pgetter, N, hstats, individual_curves,
     :param max_sites_disagg: if there are less sites than this, store rup info
     :param amplifier: instance of Amplifier or None
     :param monitor: instance of Monitor
-    :returns: a dictionary kind -> ProbabilityMap
+    :yields: dictionaries kind -> (sids, array), one per block of sites
 
-    The "kind" is a string of the form 'rlz-XXX' or 'mean' of 'quantile-XXX'
-    used to specify the kind of output.
+    The "kind" is a string of the form 'hcurves-rlzs', 'hcurves-stats',
+    'hmaps-rlzs' or 'hmaps-stats', i.e. the name of the output dataset.
     """
     with monitor('read PoEs'):
-        pgetter.init()
+        pgetter.init_attrs()
         if amplifier:
             ampcode = pgetter.dstore['sitecol'].ampcode
             imtls = DictArray({imt: amplifier.amplevels
@@ -668,41 +732,57 @@ def build_hazard(pgetter, N, hstats, individual_curves,
             imtls = pgetter.imtls
     poes, weights = pgetter.poes, pgetter.weights
     M = len(imtls)
-    P = len(poes)
     L = len(imtls.array)
     R = len(weights)
-    S = len(hstats)
-    pmap_by_kind = {}
-    if R > 1 and individual_curves or not hstats:
-        pmap_by_kind['hcurves-rlzs'] = [ProbabilityMap(L) for r in range(R)]
-    if hstats:
-        pmap_by_kind['hcurves-stats'] = [ProbabilityMap(L) for r in range(S)]
-        if poes:
-            pmap_by_kind['hmaps-stats'] = [
-                ProbabilityMap(M, P) for r in range(S)]
+    statfuncs = list(hstats.values())
     combine_mon = monitor('combine pmaps', measuremem=False)
     compute_mon = monitor('compute stats', measuremem=False)
-    for sid in pgetter.sids:
+    # the sites are processed in blocks, so that the arrays of
+    # shape (N, R, L) have at most MAX_ELEMENTS elements
+    sids = numpy.sort(pgetter.sids)
+    blocksize = max(MAX_ELEMENTS // (R * len(pgetter.imtls.array)), 1)
+    for start in range(0, len(sids), blocksize):
+        block = sids[start:start + blocksize]
         with combine_mon:
-            pcurves = pgetter.get_pcurves(sid)
+            pcurves = pgetter.get_pcurves_block(block)  # shape (N, R, L)
             if amplifier:
-                pcurves = amplifier.amplify(ampcode[sid], pcurves)
                 # NB: the pcurves have soil levels != IMT levels
-        if sum(pc.array.sum() for pc in pcurves) == 0:  # no data
+                pcurves = numpy.array([
+                    [pc.array[:, 0] for pc in amplifier.amplify(
+                        ampcode[sid], [ProbabilityCurve(arr[:, None])
+                                       for arr in pcurves[i]])]
+                    for i, sid in enumerate(block)])
+            ok = pcurves.sum(axis=(1, 2)) > 0  # discard sites without data
+            block, pcurves = block[ok], pcurves[ok]
+        if len(block) == 0:
             continue
+        out = {}
         with compute_mon:
             if hstats:
-                arr = numpy.array([pc.array for pc in pcurves])
-                for s, (statname, stat) in enumerate(hstats.items()):
-                    pc = getters.build_stat_curve(arr, imtls, stat, weights)
-                    pmap_by_kind['hcurves-stats'][s][sid] = pc
-                    if poes:
-                        hmap = calc.make_hmap(pc, imtls, poes, sid)
-                        pmap_by_kind['hmaps-stats'][s].update(hmap)
+                arr = getters.build_stat_curves(
+                    pcurves, imtls, statfuncs, weights)  # shape (N, S, L)
+                out['hcurves-stats'] = block, arr
+                if poes:
+                    out['hmaps-stats'] = block, make_hmaps(arr, imtls, poes)
             if R > 1 and individual_curves or not hstats:
-                for pmap, pc in zip(pmap_by_kind['hcurves-rlzs'], pcurves):
-                    pmap[sid] = pc
+                out['hcurves-rlzs'] = block, pcurves
                 if poes:
-                    pmap_by_kind['hmaps-rlzs'] = [
-                        calc.make_hmap(pc, imtls, poes, sid) for pc in pcurves]
-    return pmap_by_kind
+                    out['hmaps-rlzs'] = block, make_hmaps(
+                        pcurves, imtls, poes)
+        yield out
+
+
+def make_hmaps(curves, imtls, poes):
+    """
+    :param curves: an array of shape (N, R, L)
+    :param imtls: a DictArray with M IMTs and L levels
+    :param poes: a list of P PoEs
+    :returns: an array of hazard maps of shape (N, R, M, P)
+    """
+    N, R, _ = curves.shape
+    hmaps = numpy.zeros((N, R, len(imtls), len(poes)))
+    for m, imt in enumerate(imtls):
+        data = calc.compute_hazard_maps(  # shape (N * R, P)
+            curves[:, :, imtls(imt)].reshape(N * R, -1), imtls[imt], poes)
+        hmaps[:, :, m] = data.reshape(N, R, -1)
+    return hmaps
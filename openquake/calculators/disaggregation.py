@@ -30,7 +30,8 @@ from openquake.baselib.python3compat import encode
 from openquake.hazardlib import stats
 from openquake.hazardlib.calc import disagg
 from openquake.hazardlib.imt import from_string
-from openquake.hazardlib.gsim.base import ContextMaker
+from openquake.hazardlib.gsim.base import (
+    ContextMaker, to_distribution_values)
 from openquake.hazardlib.contexts import read_ctxs, RuptureContext
 from openquake.hazardlib.tom import PoissonTOM
 from openquake.commonlib import util, calc
@@ -121,7 +122,7 @@ def compute_disagg(dstore, rctx, cmaker, hmap4, trti, bin_edges, oq, monitor):
         oq.investigation_time)
     with monitor('reading contexts', measuremem=True):
         dstore.open('r')
-        ctxs, close_ctxs = read_ctxs(
+        ctxs, _ = read_ctxs(
             dstore, rctx, req_site_params=cmaker.REQUIRES_SITES_PARAMETERS)
 
     magi = numpy.searchsorted(bin_edges[0], rctx[0]['mag']) - 1
@@ -130,11 +131,9 @@ def compute_disagg(dstore, rctx, cmaker, hmap4, trti, bin_edges, oq, monitor):
     dis_mon = monitor('disaggregate', measuremem=False)
     ms_mon = monitor('disagg mean_std', measuremem=True)
     N, M, P, Z = hmap4.shape
-    g_by_z = AccumDict(accum={})  # dict s -> z -> g
+    gidx = -numpy.ones((N, Z), int)  # gsim index for each site and rlz
     for g, rlzs in enumerate(cmaker.gsims.values()):
-        for (s, z), r in numpy.ndenumerate(hmap4.rlzs):
-            if r in rlzs:
-                g_by_z[s][z] = g
+        gidx[numpy.isin(hmap4.rlzs, rlzs)] = g
     eps3 = disagg._eps3(cmaker.trunclevel, oq.num_epsilon_bins)
     res = {'trti': trti, 'magi': magi}
     imts = [from_string(im) for im in oq.imtls]
@@ -143,19 +142,16 @@ def compute_disagg(dstore, rctx, cmaker, hmap4, trti, bin_edges, oq, monitor):
         # the size is N * U * G * 16 bytes
         disagg.set_mean_std(ctxs, imts, cmaker.gsims)
 
-    # disaggregate by site, IMT
-    for s, iml3 in enumerate(hmap4):
-        if not g_by_z[s] or not close_ctxs[s]:
-            # g_by_z[s] is empty in test case_7
-            continue
-        # dist_bins, lon_bins, lat_bins, eps_bins
-        bins = (bin_edges[1], bin_edges[2][s], bin_edges[3][s],
-                bin_edges[4])
-        iml2 = dict(zip(imts, iml3))
-        with dis_mon:
-            # 7D-matrix #distbins, #lonbins, #latbins, #epsbins, M, P, Z
-            matrix = disagg.disaggregate(
-                close_ctxs[s], g_by_z[s], iml2, eps3, s, bins)  # 7D-matrix
+    # switch to logarithmic intensities; 0 values are converted into -inf
+    iml4 = numpy.zeros((N, M, P, Z))
+    for m, imt in enumerate(imts):
+        iml4[:, m] = to_distribution_values(hmap4.array[:, m], imt)
+
+    # disaggregate all sites at once, by blocks of (rupture, site) pairs
+    with dis_mon:
+        # 7D-matrix #distbins, #lonbins, #latbins, #epsbins, M, P, Z
+        for s, matrix in disagg.disagg_by_site(
+                ctxs, iml4, gidx, eps3, bin_edges[1:]):
             for m in range(M):
                 mat6 = matrix[..., m, :, :]
                 if mat6.any():
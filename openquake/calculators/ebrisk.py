@@ -18,7 +18,6 @@
 import logging
 import operator
 import itertools
-from datetime import datetime
 import numpy
 
 from openquake.baselib import datastore, hdf5, parallel, general
@@ -27,7 +26,8 @@ from openquake.hazardlib.calc.filters import getdefault
 from openquake.risklib import riskmodels
 from openquake.risklib.scientific import LossesByAsset
 from openquake.risklib.riskinput import (
-    cache_epsilons, get_assets_by_taxo, get_output)
+    cache_epsilons, get_assets_by_taxo, get_output, get_ratios_by_taxo,
+    get_batched_output)
 from openquake.commonlib import logs
 from openquake.calculators import base, event_based, getters
 from openquake.calculators.post_risk import PostRiskCalculator
@@ -38,12 +38,44 @@ U32 = numpy.uint32
 F32 = numpy.float32
 F64 = numpy.float64
 TWO32 = 2 ** 32
+# approximate memory occupation of a loss in lba.alt, temporaries included
+ALT_NBYTES = 24
 get_n_occ = operator.itemgetter(1)
 
 gmf_info_dt = numpy.dtype([('rup_id', U32), ('task_no', U16),
                            ('nsites', U16), ('gmfbytes', F32), ('dt', F32)])
 
 
+def flush_alt(lba, events, aggkeys, elt_dt, alt):
+    """
+    Move the losses accumulated in lba.alt into the dictionary alt
+    aggkey -> list of arrays of dtype elt_dt. The same event can appear
+    in more arrays: the losses are summed in post_risk.
+    """
+    kids, eidxs, losses = lba.pop_alt()  # sorted by kid
+    elt = numpy.zeros(len(kids), elt_dt)
+    elt['event_id'] = events['id'][eidxs]
+    elt['rlzi'] = events['rlz_id'][eidxs]
+    elt['loss'] = losses
+    ukids, start = numpy.unique(kids, return_index=True)
+    for kid, arr in zip(ukids, numpy.split(elt, start[1:])):
+        alt[aggkeys[kid]].append(arr)
+
+
+def read_risk_inputs(hdf5path):
+    """
+    :param hdf5path: the path to the datastore of the calculation
+    :returns: assets_df, crmodel, the realization of each event, weights
+    """
+    dstore = datastore.read(hdf5path)
+    try:
+        return (dstore.read_df('assetcol/array', 'ordinal'),
+                riskmodels.CompositeRiskModel.read(dstore),
+                dstore['events']['rlz_id'], dstore['weights'][()])
+    finally:
+        dstore.close()
+
+
 def calc_risk(gmfs, param, monitor):
     """
     :param gmfs: an array of GMFs with fields sid, eid, gmv
@@ -54,26 +86,26 @@ def calc_risk(gmfs, param, monitor):
     mon_risk = monitor('computing risk', measuremem=False)
     mon_agg = monitor('aggregating losses', measuremem=False)
     eids = numpy.unique(gmfs['eid'])
-    dstore = datastore.read(param['hdf5path'])
-    with monitor('getting assets'):
-        assets_df = dstore.read_df('assetcol/array', 'ordinal')
-    with monitor('getting crmodel'):
-        crmodel = riskmodels.CompositeRiskModel.read(dstore)
-        events = dstore['events'][list(eids)]
-        weights = dstore['weights'][()]
+    # assets, risk model, event realizations and weights are kept in
+    # memory by the worker and reused by the following tasks of the same
+    # calculation, so that the datastore is opened only by the first task
+    with monitor('getting assets and crmodel'):
+        assets_df, crmodel, rlz_ids, weights = parallel.cached(
+            monitor.calc_id, 'risk_inputs',
+            read_risk_inputs, param['hdf5path'])
+        events = numpy.zeros(len(eids), [('id', U32), ('rlz_id', U16)])
+        events['id'] = eids
+        events['rlz_id'] = rlz_ids[eids]
     E = len(eids)
     L = len(param['lba'].loss_names)
     elt_dt = [('event_id', U32), ('rlzi', U16), ('loss', (F32, (L,)))]
-    # aggkey -> eid -> loss
     acc = dict(events_per_sid=0, numlosses=numpy.zeros(2, int))  # (kept, tot)
     lba = param['lba']
-    lba.alt = general.AccumDict(
-        accum=general.AccumDict(accum=numpy.zeros(L, F32)))
+    lba.alt = []
     lba.losses_by_E = numpy.zeros((E, L), F32)
     tempname = param['tempname']
-    eid2rlz = dict(events[['id', 'rlz_id']])
-    eid2idx = {eid: idx for idx, eid in enumerate(eids)}
     aggby = param['aggregate_by']
+    aggkeys = param['aggkeys']
 
     minimum_loss = []
     for lt, lti in crmodel.lti.items():
@@ -82,35 +114,67 @@ def calc_risk(gmfs, param, monitor):
         if lt in lba.policy_dict:  # same order as in lba.compute
             minimum_loss.append(val)
 
+    # the loss matrices of shape (A, E) are computed in chunks of events
+    # and lba.alt is converted into arrays when it becomes too big, so
+    # that the memory occupation stays below ebrisk_maxsize
+    maxsize = param['ebrisk_maxsize']
+    alt = general.AccumDict(accum=[])  # aggkey -> list of arrays
+    nkept = 0
     haz_by_sid = general.group_array(gmfs, 'sid')
+    assets_by_sid = []
     for sid, asset_df in assets_df.groupby('site_id'):
-        try:
+        if sid in haz_by_sid:  # else no hazard here
+            assets_by_sid.append((sid, asset_df.to_records()))  # fast
+            haz_by_sid[sid].sort(order='eid')
+    # if the loss ratios do not depend on the assets, the risk functions
+    # are called once per taxonomy on blocks of sites and not once per site
+    batched = tempname is None and crmodel.distributions <= {'LN'}
+    for block in general.block_splitter(
+            assets_by_sid, maxsize / (8 * L),
+            lambda pair: len(haz_by_sid[pair[0]]) * len(pair[1])):
+        if batched:
+            with mon_risk:
+                ratios = get_ratios_by_taxo(crmodel, block, haz_by_sid)
+        for sid, assets in block:
             haz = haz_by_sid[sid]
-        except KeyError:  # no hazard here
-            continue
-        with mon_risk:
-            assets = asset_df.to_records()  # fast
             acc['events_per_sid'] += len(haz)
-            if param['avg_losses']:
-                ws = weights[[eid2rlz[eid] for eid in haz['eid']]]
-            else:
-                ws = None
-            assets_by_taxo = get_assets_by_taxo(assets, tempname)  # fast
-            eidx = numpy.array([eid2idx[eid] for eid in haz['eid']])  # fast
-            out = get_output(crmodel, assets_by_taxo, haz)  # slow
-        with mon_agg:
+            if not batched:
+                with mon_risk:
+                    assets_by_taxo = get_assets_by_taxo(
+                        assets, tempname)  # fast
             tagidxs = assets[aggby] if aggby else None
-            acc['numlosses'] += lba.aggregate(
-                out, eidx, minimum_loss, tagidxs, ws)
+            chunksize = max(int(maxsize // (8 * L * len(assets))), 1)
+            for start in range(0, len(haz), chunksize):
+                slc = slice(start, start + chunksize)
+                hz = haz[slc]
+                with mon_risk:
+                    eidx = numpy.searchsorted(eids, hz['eid'])
+                    if param['avg_losses']:
+                        ws = weights[events['rlz_id'][eidx]]
+                    else:
+                        ws = None
+                    if batched:
+                        out = get_batched_output(
+                            crmodel, sid, assets, ratios, haz, slc)
+                    else:
+                        out = get_output(crmodel, assets_by_taxo, hz)  # slow
+                with mon_agg:
+                    numlosses = lba.aggregate(
+                        out, eidx, minimum_loss, tagidxs, ws)
+                    acc['numlosses'] += numlosses
+                    nkept += numlosses[0]
+                    if nkept * ALT_NBYTES > maxsize:
+                        flush_alt(lba, events, aggkeys, elt_dt, alt)
+                        nkept = 0
     if len(gmfs):
         acc['events_per_sid'] /= len(gmfs)
     acc['elt'] = numpy.fromiter(  # this is ultra-fast
         ((event['id'], event['rlz_id'], losses)
          for event, losses in zip(events, lba.losses_by_E) if losses.sum()),
         elt_dt)
-    acc['alt'] = {idx: numpy.fromiter(  # already sorted by aid, ultra-fast
-        ((eid, eid2rlz[eid], loss) for eid, loss in lba.alt[idx].items()),
-        elt_dt) for idx in lba.alt}
+    flush_alt(lba, events, aggkeys, elt_dt, alt)
+    acc['alt'] = {idx: numpy.concatenate(arrays)
+                  for idx, arrays in alt.items()}
     if param['avg_losses']:
         acc['losses_by_A'] = param['lba'].losses_by_A * param['ses_ratio']
         # without resetting the cache the sequential avg_losses would be wrong!
@@ -128,10 +192,14 @@ def ebrisk(rupgetter, srcfilter, param, monitor):
     """
     mon_rup = monitor('getting ruptures', measuremem=False)
     mon_haz = monitor('getting hazard', measuremem=False)
+    # the site collection is read only by the first task of the worker
+    with monitor('getting sitecol'):
+        vars(srcfilter)['sitecol'] = parallel.cached(
+            monitor.calc_id, 'sitecol', getattr, srcfilter, 'sitecol')
     gmfs = []
     gmf_info = []
     gg = getters.GmfGetter(rupgetter, srcfilter, param['oqparam'],
-                           param['amplifier'])
+                           param['amplifier'], param['rup_distances'])
     nbytes = 0
     for c in gg.gen_computers(mon_rup):
         with mon_haz:
@@ -143,11 +211,8 @@ def ebrisk(rupgetter, srcfilter, param, monitor):
                          data.nbytes, mon_haz.dt))
         if nbytes > param['ebrisk_maxsize']:
             msg = 'produced subtask'
-            try:
-                logs.dbcmd('log', monitor.calc_id, datetime.utcnow(), 'DEBUG',
-                           'ebrisk#%d' % monitor.task_no, msg)
-            except Exception:  # for `oq run`
-                print(msg)
+            logs.dblog(monitor.calc_id, 'DEBUG',
+                       'ebrisk#%d' % monitor.task_no, msg)
             yield calc_risk, numpy.concatenate(gmfs), param
             nbytes = 0
             gmfs = []
@@ -183,7 +248,8 @@ class EbriskCalculator(event_based.EventBasedCalculator):
         super().pre_execute()
         self.param['lba'] = lba = (
             LossesByAsset(self.assetcol, oq.loss_names,
-                          self.policy_name, self.policy_dict))
+                          self.policy_name, self.policy_dict,
+                          oq.aggregate_by))
         self.param['ses_ratio'] = oq.ses_ratio
         self.param['aggregate_by'] = oq.aggregate_by
         self.param['ebrisk_maxsize'] = oq.ebrisk_maxsize
@@ -201,10 +267,13 @@ class EbriskCalculator(event_based.EventBasedCalculator):
         self.param['minimum_asset_loss'] = mal
 
         elt_dt = [('event_id', U32), ('rlzi', U16), ('loss', (F32, (L,)))]
+        # the aggregation keys in the order of lba.get_aggkeys
+        self.param['aggkeys'] = aggkeys = []
         for idxs, attrs in gen_indices(self.assetcol.tagcol, oq.aggregate_by):
             idx = ','.join(map(str, idxs)) + ','
             self.datastore.create_dset('event_loss_table/' + idx, elt_dt,
                                        attrs=attrs)
+            aggkeys.append(idx)
         self.param.pop('oqparam', None)  # unneeded
         self.datastore.create_dset('avg_losses-stats', F32, (A, 1, L))  # mean
         elt_nbytes = 4 * self.E * L
@@ -237,6 +306,7 @@ class EbriskCalculator(event_based.EventBasedCalculator):
             tempname=cache_epsilons(
                 self.datastore, oq, self.assetcol, self.crmodel, self.E))
         srcfilter = self.src_filter(self.datastore.tempname)
+        self.init_rup_distances(save=False)
         logging.info(
             'Sending {:_d} ruptures'.format(len(self.datastore['ruptures'])))
         self.events_per_sid = []
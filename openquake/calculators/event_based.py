@@ -17,11 +17,12 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
 import os.path
+import zlib
 import logging
 import operator
 import numpy
 
-from openquake.baselib import hdf5, parallel
+from openquake.baselib import hdf5, parallel, general
 from openquake.baselib.general import AccumDict
 from openquake.hazardlib.probability_map import ProbabilityMap
 from openquake.hazardlib.stats import compute_pmap_stats
@@ -36,7 +37,7 @@ from openquake.commonlib import calc, util, logs, readinput, logictree
 from openquake.risklib.riskinput import str2rsi
 from openquake.calculators import base
 from openquake.calculators.getters import (
-    GmfGetter, gen_rupture_getters, sig_eps_dt, time_dt)
+    GmfGetter, gen_rupture_getters, sig_eps_dt, time_dt, rup_distances_dt)
 from openquake.calculators.classical import ClassicalCalculator
 from openquake.engine import engine
 
@@ -62,6 +63,63 @@ def get_mean_curves(dstore, imt):
         arr = dstore.sel('hcurves-rlzs', rlz_id=0, imt=imt)
     return arr[:, 0, 0, :]
 
+
+def sort_gmf_data(dstore, indices, N, maxrows=10_000_000):
+    """
+    Rewrite gmf_data/data ordered by site ID and event ID in a chunked
+    and compressed dataset, replacing the variable-length gmf_data/indices
+    with an array of shape (N, 2) containing a single start, stop pair per
+    site, so that the GMVs of a site (or of a range of sites) can be read
+    with a single slice. Since HDF5 does not reclaim the space of a
+    deleted dataset, the sorted copy is written in a temporary file and
+    copied back after removing the original, so that it can reuse the
+    freed space instead of growing the datastore.
+
+    :param dstore: a DataStore containing gmf_data/data
+    :param indices: a dictionary (sid, 0|1) -> list of starts|stops
+    :param N: the total number of sites
+    :param maxrows: maximum number of rows to keep in memory
+    :returns: the number of GMVs per site
+    """
+    data = dstore['gmf_data/data']
+    tmp = hdf5.File.temporary()
+    dset = hdf5.create(tmp, 'sorted', data.dtype, compression='gzip')
+    offsets = numpy.zeros((N, 2), U32)
+    num_evs = numpy.zeros(N, U32)
+    for sid in range(N):
+        if (sid, 0) in indices:
+            num_evs[sid] = (numpy.array(indices[sid, 1]) -
+                            numpy.array(indices[sid, 0])).sum()
+    offsets[:, 1] = numpy.cumsum(num_evs)
+    offsets[1:, 0] = offsets[:-1, 1]
+    # groups of consecutive sites with less than maxrows rows; since the
+    # gmfdata of each task are sorted by site, the rows of a group come
+    # from a few contiguous slices, one per task
+    for group in general.block_splitter(range(N), maxrows,
+                                        lambda sid: num_evs[sid]):
+        slices = []
+        for sid in group:
+            if (sid, 0) in indices:
+                slices.extend(zip(indices[sid, 0], indices[sid, 1]))
+        slices.sort()
+        merged = []
+        for start, stop in slices:
+            if merged and merged[-1][1] == start:  # contiguous
+                merged[-1][1] = stop
+            else:
+                merged.append([start, stop])
+        if merged:
+            arr = numpy.concatenate([data[a:b] for a, b in merged])
+            hdf5.extend(dset, arr[numpy.lexsort((arr['eid'], arr['sid']))])
+    del data  # close the dataset, otherwise its space is not freed
+    del dstore['gmf_data/data']
+    dstore.hdf5.copy(dset, dstore['gmf_data'], 'data')
+    tmp.close()
+    os.remove(tmp.path)
+    del dstore['gmf_data/indices']
+    dstore['gmf_data/indices'] = offsets
+    return num_evs
+
 # ########################################################################## #
 
 
@@ -70,8 +128,13 @@ def compute_gmfs(rupgetter, srcfilter, param, monitor):
     Compute GMFs and optionally hazard curves
     """
     oq = param['oqparam']
-    getter = GmfGetter(rupgetter, srcfilter, oq, param['amplifier'])
-    return getter.compute_gmfs_curves(param.get('rlz_by_event'), monitor)
+    getter = GmfGetter(rupgetter, srcfilter, oq, param['amplifier'],
+                       param.get('rup_distances'))
+    res = getter.compute_gmfs_curves(param.get('rlz_by_event'), monitor)
+    if param.get('distance_params'):
+        res['rup_distances'] = getter.get_rup_distances(
+            param['distance_params'])
+    return res
 
 
 @base.calculators.add('event_based', 'scenario', 'ucerf_hazard')
@@ -187,6 +250,9 @@ class EventBasedCalculator(base.HazardCalculator):
         if self.offset >= TWO32:
             raise RuntimeError(
                 'The gmf_data table has more than %d rows' % TWO32)
+        if 'rup_distances' in result:
+            with sav_mon:
+                self.save_rup_distances(*result.pop('rup_distances'))
         imtls = self.oqparam.imtls
         with agg_mon:
             for key, poes in result.get('hcurves', {}).items():
@@ -196,6 +262,57 @@ class EventBasedCalculator(base.HazardCalculator):
         self.datastore.flush()
         return acc
 
+    def init_rup_distances(self, save=True):
+        """
+        Reuse the rupture-site distances of the parent calculation, if
+        they were computed with the same sites and maximum_distance;
+        otherwise, if `save` is true, prepare the rup_distances datasets
+        where they will be stored by rupture ID (unless save_disk_space
+        is set).
+        """
+        oq = self.oqparam
+        sitecol = self.sitecol.complete
+        attrs = dict(filter_distance=oq.filter_distance,
+                     maximum_distance=repr(oq.maximum_distance),
+                     sites_checksum=zlib.adler32(numpy.array(
+                         [sitecol.lons, sitecol.lats, sitecol.depths])))
+        self.param['rup_distances'] = None
+        self.param['distance_params'] = ()
+        parent = self.datastore.parent
+        if parent and 'rup_distances' in parent.hdf5:
+            dic = parent.get_attrs('rup_distances/data')
+            if all(dic.get(k) == v for k, v in attrs.items()):
+                logging.info('Reusing the rupture distances of calculation '
+                             '#%d', parent.calc_id)
+                self.param['rup_distances'] = parent.filename
+                return
+        if not save or oq.save_disk_space:
+            return
+        params = {oq.filter_distance}
+        for rlzs_by_gsim in self.datastore['full_lt'].get_rlzs_by_gsim_grp(
+                ).values():
+            for gsim in rlzs_by_gsim:
+                params.update(gsim.REQUIRES_DISTANCES)
+        self.param['distance_params'] = params = sorted(params)
+        nrups = len(self.datastore['ruptures'])
+        self.datastore.create_dset('rup_distances/data',
+                                   rup_distances_dt(params))
+        self.datastore.create_dset('rup_distances/indices', U32, (nrups, 2))
+        self.datastore.set_attrs('rup_distances/data', **attrs)
+
+    def save_rup_distances(self, ids, lens, data):
+        """
+        Store the distances of the given ruptures in CSR format, i.e.
+        in rup_distances/data, with rup_distances/indices containing the
+        (start, stop) slices for each rupture ID
+        """
+        if len(ids) == 0:
+            return
+        dset = self.datastore['rup_distances/data']
+        stops = hdf5.extend(dset, data) - len(data) + numpy.cumsum(lens)
+        self.datastore['rup_distances/indices'][ids] = numpy.array(
+            [stops - lens, stops]).T
+
     def set_param(self, **kw):
         oq = self.oqparam
         # set the minimum_intensity
@@ -295,6 +412,8 @@ class EventBasedCalculator(base.HazardCalculator):
                                        time_dt, (nrups,), fillvalue=None)
         if oq.hazard_curves_from_gmfs:
             self.param['rlz_by_event'] = self.datastore['events']['rlz_id']
+        if hasattr(oq, 'maximum_distance'):
+            self.init_rup_distances()
 
         # compute_gmfs in parallel
         nr = len(self.datastore['ruptures'])
@@ -309,7 +428,18 @@ class EventBasedCalculator(base.HazardCalculator):
             num_cores=oq.num_cores
         ).reduce(self.agg_dicts, self.acc0())
 
-        if self.indices:
+        if self.indices and oq.sort_gmf_data:
+            # datasets cannot be safely removed in SWMR mode, so reopen
+            self.datastore.close()
+            self.datastore.open('r+')
+            num_evs = self.datastore['gmf_data/events_by_sid']
+            logging.info('Sorting gmf_data by site')
+            with self.monitor('sorting gmf_data', measuremem=True):
+                self.datastore['gmf_data/imts'] = ' '.join(oq.imtls)
+                num_evs[:] = sort_gmf_data(self.datastore, self.indices, N)
+            avg_events_by_sid = num_evs[()].sum() / N
+            logging.info('Found ~%d GMVs per site', avg_events_by_sid)
+        elif self.indices:
             dset = self.datastore['gmf_data/indices']
             num_evs = self.datastore['gmf_data/events_by_sid']
             logging.info('Saving gmf_data/indices')
@@ -32,6 +32,7 @@ from openquake.commonlib.calc import _gmvs_to_haz_curve
 U16 = numpy.uint16
 U32 = numpy.uint32
 F32 = numpy.float32
+F64 = numpy.float64
 by_taxonomy = operator.attrgetter('taxonomy')
 code2cls = BaseRupture.init()
 
@@ -56,6 +57,29 @@ def build_stat_curve(poes, imtls, stat, weights):
     return probability_map.ProbabilityCurve(array)
 
 
+def build_stat_curves(poes, imtls, statfuncs, weights):
+    """
+    Vectorized version of build_stat_curve working on blocks of sites
+
+    :param poes: an array of shape (N, R, L)
+    :param imtls: a DictArray with L levels
+    :param statfuncs: a sequence of S statistic functions
+    :param weights: R weights or R ImtWeights
+    :returns: an array of shape (N, S, L)
+    """
+    if not isinstance(weights, list):  # no IMT-dependent weights
+        return stats.compute_stats2(poes, statfuncs, weights)
+    out = numpy.zeros((len(poes), len(statfuncs), len(imtls.array)))
+    for imt in imtls:
+        slc = imtls(imt)
+        ws = [w[imt] for w in weights]
+        if sum(ws) == 0:  # expect no data for this IMT
+            continue
+        out[:, :, slc] = stats.compute_stats2(
+            poes[:, :, slc], statfuncs, ws)
+    return out
+
+
 def sig_eps_dt(imts):
     """
     :returns: a composite data type for the sig_eps output
@@ -109,12 +133,10 @@ class PmapGetter(object):
     def R(self):
         return len(self.weights)
 
-    def init(self):
+    def init_attrs(self):
         """
-        Read the poes and set the .data attribute with the hazard curves
+        Open the datastore and set the attributes imtls, poes, rlzs_by_grp
         """
-        if hasattr(self, '_pmap_by_grp'):  # already initialized
-            return self._pmap_by_grp
         if isinstance(self.dstore, str):
             self.dstore = hdf5.File(self.dstore, 'r')
         else:
@@ -126,6 +148,14 @@ class PmapGetter(object):
         self.poes = self.poes or oq.poes
         self.rlzs_by_grp = self.dstore['full_lt'].get_rlzs_by_grp()
 
+    def init(self):
+        """
+        Read the poes and set the .data attribute with the hazard curves
+        """
+        if hasattr(self, '_pmap_by_grp'):  # already initialized
+            return self._pmap_by_grp
+        self.init_attrs()
+
         # populate _pmap_by_grp
         self._pmap_by_grp = {}
         if 'poes' in self.dstore:
@@ -187,6 +217,37 @@ class PmapGetter(object):
                     pcurves[rlzi] |= c
         return pcurves
 
+    def get_pcurves_block(self, sids):
+        """
+        Read the PoEs of a block of sites from contiguous slices of the
+        poes/grp-XX datasets and combine them by realization.
+
+        :param sids: an ordered array of site IDs
+        :returns: an array of PoEs of shape (N, R, L) with N=len(sids)
+        """
+        res = numpy.zeros((len(sids), self.num_rlzs, self.L))
+        if 'poes' not in self.dstore or len(sids) == 0:
+            return res
+        if not hasattr(self, '_sids_by_grp'):
+            self._sids_by_grp = {grp: dset['sids'][()] for grp, dset in
+                                 self.dstore['poes'].items()}
+        for grp, allsids in self._sids_by_grp.items():
+            start, stop = numpy.searchsorted(allsids, [sids[0], sids[-1] + 1])
+            if start == stop:  # no hazard for the block
+                continue
+            idx = numpy.searchsorted(sids, allsids[start:stop])
+            ok = sids[numpy.minimum(idx, len(sids) - 1)] == allsids[start:stop]
+            poes = self.dstore['poes/%s/array' % grp][start:stop][ok]
+            idx = idx[ok, None]
+            # rlzs and gsim indices have the same length
+            rlzs, gidxs = [], []
+            for gidx, rlzis in enumerate(self.rlzs_by_grp[grp]):
+                rlzs.extend(rlzis)
+                gidxs.extend([gidx] * len(rlzis))
+            res[idx, rlzs] = 1. - (1. - res[idx, rlzs]) * (
+                1. - poes[:, :, gidxs].transpose(0, 2, 1))
+        return res
+
     def get_hcurves(self, pmap_by_grp):
         """
         :param pmap_by_grp: a dictionary of ProbabilityMaps by group
@@ -321,7 +382,8 @@ class GmfGetter(object):
     An hazard getter with methods .get_gmfdata and .get_hazard returning
     ground motion values.
     """
-    def __init__(self, rupgetter, srcfilter, oqparam, amplifier=None):
+    def __init__(self, rupgetter, srcfilter, oqparam, amplifier=None,
+                 rup_distances=None):
         self.rlzs_by_gsim = rupgetter.rlzs_by_gsim
         self.rupgetter = rupgetter
         self.srcfilter = srcfilter
@@ -342,6 +404,8 @@ class GmfGetter(object):
         self.cmaker = ContextMaker(
             rupgetter.trt, rupgetter.rlzs_by_gsim, param)
         self.correl_model = oqparam.correl_model
+        self.rup_distances = rup_distances  # path to the stored distances
+        self.dcache = None  # rup_id -> (sids, distances), set lazily
 
     def gen_computers(self, mon):
         """
@@ -350,6 +414,9 @@ class GmfGetter(object):
         trt, samples = self.rupgetter.trt, self.rupgetter.samples
         with mon:
             proxies = self.rupgetter.get_proxies()
+            if self.dcache is None:
+                self.dcache = read_rup_distances(
+                    self.rup_distances, proxies) if self.rup_distances else {}
         for proxy in proxies:
             with mon:
                 ebr = proxy.to_ebr(trt, samples)
@@ -359,7 +426,7 @@ class GmfGetter(object):
                     computer = calc.gmf.GmfComputer(
                         ebr, sitecol, self.oqparam.imtls, self.cmaker,
                         self.oqparam.truncation_level, self.correl_model,
-                        self.amplifier)
+                        self.amplifier, self.dcache)
                     computer.offset = self.rupgetter.offset
                 except FarAwayRupture:
                     continue
@@ -396,6 +463,31 @@ class GmfGetter(object):
             return []
         return numpy.concatenate(alldata)
 
+    def get_rup_distances(self, params):
+        """
+        :param params: the distance parameters to store
+        :returns: rupture IDs, number of affected sites per rupture and
+                  an array of dtype rup_distances_dt
+        """
+        dt = rup_distances_dt(params)
+        ids, lens, arrays = [], [], []
+        for proxy in sorted(self.rupgetter.proxies, key=lambda p: p['id']):
+            try:
+                sids, dists = self.dcache[proxy['serial']]
+            except (TypeError, KeyError):  # no cache or far away rupture
+                continue
+            arr = numpy.zeros(len(sids), dt)
+            arr['sid'] = sids
+            for param in params:
+                arr[param] = dists.get(param, numpy.nan)
+            ids.append(proxy['id'])
+            lens.append(len(arr))
+            arrays.append(arr)
+        if not arrays:
+            return numpy.zeros(0, U32), numpy.zeros(0, U32), numpy.zeros(0, dt)
+        return (numpy.array(ids, U32), numpy.array(lens, U32),
+                numpy.concatenate(arrays))
+
     def get_hazard_by_sid(self, data=None):
         """
         :param data: if given, an iterator of records of dtype gmf_dt
@@ -463,6 +555,44 @@ def group_by_rlz(data, rlzs):
     return {rlzi: numpy.array(recs) for rlzi, recs in acc.items()}
 
 
+def rup_distances_dt(params):
+    """
+    :param params: a list of distance parameters
+    :returns: the dtype of the records stored in rup_distances/data
+    """
+    return numpy.dtype([('sid', U32)] + [(param, F32) for param in params])
+
+
+def read_rup_distances(fname, proxies):
+    """
+    :param fname: path to a datastore with a group rup_distances
+    :param proxies: a list of RuptureProxies
+    :returns: a dictionary serial -> (sids, distances)
+
+    The stored distances are in single precision and are converted back
+    to double precision; distances containing NaNs (i.e. not required by
+    the GSIMs of the original calculation) are skipped and recomputed.
+    """
+    dcache = {}
+    if not proxies:
+        return dcache
+    with hdf5.File(fname, 'r') as f:
+        dset = f['rup_distances/data']
+        params = dset.dtype.names[1:]
+        ids = numpy.unique([proxy['id'] for proxy in proxies])
+        start_stop = dict(zip(ids, f['rup_distances/indices'][ids]))
+        for proxy in proxies:
+            start, stop = start_stop[proxy['id']]
+            arr = dset[start:stop]
+            dists = {}
+            for param in params:
+                dist = F64(arr[param])
+                if not numpy.isnan(dist).any():
+                    dists[param] = dist
+            dcache[proxy['serial']] = arr['sid'], dists
+    return dcache
+
+
 def gen_rgetters(dstore, slc=slice(None)):
     """
     :yields: unfiltered RuptureGetters
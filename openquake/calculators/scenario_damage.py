@@ -21,6 +21,7 @@ import numpy
 from openquake.baselib import hdf5
 from openquake.baselib.general import AccumDict, get_indices
 from openquake.hazardlib.stats import set_rlzs_stats
+from openquake.risklib.scientific import uniform_by_event
 from openquake.calculators import base
 
 U16 = numpy.uint16
@@ -37,21 +38,36 @@ def floats_in(numbers):
     return (U32(numbers) != numbers).sum()
 
 
-def bin_ddd(fractions, n, seed):
+def bin_ddd(fractions, n, seed, aid, eids):
     """
     Converting fractions into discrete damage distributions using bincount
-    and numpy.random.choice
+    and uniform numbers keyed by (seed, aid) and indexed by event ID, so
+    that the distribution of an event does not depend on the other events
+    in the block.
     """
     n = int(n)
     D = fractions.shape[1]  # shape (E, D)
     ddd = numpy.zeros(fractions.shape, U32)
-    numpy.random.seed(seed)
+    uniform = uniform_by_event(seed, aid, eids, n)  # shape (E, n)
     for e, frac in enumerate(fractions):
+        # same algorithm as numpy.random.choice
+        cdf = numpy.array(frac / frac.sum(), F64).cumsum()
+        cdf /= cdf[-1]
         ddd[e] = numpy.bincount(
-            numpy.random.choice(D, n, p=frac/frac.sum()), minlength=D)
+            cdf.searchsorted(uniform[e], side='right'), minlength=D)
     return ddd
 
 
+def _sum_by_event(eids, arrays):
+    # sum the arrays with the same event ID, by preserving the dtype;
+    # returns the unique event IDs and the sums
+    order = numpy.argsort(eids, kind='stable')
+    eids = eids[order]
+    start = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(eids)) + 1])
+    return eids[start], numpy.add.reduceat(
+        arrays[order], start, axis=0, dtype=arrays.dtype)
+
+
 def scenario_damage(riskinputs, crmodel, param, monitor):
     """
     Core function for a damage computation.
@@ -65,11 +81,15 @@ def scenario_damage(riskinputs, crmodel, param, monitor):
     :param param:
         dictionary of extra parameters
     :returns:
-        a dictionary {'d_asset': [(l, r, a, mean-stddev), ...],
-                      'd_event': dict eid -> array of shape (L, D)
+        a dictionary {'d_asset': [(l, r, aids, tots), ...],
+                      'eids': array of E' event IDs affecting the assets,
+                      'd_event': array of shape (E', L, D - 1)
                       + optional consequences}
 
     `d_asset` and `d_tag` are related to the damage distributions.
+    The computation is vectorized on the assets and the events of each
+    riskinput: the damage distributions are arrays of shape (A, E, D) and
+    the `aed` array is built directly from them.
     """
     L = len(crmodel.loss_types)
     D = len(crmodel.damage_states)
@@ -78,57 +98,81 @@ def scenario_damage(riskinputs, crmodel, param, monitor):
     rsk_mon = monitor('aggregating risk', measuremem=False)
     # algorithm used to compute the discrete damage distributions
     approx_ddd = param['approx_ddd']
-    z = numpy.zeros((L, D - 1), F32 if approx_ddd else U32)
-    d_event = AccumDict(accum=z)
-    res = {'d_event': d_event}
-    for name in consequences:
-        res[name + '_by_event'] = AccumDict(accum=numpy.zeros(L, F64))
-        # using F64 here is necessary: with F32 the non-commutativity
-        # of addition would hurt too much with multiple tasks
     seed = param['master_seed']
     num_events = param['num_events']  # per realization
+    dt = F32 if approx_ddd else U32
+    # event IDs and damages/consequences by event of each output
+    ev_eids, ev_dmg, ev_csq = [], [], AccumDict(accum=[])
     for ri in riskinputs:
-        # otherwise test 4b will randomly break with last digit changes
-        # in dmg_by_event :-(
         result = dict(d_asset=[])
         for name in consequences:
             result['avg_' + name] = []
-        ddic = AccumDict(accum=numpy.zeros((L, D - 1), F32))  # aid,eid->dd
+        aids = ri.assets['ordinal']
+        numbers = ri.assets['number']
+        aeds = []
         with haz_mon:
             ri.hazard_getter.init()
         for out in ri.gen_outputs(crmodel, monitor):
             with rsk_mon:
                 r = out.rlzi
                 ne = num_events[r]  # total number of events
+                eids = out.eids
+                dd = numpy.zeros((len(aids), len(eids), L, D - 1), F32)
+                dmg = numpy.zeros((len(eids), L, D - 1), dt)
+                # using F64 here is necessary: with F32 the non-commutativity
+                # of addition would hurt too much with multiple tasks
+                csqs = {name: numpy.zeros((len(eids), L), F64)
+                        for name in consequences}
                 for l, loss_type in enumerate(crmodel.loss_types):
-                    for asset, fractions in zip(ri.assets, out[loss_type]):
-                        aid = asset['ordinal']
-                        if approx_ddd:
-                            ddds = fractions * asset['number']
-                        else:
-                            ddds = bin_ddd(
-                                fractions, asset['number'], seed + aid)
-                        for e, ddd in enumerate(ddds):
-                            eid = out.eids[e]
-                            ddic[aid, eid][l] = ddd[1:]
-                            d_event[eid][l] += ddd[1:]
-                        tot = ddds.sum(axis=0)  # shape D
-                        nodamage = asset['number'] * (ne - len(ddds))
-                        tot[0] += nodamage
-                        result['d_asset'].append((l, r, aid, tot))
-                        # TODO: use the ddd, not the fractions in compute_csq
-                        csq = crmodel.compute_csq(asset, fractions, loss_type)
-                        for name, values in csq.items():
-                            result['avg_%s' % name].append(
-                                (l, r, asset['ordinal'], values.sum(axis=0)))
-                            by_event = res[name + '_by_event']
-                            for eid, value in zip(out.eids, values):
-                                by_event[eid][l] += value
+                    fractions = out[loss_type]  # shape (A, E, D)
+                    if approx_ddd:
+                        # multiplying with the precision of the fractions
+                        ddds = fractions * numbers.astype(
+                            fractions.dtype)[:, None, None]
+                    else:
+                        ddds = numpy.array([
+                            bin_ddd(fracs, n, seed, aid, eids)
+                            for fracs, n, aid in zip(fractions, numbers, aids)
+                        ])
+                    dd[:, :, l] = ddds[:, :, 1:]
+                    dmg[:, l] = ddds[:, :, 1:].sum(axis=0)
+                    tot = ddds.sum(axis=1)  # shape (A, D)
+                    # NB: not using += since tot can be an integer array
+                    tot[:, 0] = tot[:, 0] + numbers * (ne - len(eids))
+                    result['d_asset'].append((l, r, aids, tot))
+                    # TODO: use the ddd, not the fractions in compute_csq
+                    csq = crmodel.compute_csq(ri.assets, fractions, loss_type)
+                    for name, values in csq.items():  # shape (A, E)
+                        result['avg_' + name].append(
+                            (l, r, aids, values.sum(axis=1)))
+                        csqs[name][:, l] = values.sum(axis=0)
+                aed = numpy.zeros(dd.shape[0] * dd.shape[1], param['aed_dt'])
+                aed['aid'] = numpy.repeat(aids, len(eids))
+                aed['eid'] = numpy.tile(eids, len(aids))
+                aed['dd'] = dd.reshape(-1, L, D - 1)
+                aeds.append(aed)
+                ev_eids.append(eids)
+                ev_dmg.append(dmg)
+                for name in consequences:
+                    ev_csq[name].append(csqs[name])
         with rsk_mon:
-            result['aed'] = aed = numpy.zeros(len(ddic), param['aed_dt'])
-            for i, ((aid, eid), dd) in enumerate(sorted(ddic.items())):
-                aed[i] = (aid, eid, dd)
+            if aeds:
+                aed = numpy.concatenate(aeds)
+                aed = aed[numpy.lexsort((aed['eid'], aed['aid']))]
+            else:
+                aed = numpy.zeros(0, param['aed_dt'])
+            result['aed'] = aed
         yield result
+    # return only the events affecting the assets of the task
+    if not ev_eids:
+        return
+    eids = numpy.concatenate(ev_eids)
+    res = {}
+    res['eids'], res['d_event'] = _sum_by_event(
+        eids, numpy.concatenate(ev_dmg))
+    for name in consequences:
+        res[name + '_by_event'] = _sum_by_event(
+            eids, numpy.concatenate(ev_csq[name]))[1]
     yield res
 
 
@@ -165,8 +209,25 @@ class ScenarioDamageCalculator(base.RiskCalculator):
         self.datastore.create_dset('dd_data/indices', U32, (A, 2))
         self.riskinputs = self.build_riskinputs('gmf')
         self.start = 0
+        # damages and consequences by event, populated in combine
+        E = self.param['num_events'].sum()
+        L = len(self.crmodel.loss_types)
+        D = len(self.crmodel.damage_states)
+        self.d_event = numpy.zeros(
+            (E, L, D - 1), F32 if self.param['approx_ddd'] else U32)
+        self.by_event = {name: numpy.zeros((E, L), F64)
+                         for name in self.crmodel.get_consequences()}
+        # events affecting at least an asset, used in the *_by_event outputs
+        self.seen = numpy.zeros(E, bool)
 
     def combine(self, acc, res):
+        if 'eids' in res:  # damages and consequences by event of a task
+            eids = res.pop('eids')
+            self.seen[eids] = True
+            self.d_event[eids] += res.pop('d_event')
+            for name, arr in self.by_event.items():
+                arr[eids] += res.pop(name + '_by_event')
+            return acc
         aed = res.pop('aed', ())
         if len(aed) == 0:
             return acc + res
@@ -207,8 +268,8 @@ class ScenarioDamageCalculator(base.RiskCalculator):
 
         # damage by asset
         d_asset = numpy.zeros((A, R, L, D), F32)
-        for (l, r, a, tot) in result['d_asset']:
-            d_asset[a, r, l] = tot
+        for (l, r, aids, tots) in result['d_asset']:
+            d_asset[aids, r, l] = tots
         self.datastore['avg_damages-rlzs'] = d_asset * avg_ratio
         set_rlzs_stats(self.datastore,
                        'avg_damages',
@@ -221,32 +282,30 @@ class ScenarioDamageCalculator(base.RiskCalculator):
         tot = self.assetcol['number'].sum()
         dt = F32 if self.param['approx_ddd'] else U32
         dbe = numpy.zeros((self.E, L, D), dt)  # shape E, L, D
-        dbe[:, :, 0] = tot
-        for e, dmg_by_lt in result['d_event'].items():
-            for l, dmg in enumerate(dmg_by_lt):
-                dbe[e, l,  0] = tot - dmg.sum()
-                dbe[e, l,  1:] = dmg
+        dbe[:, :, 0] = tot - self.d_event.sum(axis=2)
+        dbe[:, :, 1:] = self.d_event
         self.datastore['dmg_by_event'] = dbe
 
         # consequence distributions
         del result['d_asset']
-        del result['d_event']
         dtlist = [('event_id', U32), ('rlz_id', U16), ('loss', (F32, (L,)))]
         rlz = self.datastore['events']['rlz_id']
-        for name, csq in result.items():
+        for name in result:
             if name.startswith('avg_'):
                 c_asset = numpy.zeros((A, R, L), F32)
-                for (l, r, a, stat) in result[name]:
-                    c_asset[a, r, l] = stat
+                for (l, r, aids, stats) in result[name]:
+                    c_asset[aids, r, l] = stats
                 self.datastore[name + '-rlzs'] = c_asset * avg_ratio
                 set_rlzs_stats(self.datastore, name,
                                asset_id=self.assetcol['id'],
                                loss_type=oq.loss_names)
-            elif name.endswith('_by_event'):
-                arr = numpy.zeros(len(csq), dtlist)
-                for i, (eid, loss) in enumerate(csq.items()):
-                    arr[i] = (eid, rlz[eid], loss)
-                self.datastore[name] = arr
+        eids, = self.seen.nonzero()
+        for name, csq in self.by_event.items():
+            arr = numpy.zeros(len(eids), dtlist)
+            arr['event_id'] = eids
+            arr['rlz_id'] = rlz[eids]
+            arr['loss'] = csq[eids]
+            self.datastore[name + '_by_event'] = arr
 
     def sanity_check(self):
         """
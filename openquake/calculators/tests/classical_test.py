@@ -22,6 +22,7 @@ import unittest.mock as mock
 import numpy
 from openquake.baselib import parallel, general
 from openquake.hazardlib import lt
+from openquake.commonlib import calc
 from openquake.calculators.views import view
 from openquake.calculators.export import export
 from openquake.calculators.extract import extract
@@ -108,6 +109,12 @@ class ClassicalTestCase(CalculatorTestCase):
             self.run_calc(case_1.__file__, 'job.ini', minimum_magnitude='4.5')
         self.assertEqual(str(ctx.exception), 'All sources were discarded!?')
 
+    def test_preclassical(self):
+        # the preclassical tasks return 0 in place of the pmaps
+        self.run_calc(case_1.__file__, 'job.ini',
+                      calculation_mode='preclassical')
+        self.assertEqual(len(self.calc.datastore['source_info']), 1)
+
     def test_wrong_smlt(self):
         with self.assertRaises(lt.LogicTreeError):
             self.run_calc(case_1.__file__, 'job_wrong.ini')
@@ -250,6 +257,18 @@ class ClassicalTestCase(CalculatorTestCase):
         # test disagg_by_src in a complex case with duplicated sources
         check_disagg_by_src(self.calc.datastore)
 
+    def test_case_13_tiled(self):
+        # with tiling the sources are computed once per tile, but the
+        # poes by source and the effective ruptures must not change
+        self.run_calc(case_13.__file__, 'job.ini')
+        dbs = self.calc.datastore['disagg_by_src'][()]
+        effrups = self.calc.datastore['source_info']['eff_ruptures']
+        self.run_calc(case_13.__file__, 'job.ini', max_sites_per_tile='10')
+        aac(self.calc.datastore['disagg_by_src'][()], dbs, atol=1E-6)
+        tiled = self.calc.datastore['source_info']['eff_ruptures']
+        self.assertTrue((tiled <= effrups).all())
+        check_disagg_by_src(self.calc.datastore)
+
     def test_case_14(self):
         # test classical with 2 gsims and 1 sample
         self.assert_curves_ok(['hazard_curve-rlz-000_PGA.csv'],
@@ -338,6 +357,18 @@ hazard_uhs-std.csv
         [fname] = export(('realizations', 'csv'), self.calc.datastore)
         self.assertEqualFiles('expected/realizations.csv', fname)
 
+        # check the hazard maps of each realization, which are computed
+        # from the curves of the same realization
+        oq = self.calc.oqparam
+        hcurves = self.calc.datastore['hcurves-rlzs'][()]  # (N, R, M, L1)
+        hmaps = self.calc.datastore['hmaps-rlzs'][()]  # (N, R, M, P)
+        self.assertEqual(hmaps.shape[1], 3)  # 3 realizations
+        for m, imt in enumerate(oq.imtls):
+            for r in range(3):
+                aac(hmaps[:, r, m], calc.compute_hazard_maps(
+                    hcurves[:, r, m], oq.imtls[imt], oq.poes), rtol=1E-5)
+        self.assertFalse(numpy.allclose(hmaps[:, 0], hmaps[:, 2]))
+
         if os.environ.get('TRAVIS'):
             raise unittest.SkipTest('Randomly broken on Travis')
 
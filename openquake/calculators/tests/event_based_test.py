@@ -125,6 +125,17 @@ class EventBasedTestCase(CalculatorTestCase):
         self.assertEqualFiles('expected/gmf-data.csv', fname)
         self.assertEqualFiles('expected/sig-eps.csv', sig_eps)
 
+        # sorting the GMFs by site does not change the exported GMFs
+        out = self.run_calc(blocksize.__file__, 'job.ini',
+                            concurrent_tasks='4', exports='csv',
+                            sort_gmf_data='true')
+        [fname, _, _] = out['gmf_data', 'csv']
+        self.assertEqualFiles('expected/gmf-data.csv', fname)
+        sids = self.calc.datastore['gmf_data/data']['sid']
+        self.assertTrue((sids[1:] >= sids[:-1]).all())
+        self.assertEqual(self.calc.datastore['gmf_data/indices'].shape,
+                         (len(self.calc.sitecol.complete), 2))
+
     def test_case_1(self):
         out = self.run_calc(case_1.__file__, 'job.ini', exports='csv,xml')
 
@@ -29,6 +29,7 @@ from openquake.calculators.tests import CalculatorTestCase, strip_calc_id
 from openquake.calculators.extract import extract
 from openquake.calculators.export import export
 from openquake.calculators.views import view
+from openquake.calculators.scenario_damage import bin_ddd
 
 aac = numpy.testing.assert_allclose
 
@@ -188,3 +189,17 @@ RM       4_000
         fnames = export(('avg_damages-rlzs', 'csv'), self.calc.datastore)
         for i, fname in enumerate(fnames):
             self.assertEqualFiles('expected/avg_damages-%d.csv' % i, fname)
+
+    def test_bin_ddd(self):
+        # the damage distribution of an event does not depend on the
+        # partition of the events
+        fractions = numpy.array([[.5, .3, .2], [.1, .1, .8], [.3, .4, .3],
+                                 [.9, .1, 0], [.2, .2, .6]])
+        eids = numpy.array([1, 4, 5, 9, 12])
+        ddd = bin_ddd(fractions, 100, 42, 7, eids)
+        numpy.testing.assert_equal(ddd.sum(axis=1), 100)
+        for slc in (slice(0, 1), slice(1, 4), slice(4, 5)):
+            numpy.testing.assert_equal(
+                bin_ddd(fractions[slc], 100, 42, 7, eids[slc]), ddd[slc])
+        # another asset has different numbers
+        self.assertFalse((bin_ddd(fractions, 100, 42, 8, eids) == ddd).all())
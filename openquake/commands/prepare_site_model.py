@@ -107,8 +107,8 @@ def prepare_site_model(exposure_xml, sites_csv, vs30_csv,
         fields.append('vs30measured')
     with performance.Monitor(measuremem=True) as mon:
         if exposure_xml:
-            mesh, assets_by_site = Exposure.read(
-                exposure_xml, check_dupl=False).get_mesh_assets_by_site()
+            mesh, assets = Exposure.read(
+                exposure_xml, check_dupl=False).get_mesh_assets()
             hdf5['assetcol'] = assetcol = site.SiteCollection.from_points(
                 mesh.lons, mesh.lats, req_site_params=req_site_params)
             if grid_spacing:
@@ -118,9 +118,9 @@ def prepare_site_model(exposure_xml, sites_csv, vs30_csv,
                     grid.lons, grid.lats, req_site_params=req_site_params)
                 logging.info(
                     'Associating exposure grid with %d locations to %d '
-                    'exposure sites', len(haz_sitecol), len(assets_by_site))
-                haz_sitecol, assets_by, discarded = assoc(
-                    assets_by_site, haz_sitecol,
+                    'exposure sites', len(haz_sitecol), len(mesh))
+                haz_sitecol, assets, discarded = assoc(
+                    assets, haz_sitecol,
                     grid_spacing * SQRT2, 'filter')
                 if len(discarded):
                     logging.info('Discarded %d sites with assets '
@@ -19,8 +19,13 @@
 Set up some system-wide loggers
 """
 import os.path
+import time
 import socket
+import sqlite3
 import logging
+import functools
+import threading
+import multiprocessing.util
 from datetime import datetime
 from contextlib import contextmanager
 from openquake.baselib import zeromq, config, parallel, datastore
@@ -32,25 +37,140 @@ LEVELS = {'debug': logging.DEBUG,
           'critical': logging.CRITICAL}
 
 DBSERVER_PORT = int(os.environ.get('OQ_DBSERVER_PORT') or config.dbserver.port)
+FLUSH_INTERVAL = 1  # seconds between two flushes of the log buffer
+FLUSH_SIZE = 1000  # flush the log buffer when it has more records than this
+
+_local = threading.local()
+
+
+@functools.lru_cache()
+def _dbserver_url():
+    # resolve the hostname only once per process
+    host = socket.gethostbyname(config.dbserver.host)
+    return 'tcp://%s:%s' % (host, DBSERVER_PORT)
+
+
+def _send(cmd):
+    # send a command on a REQ socket kept open for the current thread and
+    # process; on errors the socket is discarded, since a REQ socket which
+    # did not get a reply cannot be used anymore
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:  # first time or after a fork
+        _local.sock = None
+        _local.pid = pid
+    if _local.sock is None:
+        _local.sock = zeromq.Socket(
+            _dbserver_url(), zeromq.zmq.REQ, 'connect').__enter__()
+    try:
+        return _local.sock.send(cmd)
+    except BaseException:
+        _local.sock.__exit__(None, None, None)
+        _local.sock = None
+        raise
 
 
 def dbcmd(action, *args):
     """
-    A dispatcher to the database server.
+    A dispatcher to the database server. The pending log records are sent
+    before the command, so that the order of the operations is preserved.
 
     :param string action: database action to perform
     :param tuple args: arguments
     """
-    host = socket.gethostbyname(config.dbserver.host)
-    sock = zeromq.Socket(
-        'tcp://%s:%s' % (host, DBSERVER_PORT), zeromq.zmq.REQ, 'connect')
-    with sock:
-        res = sock.send((action,) + args)
-        if isinstance(res, parallel.Result):
-            return res.get()
+    if action != 'log_many':
+        log_buffer.flush()
+    res = _send((action,) + args)
+    if isinstance(res, parallel.Result):
+        return res.get()
     return res
 
 
+class LogBuffer(object):
+    """
+    Collect log records and send them to the DbServer in bulk, with a
+    single 'log_many' command. The buffer is flushed when it contains
+    more than `maxsize` records, every `interval` seconds by a background
+    thread, before any other database command and at process exit.
+    """
+    def __init__(self, interval=FLUSH_INTERVAL, maxsize=FLUSH_SIZE):
+        self.interval = interval
+        self.maxsize = maxsize
+        self.records = []
+        self.lock = threading.Lock()
+        self.send_lock = threading.RLock()
+        self.pid = None
+        if hasattr(os, 'register_at_fork'):  # Python 3.7+
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # the locks could be held by the flushing thread of the parent
+        self.lock = threading.Lock()
+        self.send_lock = threading.RLock()
+
+    def _start(self):
+        # start the flushing thread, once per process
+        self.pid = os.getpid()
+        self.records = []  # discard the records inherited from the parent
+        threading.Thread(target=self._run, daemon=True).start()
+        # flush at exit, also in the pool processes
+        multiprocessing.util.Finalize(None, self.flush, exitpriority=10)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:  # keep the flushing thread alive
+                logging.exception('Could not send the log records')
+
+    def append(self, job_id, level, process, message):
+        """
+        Add a log record to the buffer
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self._start()
+            self.records.append(
+                (job_id, datetime.utcnow(), level, process, message))
+            full = len(self.records) >= self.maxsize
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Send the pending log records to the DbServer
+        """
+        with self.send_lock:
+            with self.lock:
+                if self.pid != os.getpid():  # nothing was logged here
+                    return
+                records, self.records = self.records, []
+            if records:
+                try:
+                    dbcmd('log_many', records)
+                except sqlite3.IntegrityError:
+                    # a foreign key error in case of `oq run` is expected,
+                    # since the job is not in the database
+                    for job_id, _, level, process, message in records:
+                        logging.debug('[%s] %s', process, message)
+
+
+log_buffer = LogBuffer()
+
+
+def dblog(job_id, level, process, message):
+    """
+    Log a message on the database asynchronously; it works also
+    in the workers.
+
+    :param job_id: a job ID
+    :param level: a string like 'DEBUG', 'INFO', ...
+    :param process: a string identifying the process or the task
+    :param message: the message to log
+    """
+    log_buffer.append(job_id, level, process, message)
+
+
 def touch_log_file(log_file):
     """
     If a log file destination is specified, attempt to open the file in
@@ -108,10 +228,13 @@ class LogDatabaseHandler(logging.Handler):
 
     def emit(self, record):  # pylint: disable=E0202
         if record.levelno >= logging.INFO:
-            dbcmd('log', self.job_id, datetime.utcnow(), record.levelname,
+            dblog(self.job_id, record.levelname,
                   '%s/%s' % (record.processName, record.process),
                   record.getMessage())
 
+    def flush(self):
+        log_buffer.flush()
+
 
 @contextmanager
 def handle(job_id, log_level='info', log_file=None):
@@ -144,6 +267,7 @@ def handle(job_id, log_level='info', log_file=None):
                 os.path.getsize(log_file) == 0):
             logging.root.warn('The log file %s is empty!?' % log_file)
         for handler in handlers:
+            handler.flush()
             logging.root.removeHandler(handler)
 
 
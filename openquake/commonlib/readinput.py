@@ -22,7 +22,6 @@ import csv
 import copy
 import json
 import zlib
-import pickle
 import shutil
 import zipfile
 import logging
@@ -48,7 +47,7 @@ from openquake.hazardlib.probability_map import ProbabilityMap
 from openquake.risklib import asset, riskmodels
 from openquake.risklib.riskmodels import get_risk_models
 from openquake.commonlib.oqvalidation import OqParam
-from openquake.commonlib.source_reader import get_csm
+from openquake.commonlib.source_reader import get_csm, read_csm, write_csm
 from openquake.commonlib import logictree
 
 # the following is quite arbitrary, it gives output weights that I like (MS)
@@ -716,21 +715,17 @@ def _get_csm_cached(oq, full_lt, h5=None):
     checksum = get_checksum32(oq)
     if h5:
         h5.attrs['checksum32'] = checksum
-    fname = os.path.join(oq.csm_cache, '%s.pik' % checksum)
+    fname = os.path.join(oq.csm_cache, '%s.hdf5' % checksum)
     if os.path.exists(fname):
         logging.info('Reading %s', fname)
-        with open(fname, 'rb') as f:
-            csm = pickle.load(f)
-            csm.full_lt = full_lt
-            return csm
+        return read_csm(fname, full_lt)
     csm = get_csm(oq, full_lt, h5)
     logging.info('Weighting the sources')
     for sg in csm.src_groups:
         for src in sg:
             src.weight  # cache .num_ruptures
     logging.info('Saving %s', fname)
-    with open(fname, 'wb') as f:
-        pickle.dump(csm, f)
+    write_csm(fname, csm)
     return csm
 
 
@@ -859,8 +854,8 @@ def get_crmodel(oqparam):
 
 def get_exposure(oqparam):
     """
-    Read the full exposure in memory and build a list of
-    :class:`openquake.risklib.asset.Asset` instances.
+    Read the full exposure in memory and build the asset array, with
+    the site_id field referring to the exposure mesh.
 
     :param oqparam:
         an :class:`openquake.commonlib.oqvalidation.OqParam` instance
@@ -871,7 +866,8 @@ def get_exposure(oqparam):
         oqparam.inputs['exposure'], oqparam.calculation_mode,
         oqparam.region, oqparam.ignore_missing_costs,
         by_country='country' in oqparam.aggregate_by)
-    exposure.mesh, exposure.assets_by_site = exposure.get_mesh_assets_by_site()
+    exposure.mesh, exposure.array = exposure.get_mesh_assets(
+        oqparam.time_event)
     return exposure
 
 
@@ -899,24 +895,21 @@ def get_sitecol_assetcol(oqparam, haz_sitecol=None, cost_types=()):
 
     if haz_sitecol.mesh != exposure.mesh:
         # associate the assets to the hazard sites
-        sitecol, assets_by, discarded = geo.utils.assoc(
-            exposure.assets_by_site, haz_sitecol, haz_distance, 'filter')
-        assets_by_site = [[] for _ in sitecol.complete.sids]
-        num_assets = 0
-        for sid, assets in zip(sitecol.sids, assets_by):
-            assets_by_site[sid] = assets
-            num_assets += len(assets)
+        sitecol, assets, discarded = geo.utils.assoc(
+            exposure.array, haz_sitecol, haz_distance, 'filter')
+        tot_sites = len(sitecol.complete)
         logging.info(
-            'Associated %d assets to %d sites', num_assets, len(sitecol))
+            'Associated %d assets to %d sites', len(assets), len(sitecol))
     else:
         # asset sites and hazard sites are the same
         sitecol = haz_sitecol
-        assets_by_site = exposure.assets_by_site
+        assets = exposure.array
+        tot_sites = len(exposure.mesh)
         discarded = []
         logging.info('Read %d sites and %d assets from the exposure',
-                     len(sitecol), sum(len(a) for a in assets_by_site))
+                     len(sitecol), len(assets))
     assetcol = asset.AssetCollection(
-        exposure, assets_by_site, oqparam.time_event)
+        exposure, assets, tot_sites, oqparam.time_event)
     if assetcol.occupancy_periods:
         missing = set(cost_types) - set(exposure.cost_types['name']) - set(
             ['occupants'])
@@ -19,16 +19,20 @@ import copy
 import random
 import os.path
 import pickle
+import types
 import operator
 import logging
 import zlib
 import numpy
 
-from openquake.baselib import parallel, general
+from openquake.baselib import hdf5, parallel, general
 from openquake.hazardlib import nrml, sourceconverter, calc, InvalidFile
 from openquake.hazardlib.lt import apply_uncertainties
 
 TWO16 = 2 ** 16  # 65,536
+BLOCKSIZE = 10 * 1024 ** 2  # source model files are read in blocks of 10 MB
+U8 = numpy.uint8
+U32 = numpy.uint32
 by_id = operator.attrgetter('source_id')
 
 
@@ -48,19 +52,32 @@ def random_filtered_sources(sources, srcfilter, seed):
     return []
 
 
-def read_source_model(fname, converter, srcfilter, monitor):
+def read_source_model(fname, converter, srcfilter, block, monitor):
     """
     :param fname: path to a source model XML file
     :param converter: SourceConverter
     :param srcfilter: None unless OQ_SAMPLE_SOURCES is set
+    :param block: an XmlBlock if the file is read in blocks, otherwise None
     :param monitor: a Monitor instance
-    :returns: a SourceModel instance
+    :returns: a dictionary fname -> [(block, SourceModel)]
     """
-    [sm] = nrml.read_source_models([fname], converter)
+    if block is None:
+        [sm] = nrml.read_source_models([fname], converter)
+    else:
+        sm = nrml.read_source_block(fname, block, converter)
     if srcfilter:  # if OQ_SAMPLE_SOURCES is set sample the close sources
         for i, sg in enumerate(sm.src_groups):
             sg.sources = random_filtered_sources(sg.sources, srcfilter, i)
-    return {fname: sm}
+    return {fname: [(block, sm)]}
+
+
+def _merge_blocks(pairs):
+    # reassemble a source model from the blocks read in parallel
+    if pairs[0][0] is None:  # the file was read in a single task
+        return pairs[0][1]
+    pairs.sort(key=lambda pair: pair[0].start)
+    blocks, sms = zip(*pairs)
+    return nrml.merge_source_model(blocks, sms)
 
 
 def check_dupl_ids(smdict):
@@ -143,11 +160,18 @@ def get_csm(oq, full_lt, h5=None):
     # NB: h5 is None in logictree_test.py
     allargs = []
     for fname in full_lt.source_model_lt.info.smpaths:
-        allargs.append((fname, converter, srcfilter))
-    smdict = parallel.Starmap(read_source_model, allargs, distribute=dist,
-                              h5=h5 if h5 else None).reduce()
-    if len(smdict) > 1:  # really parallel
+        blocks = []
+        if (fname.endswith(('.xml', '.nrml')) and
+                os.path.getsize(fname) > BLOCKSIZE):
+            # large files are split in blocks of sources read in parallel
+            blocks = nrml.split_source_model(fname, BLOCKSIZE)
+        for block in blocks or [None]:
+            allargs.append((fname, converter, srcfilter, block))
+    res = parallel.Starmap(read_source_model, allargs, distribute=dist,
+                           h5=h5 if h5 else None).reduce()
+    if len(allargs) > 1:  # really parallel
         parallel.Starmap.shutdown()  # save memory
+    smdict = {fname: _merge_blocks(res[fname]) for fname in res}
     check_dupl_ids(smdict)
     groups = _build_groups(full_lt, smdict)
 
@@ -337,3 +361,187 @@ class CompositeSourceModel:
         """
         return '<%s with %d source group(s)>' % (
             self.__class__.__name__, len(self.src_groups))
+
+
+# ######################### HDF5 source model cache ####################### #
+
+# the composite source model is stored in HDF5 format column-wise: the
+# sources of each group are split in batches of homogeneous sources and
+# each attribute (recursively, i.e. mfd.a_val, location.longitude, ...)
+# is stored as a separate dataset; values which cannot be split in columns
+# are pickled, storing only once the values which are repeated
+
+PICKLE_METHODS = ('__reduce__', '__reduce_ex__', '__getstate__',
+                  '__setstate__', '__getnewargs__', '__getnewargs_ex__')
+
+
+# classes, functions and modules have a __dict__ but are pickled by reference
+NOT_PLAIN = (type, types.FunctionType, types.BuiltinFunctionType,
+             types.MethodType, types.ModuleType)
+
+
+def _plain(cls):
+    # True for the classes pickled by simply storing their __dict__
+    return (not issubclass(cls, NOT_PLAIN) and
+            all(getattr(cls, name, None) is getattr(object, name, None)
+                for name in PICKLE_METHODS) and
+            not any('__slots__' in vars(klass) for klass in cls.__mro__))
+
+
+def _store(h5, path, data, dtype=None, **attrs):
+    if dtype is None:
+        h5[path] = data
+    else:
+        dset = h5.create_dataset(path, (len(data),), dtype)
+        dset[:] = data
+    h5[path].attrs.update(attrs)
+
+
+def _pickles(values):
+    # pickle the values, only once for identical objects
+    pik = {}  # id -> pickle
+    for val in values:
+        if id(val) not in pik:
+            pik[id(val)] = pickle.dumps(val, protocol=4)
+    return [pik[id(val)] for val in values]
+
+
+def _store_pickles(h5, path, pickles):
+    # store the pickled values, only once for equal values
+    uniq = {p: i for i, p in enumerate(dict.fromkeys(pickles))}
+    _store(h5, path + '/idx', U32([uniq[p] for p in pickles]))
+    _store(h5, path + '/pik', [numpy.frombuffer(p, U8) for p in uniq],
+           hdf5.vuint8)
+    h5[path].attrs['kind'] = 'pickle'
+
+
+def _encode(h5, path, values, dedup=True):
+    # store the values in the node `path` of the HDF5 file, recursively;
+    # if dedup is true, the equal values are stored only once
+    cls = type(values[0])
+    same = all(type(val) is cls for val in values)
+    if same and (cls in (bool, int, float) or issubclass(cls, numpy.number)):
+        arr = numpy.array(values)
+        if arr.dtype.kind in 'biuf':  # no overflow to object
+            _store(h5, path, arr, kind='array',
+                   numpy=issubclass(cls, numpy.number))
+            return
+    elif same and cls is str:
+        _store(h5, path, hdf5.array_of_vstr(values), kind='str')
+        return
+    pickles = _pickles(values) if dedup or not same else None
+    if pickles and len(set(pickles)) * 2 <= len(values) or not same:
+        _store_pickles(h5, path, pickles)  # many equal values
+    elif cls is list:
+        items = [item for val in values for item in val]
+        _store(h5, path + '/lens', U32([len(val) for val in values]))
+        if items:
+            _encode(h5, path + '/items', items)
+        h5[path].attrs['kind'] = 'list'
+    elif (issubclass(cls, tuple) and values[0] and
+          len(set(map(len, values))) == 1 and
+          (cls is tuple or hasattr(cls, '_fields'))):
+        for i in range(len(values[0])):
+            _encode(h5, '%s/_%d' % (path, i), [val[i] for val in values])
+        h5[path].attrs.update(kind='tuple', cls=hdf5.cls2dotname(cls),
+                              size=len(values[0]))
+    elif (_plain(cls) and getattr(values[0], '__dict__', None) and
+          len(set(tuple(vars(val)) for val in values)) == 1):
+        keys = list(vars(values[0]))
+        for key in keys:
+            _encode(h5, '%s/%s' % (path, key),
+                    [vars(val)[key] for val in values])
+        h5[path].attrs.update(kind='object', cls=hdf5.cls2dotname(cls),
+                              keys=' '.join(keys))
+    else:
+        _store_pickles(h5, path, pickles or _pickles(values))
+
+
+def _attr(node, name):
+    val = node.attrs[name]
+    return val.decode('utf8') if isinstance(val, bytes) else val
+
+
+def _decode(node):
+    # read the values stored in the node by _encode
+    kind = _attr(node, 'kind')
+    if kind == 'array':
+        arr = node[()]
+        return list(arr) if node.attrs['numpy'] else arr.tolist()
+    elif kind == 'str':
+        return [s.decode('utf8') if isinstance(s, bytes) else s
+                for s in node[()]]
+    elif kind == 'pickle':
+        uniq = [pickle.loads(pik.tobytes()) for pik in node['pik'][()]]
+        return [uniq[i] for i in node['idx'][()]]
+    elif kind == 'list':
+        stops = numpy.cumsum(node['lens'][()]).tolist()
+        items = _decode(node['items']) if 'items' in node else []
+        return [items[start:stop]
+                for start, stop in zip([0] + stops[:-1], stops)]
+    cls = hdf5.dotname2cls(_attr(node, 'cls'))
+    if kind == 'tuple':
+        cols = [_decode(node['_%d' % i]) for i in range(node.attrs['size'])]
+        if cls is tuple:
+            return list(zip(*cols))
+        return [cls(*row) for row in zip(*cols)]
+    # kind == 'object'
+    keys = _attr(node, 'keys').split()
+    objs = []
+    for row in zip(*[_decode(node[key]) for key in keys]):
+        obj = cls.__new__(cls)
+        obj.__dict__.update(zip(keys, row))
+        objs.append(obj)
+    return objs
+
+
+def write_csm(fname, csm):
+    """
+    Store the source groups of a composite source model in a HDF5 file
+    in columnar format.
+
+    :param fname: path to the HDF5 file
+    :param csm: a :class:`CompositeSourceModel` instance
+    """
+    with hdf5.File(fname, 'w') as h5:
+        shells = []
+        for i, sg in enumerate(csm.src_groups):
+            shell = copy.copy(sg)  # group without sources
+            shell.sources = []
+            shells.append(numpy.frombuffer(
+                pickle.dumps(shell, protocol=4), U8))
+            batches = general.AccumDict(accum=[])  # homogeneous sources
+            for j, src in enumerate(sg):
+                batches[type(src), tuple(vars(src))].append(j)
+            for b, idxs in enumerate(batches.values()):
+                path = 'grp-%d/%d' % (i, b)
+                _store(h5, path + '/idxs', U32(idxs))
+                _encode(h5, path + '/sources', [sg.sources[j] for j in idxs],
+                        dedup=False)
+        _store(h5, 'src_groups', shells, hdf5.vuint8)
+
+
+def read_csm(fname, full_lt, trts=None):
+    """
+    Read a composite source model stored with :func:`write_csm`.
+
+    :param fname: path to the HDF5 file
+    :param full_lt: a :class:`FullLogicTree` instance
+    :param trts: if given, read only the source groups with those TRTs
+    :returns: a :class:`CompositeSourceModel` instance
+    """
+    src_groups = []
+    with hdf5.File(fname, 'r') as h5:
+        for i, shell in enumerate(h5['src_groups'][()]):
+            sg = pickle.loads(shell.tobytes())
+            if trts is not None and sg.trt not in trts:
+                continue
+            grp = h5.get('grp-%d' % i, {})
+            nsrcs = sum(len(batch['idxs']) for batch in grp.values())
+            sg.sources = [None] * nsrcs
+            for batch in grp.values():
+                srcs = _decode(batch['sources'])
+                for j, src in zip(batch['idxs'][()], srcs):
+                    sg.sources[j] = src
+            src_groups.append(sg)
+    return CompositeSourceModel(full_lt, src_groups)
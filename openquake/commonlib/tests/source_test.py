@@ -23,12 +23,13 @@ from io import BytesIO
 import numpy
 from numpy.testing import assert_allclose
 
+from openquake.baselib import general, hdf5
 from openquake.baselib.general import assert_close
 from openquake.baselib.parallel import Starmap
 from openquake.hazardlib import site, geo, mfd, pmf, scalerel, tests as htests
 from openquake.hazardlib import source, sourceconverter as s
 from openquake.hazardlib.tom import PoissonTOM
-from openquake.commonlib import tests, readinput
+from openquake.commonlib import tests, readinput, source_reader
 from openquake.commonlib.logictree import FullLogicTree
 from openquake.hazardlib import nrml
 
@@ -42,6 +43,9 @@ MIXED_SRC_MODEL = os.path.join(
 ALT_MFDS_SRC_MODEL = os.path.join(
     NRML_DIR, 'source_model/alternative-mfds.xml')
 
+MULTIPOINT_SRC_MODEL = os.path.join(
+    NRML_DIR, 'source_model/multi-point-source.xml')
+
 NONPARAMETRIC_SOURCE = os.path.join(
     NRML_DIR, 'source_model/nonparametric-source.xml')
 
@@ -755,5 +759,75 @@ Subduction Interface,b3,[SadighEtAl1997],w=1.0>''')
         self.assertEqual(repr(new), repr(csm.full_lt).
                          replace('0.6000000000000001', '0.6'))
 
+    def test_encode_decode(self):
+        # round trip of all kinds of sources, without a calculation
+        conv = s.SourceConverter(
+            investigation_time=50., rupture_mesh_spacing=5.,
+            complex_fault_mesh_spacing=5., width_of_mfd_bin=.1,
+            area_source_discretization=10.)
+        srcs = [src for fname in (MIXED_SRC_MODEL, MULTIPOINT_SRC_MODEL)
+                for sg in nrml.to_python(fname, conv) for src in sg]
+        self.assertIn('MultiPointSource', [type(src).__name__ for src in srcs])
+        for src in srcs:  # cache the number of ruptures before storing
+            src.num_ruptures = src.count_ruptures()
+        batches = general.AccumDict(accum=[])  # homogeneous sources
+        for src in srcs:
+            batches[type(src), tuple(vars(src))].append(src)
+        # a single source is not deduplicated, so it is stored by columns
+        batches = list(batches.values()) + [[src] for src in srcs]
+        fname = general.gettemp(suffix='.hdf5')
+        with hdf5.File(fname, 'w') as h5:
+            for b, batch in enumerate(batches):
+                source_reader._encode(h5, 'b%d' % b, batch, dedup=False)
+        with hdf5.File(fname, 'r') as h5:
+            for b, batch in enumerate(batches):
+                for src, newsrc in zip(batch, source_reader._decode(
+                        h5['b%d' % b])):
+                    self.assertEqual(type(src), type(newsrc))
+                    self.assertEqual(list(vars(src)), list(vars(newsrc)))
+                    self.assertEqual(src.wkt(), newsrc.wkt())
+                    self.assertEqual(src.count_ruptures(),
+                                     newsrc.count_ruptures())
+                    assert_allclose(src.get_annual_occurrence_rates(),
+                                    newsrc.get_annual_occurrence_rates())
+
+    def test_hdf5_cache(self):
+        oqparam = tests.get_oqparam('classical_job.ini')
+        self.check_hdf5_cache(readinput.get_composite_source_model(oqparam))
+
+        # a model with a MultiPointSource
+        from openquake.qa_tests_data.classical import case_22
+        oq = readinput.get_oqparam(
+            os.path.join(os.path.dirname(case_22.__file__), 'job.ini'))
+        csm = readinput.get_composite_source_model(oq)
+        self.assertEqual(
+            {type(src).__name__ for sg in csm.src_groups for src in sg},
+            {'MultiPointSource'})
+        self.check_hdf5_cache(csm)
+
+    def check_hdf5_cache(self, csm):
+        fname = general.gettemp(suffix='.hdf5')
+        source_reader.write_csm(fname, csm)
+        new = source_reader.read_csm(fname, csm.full_lt)
+        self.assertEqual(repr(new), repr(csm))
+        for sg, newsg in zip(csm.src_groups, new.src_groups):
+            self.assertEqual(sg.trt, newsg.trt)
+            self.assertEqual(sg.src_interdep, newsg.src_interdep)
+            for src, newsrc in zip(sg, newsg):
+                self.assertEqual(type(src), type(newsrc))
+                self.assertEqual(src.source_id, newsrc.source_id)
+                self.assertEqual(src.grp_ids, newsrc.grp_ids)
+                self.assertEqual(list(vars(src)), list(vars(newsrc)))
+                self.assertEqual(src.wkt(), newsrc.wkt())
+                self.assertEqual(src.get_annual_occurrence_rates(),
+                                 newsrc.get_annual_occurrence_rates())
+                self.assertEqual(src.count_ruptures(),
+                                 newsrc.count_ruptures())
+        # reading a single tectonic region type
+        trt = csm.src_groups[-1].trt
+        new = source_reader.read_csm(fname, csm.full_lt, [trt])
+        self.assertEqual([sg.trt for sg in new.src_groups],
+                         [sg.trt for sg in csm.src_groups if sg.trt == trt])
+
     def tearDown(self):
         Starmap.shutdown()
@@ -112,69 +112,149 @@ def _eps3(truncation_level, n_epsilons):
 
 
 DEBUG = AccumDict(accum=[])  # sid -> pnes.mean(), useful for debugging
+MAX_BYTES = 100 * 1024 ** 2  # max size of the PoEs arrays in disagg_by_site
+
+
+def _gsim_index(g_by_z, z):
+    # the gsim index for the realization index z or -1
+    try:
+        return g_by_z[z]
+    except (KeyError, IndexError):
+        return -1
 
 
 # this is inside an inner loop
 def disaggregate(ctxs, g_by_z, iml2dict, eps3, sid=0, bin_edges=()):
     """
     :param ctxs: a list of U fat RuptureContexts
-    :param imts: a list of Intensity Measure Type objects
     :param g_by_z: an array of gsim indices
-    :param imt: an Intensity Measure Type
     :param iml2dict: a dictionary of arrays imt -> (P, Z)
     :param eps3: a triplet (truncnorm, epsilons, eps_bands)
+    :param sid: the site ID
+    :param bin_edges: (dist_edges, lon_edges, lat_edges, eps_edges) or ()
     """
-    # disaggregate (separate) PoE in different contributions
-    U, E, M = len(ctxs), len(eps3[2]), len(iml2dict)
-    iml2 = next(iter(iml2dict.values()))
-    P, Z = iml2.shape
-    dists = numpy.zeros(U)
-    lons = numpy.zeros(U)
-    lats = numpy.zeros(U)
-
     # switch to logarithmic intensities
-    iml3 = numpy.zeros((M, P, Z))
-    for m, (imt, iml2) in enumerate(iml2dict.items()):
-        # 0 values are converted into -inf
-        iml3[m] = to_distribution_values(iml2, imt)
-
-    truncnorm, epsilons, eps_bands = eps3
-    cum_bands = numpy.array([eps_bands[e:].sum() for e in range(E)] + [0])
-    G = ctxs[0].mean_std.shape[-1]
-    mean_std = numpy.zeros((2, U, M, G), numpy.float32)
-    for u, ctx in enumerate(ctxs):
-        if not hasattr(ctx, 'idx'):  # assume single site
-            idx = 0
-        else:
-            idx = ctx.idx[sid]
-        dists[u] = ctx.rrup[idx]  # distance to the site
-        lons[u] = ctx.clon[idx]  # closest point of the rupture lon
-        lats[u] = ctx.clat[idx]  # closest point of the rupture lat
-        mean_std[:, u] = ctx.mean_std[:, idx]  # (2, N, M, G) => (2, M, G)
-    poes = numpy.zeros((U, E, M, P, Z))
-    pnes = numpy.ones((U, E, M, P, Z))
-    for (m, p, z), iml in numpy.ndenumerate(iml3):
-        if iml == -numpy.inf:  # zero hazard
-            continue
-        # discard the z contributions coming from wrong realizations: see
-        # the test disagg/case_2
-        try:
-            g = g_by_z[z]
-        except KeyError:
-            continue
-        lvls = (iml - mean_std[0, :, m, g]) / mean_std[1, :, m, g]
-        idxs = numpy.searchsorted(epsilons, lvls)
-        poes[:, :, m, p, z] = _disagg_eps(
-            truncnorm.sf(lvls), idxs, eps_bands, cum_bands)
-    for u, ctx in enumerate(ctxs):
-        pnes[u] *= ctx.get_probability_no_exceedance(poes[u])  # this is slow
+    # 0 values are converted into -inf
+    iml3 = numpy.array([to_distribution_values(iml2, imt)
+                        for imt, iml2 in iml2dict.items()])  # (M, P, Z)
+    U = len(ctxs)
+    idxs = [ctx.idx[sid] if hasattr(ctx, 'idx') else 0  # single site
+            for ctx in ctxs]
+    dists = numpy.array([ctx.rrup[i] for ctx, i in zip(ctxs, idxs)])
+    lons = numpy.array([ctx.clon[i] for ctx, i in zip(ctxs, idxs)])
+    lats = numpy.array([ctx.clat[i] for ctx, i in zip(ctxs, idxs)])
+    # (2, N, M, G) => (2, U, M, G)
+    mean_std = numpy.array([ctx.mean_std[:, i] for ctx, i in zip(ctxs, idxs)],
+                           numpy.float32).transpose(1, 0, 2, 3)
+    gidx = numpy.array([_gsim_index(g_by_z, z)
+                        for z in range(iml3.shape[-1])])
+    pnes = _disagg_pnes(ctxs, numpy.arange(U), mean_std,
+                        numpy.broadcast_to(iml3, (U,) + iml3.shape),
+                        numpy.broadcast_to(gidx, (U, len(gidx))), eps3)
     bindata = BinData(dists, lons, lats, pnes)
-    DEBUG[idx].append(pnes.mean())
+    DEBUG[sid].append(pnes.mean())
     if not bin_edges:
         return bindata
     return _build_disagg_matrix(bindata, bin_edges)
 
 
+def disagg_by_site(ctxs, iml4, gidx, eps3, bin_edges, maxsize=MAX_BYTES):
+    """
+    Disaggregate all the sites affected by the given ruptures. The
+    (rupture, site) pairs are stacked and ordered by site, then the PoEs
+    are computed in vectorized chunks of at most `maxsize` bytes.
+
+    :param ctxs: a list of U fat RuptureContexts with a .mean_std attribute
+    :param iml4: an array of logarithmic intensities of shape (N, M, P, Z)
+    :param gidx: an array of gsim indices of shape (N, Z), -1 if missing
+    :param eps3: a triplet (truncnorm, epsilons, eps_bands)
+    :param bin_edges: (dist_edges, lon_edges, lat_edges, eps_edges) with
+                      lon_edges and lat_edges dictionaries by site ID
+    :param maxsize: the memory budget in bytes
+    :yields: pairs (sid, 7D matrix of shape (D, Lo, La, E, M, P, Z))
+    """
+    if not ctxs:
+        return
+    N, M, P, Z = iml4.shape
+    E = len(eps3[2])
+    sids = numpy.concatenate([ctx.sids for ctx in ctxs])
+    rups = numpy.repeat(numpy.arange(len(ctxs)),
+                        [len(ctx.sids) for ctx in ctxs])
+    order = numpy.argsort(sids, kind='stable')
+    # discard the sites without gsims, see case_7
+    order = order[(gidx[sids[order]] >= 0).any(axis=1)]
+    sids, rups = sids[order], rups[order]
+    dists = numpy.concatenate([ctx.rrup for ctx in ctxs])[order]
+    lons = numpy.concatenate([ctx.clon for ctx in ctxs])[order]
+    lats = numpy.concatenate([ctx.clat for ctx in ctxs])[order]
+    mean_std = numpy.concatenate(  # shape (2, K, M, G)
+        [ctx.mean_std for ctx in ctxs], axis=1)[:, order].astype(numpy.float32)
+    dist_edges, lon_edges, lat_edges, eps_edges = bin_edges
+    K = len(sids)
+    blocksize = max(maxsize // (8 * E * M * P * Z), 1)
+    acc = {}  # sid -> 7D matrix of PNEs
+    for start in range(0, K, blocksize):
+        stop = min(start + blocksize, K)
+        ss = sids[start:stop]
+        pnes = _disagg_pnes(ctxs, rups[start:stop],
+                            mean_std[:, start:stop], iml4[ss], gidx[ss], eps3)
+        uniq, idxs = numpy.unique(ss, return_index=True)
+        for sid, i0, i1 in zip(uniq, idxs, list(idxs[1:]) + [len(ss)]):
+            slc = slice(start + i0, start + i1)
+            bins = dist_edges, lon_edges[sid], lat_edges[sid], eps_edges
+            bdata = BinData(dists[slc], lons[slc], lats[slc], pnes[i0:i1])
+            DEBUG[sid].append(bdata.pnes.mean())
+            mat = _pne_matrix(bdata, bins)
+            if sid in acc:
+                acc[sid] *= mat
+            else:
+                acc[sid] = mat
+        for sid in uniq:  # yield the sites already completed
+            if stop == K or sid < sids[stop]:
+                yield sid, 1. - acc.pop(sid)
+
+
+def _disagg_pnes(ctxs, rups, mean_std, iml4, gidx, eps3):
+    # returns the probabilities of no exceedance as an array of shape
+    # (K, E, M, P, Z) for K (rupture, site) pairs, where rups are the
+    # rupture indices, mean_std has shape (2, K, M, G), iml4 has shape
+    # (K, M, P, Z) and gidx has shape (K, Z)
+    truncnorm, epsilons, eps_bands = eps3
+    E = len(eps_bands)
+    cum_bands = numpy.array([eps_bands[e:].sum() for e in range(E)] + [0])
+    K, M, P, Z = iml4.shape
+    kk = numpy.arange(K)[:, None, None]
+    mm = numpy.arange(M)[None, :, None]
+    gg = numpy.maximum(gidx, 0)[:, None, :]
+    mean = mean_std[0][kk, mm, gg][:, :, None]  # shape (K, M, 1, Z)
+    std = mean_std[1][kk, mm, gg][:, :, None]  # shape (K, M, 1, Z)
+    # discard the z contributions coming from wrong realizations (see
+    # the test disagg/case_2) and the zero hazard levels
+    ok = (gidx >= 0)[:, None, None, :] & (iml4 != -numpy.inf)
+    with numpy.errstate(invalid='ignore'):
+        # NB: computing in single precision, as in the scalar algorithm
+        lvls = numpy.where(ok, (iml4.astype(mean.dtype) - mean) / std, 0)
+    poes = _disagg_eps(truncnorm.sf(lvls), numpy.searchsorted(
+        epsilons, lvls), eps_bands, cum_bands) * ok[:, None]
+    # group the pairs by temporal occurrence model; nonparametric ruptures
+    # are managed one at the time, parametric ruptures all together
+    pnes = numpy.ones_like(poes)
+    rates = numpy.array([ctx.occurrence_rate for ctx in ctxs])[rups]
+    nonpar = numpy.isnan(rates)
+    for u in numpy.unique(rups[nonpar]):
+        idx = rups == u
+        pnes[idx] = ctxs[u].get_probability_no_exceedance(poes[idx])
+    toms = {}
+    for u in numpy.unique(rups[~nonpar]):
+        tom = ctxs[u].temporal_occurrence_model
+        toms.setdefault(id(tom), (tom, []))[1].append(u)
+    for tom, us in toms.values():
+        idx = numpy.isin(rups, us) & ~nonpar
+        pnes[idx] = tom.get_probability_no_exceedance(
+            rates[idx, None, None, None, None], poes[idx])
+    return pnes
+
+
 def set_mean_std(ctxs, imts, gsims):
     for u, ctx in enumerate(ctxs):
         ctx.mean_std = ctx.get_mean_std(imts, gsims)  # (2, N, M, G)
@@ -182,13 +262,14 @@ def set_mean_std(ctxs, imts, gsims):
 
 def _disagg_eps(survival, bins, eps_bands, cum_bands):
     # disaggregate PoE of `iml` in different contributions,
-    # each coming from ``epsilons`` distribution bins
-    res = numpy.zeros((len(bins), len(eps_bands)))
+    # each coming from ``epsilons`` distribution bins;
+    # survival and bins have shape (U, ...)
+    res = numpy.zeros((len(eps_bands),) + bins.shape)
     for e, eps_band in enumerate(eps_bands):
-        res[bins <= e, e] = eps_band  # left bins
+        res[e][bins <= e] = eps_band  # left bins
         inside = bins == e + 1  # inside bins
-        res[inside, e] = survival[inside] - cum_bands[bins[inside]]
-    return res  # shape (U, E)
+        res[e][inside] = survival[inside] - cum_bands[bins[inside]]
+    return numpy.moveaxis(res, 0, 1)  # shape (U, E, ...)
 
 
 # used in calculators/disaggregation
@@ -223,6 +304,11 @@ def _build_disagg_matrix(bdata, bins):
     :returns:
         a 7D-matrix of shape (#distbins, #lonbins, #latbins, #epsbins, M, P, Z)
     """
+    return 1. - _pne_matrix(bdata, bins)
+
+
+def _pne_matrix(bdata, bins):
+    # returns the 7D-matrix of the probabilities of no exceedence
     dist_bins, lon_bins, lat_bins, eps_bins = bins
     dim1, dim2, dim3, dim4 = shape = [len(b) - 1 for b in bins]
 
@@ -245,10 +331,15 @@ def _build_disagg_matrix(bdata, bins):
     lats_idx[lats_idx == dim3] = dim3 - 1
     U, E, M, P, Z = bdata.pnes.shape
     mat7D = numpy.ones(shape + [M, P, Z])
-    for i_dist, i_lon, i_lat, pne in zip(
-            dists_idx, lons_idx, lats_idx, bdata.pnes):
-        mat7D[i_dist, i_lon, i_lat] *= pne  # shape E, M, P, Z
-    return 1. - mat7D
+    # multiply the PNEs falling in the same (dist, lon, lat) bin
+    keys = numpy.ravel_multi_index(
+        (dists_idx, lons_idx, lats_idx), (dim1, dim2, dim3))
+    order = numpy.argsort(keys, kind='stable')
+    uniq, start = numpy.unique(keys[order], return_index=True)
+    if len(uniq):
+        mat7D.reshape((dim1 * dim2 * dim3,) + mat7D.shape[3:])[uniq] = (
+            numpy.multiply.reduceat(bdata.pnes[order], start, axis=0))
+    return mat7D
 
 
 def _digitize_lons(lons, lon_bins):
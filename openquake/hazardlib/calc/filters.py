@@ -17,7 +17,9 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 import os
 import re
+import copy
 import ast
+import math
 import sys
 import time
 import logging
@@ -269,6 +271,123 @@ def split_sources(srcs):
     return sources, split_time
 
 
+class _Grid(object):
+    # a regular grid of cells over the sites, with the site indices ordered
+    # by cell row by row, so that consecutive cells of a row correspond
+    # to a contiguous slice of .order (CSR-style)
+    def __init__(self, lons, lats, sites_per_cell):
+        self.lons = lons
+        self.lats = lats
+        self.min_lon, self.min_lat = lons.min(), lats.min()
+        dlon = lons.max() - self.min_lon
+        dlat = lats.max() - self.min_lat
+        ncells = max(len(lons) // sites_per_cell, 1)
+        # cells approximately square in degrees
+        ratio = (dlon or 1.) / (dlat or 1.)
+        self.nx = int(min(max(numpy.sqrt(ncells * ratio), 1), ncells))
+        self.ny = max(ncells // self.nx, 1)
+        self.xstep = (dlon or 1.) / self.nx
+        self.ystep = (dlat or 1.) / self.ny
+        cells = self.get_row(lats) * self.nx + self.get_col(lons)
+        self.order = numpy.argsort(cells, kind='stable')
+        self.offsets = numpy.zeros(self.nx * self.ny + 1, int)
+        self.offsets[1:] = numpy.cumsum(
+            numpy.bincount(cells, minlength=self.nx * self.ny))
+
+    def get_col(self, lons):
+        col = numpy.floor((lons - self.min_lon) / self.xstep)
+        return numpy.clip(col, 0, self.nx - 1).astype(int)
+
+    def get_row(self, lats):
+        row = numpy.floor((lats - self.min_lat) / self.ystep)
+        return numpy.clip(row, 0, self.ny - 1).astype(int)
+
+    @staticmethod
+    def _clip(x, n):
+        # scalar version of get_col/get_row, faster for a single value
+        return min(max(int(math.floor(x)), 0), n - 1)
+
+    def query(self, min_lon, min_lat, max_lon, max_lat):
+        # returns the ordered indices of the sites strictly inside the box
+        c0 = self._clip((min_lon - self.min_lon) / self.xstep, self.nx)
+        c1 = self._clip((max_lon - self.min_lon) / self.xstep, self.nx)
+        r0 = self._clip((min_lat - self.min_lat) / self.ystep, self.ny)
+        r1 = self._clip((max_lat - self.min_lat) / self.ystep, self.ny)
+        rows = numpy.arange(r0, r1 + 1) * self.nx
+        starts = self.offsets[rows + c0]
+        stops = self.offsets[rows + c1 + 1]
+        # concatenate the slices order[start:stop] without a Python loop
+        lens = stops - starts
+        tot = lens.sum()
+        if tot == 0:
+            return numpy.zeros(0, int)
+        shift = numpy.repeat(starts - numpy.cumsum(lens) + lens, lens)
+        idxs = self.order[numpy.arange(tot) + shift]
+        lons, lats = self.lons[idxs], self.lats[idxs]
+        ok = ((min_lon < lons) & (lons < max_lon) &
+              (min_lat < lats) & (lats < max_lat))
+        return numpy.sort(idxs[ok])
+
+
+class SiteIndex(object):
+    """
+    A spatial index over the sites of a site collection, built once and
+    used to answer many bounding box queries. The results are the same as
+    the ones of :meth:`openquake.hazardlib.site.SiteCollection.within_bbox`,
+    including the management of the international date line, but the
+    cost of a query is proportional to the number of sites in the box and
+    not to the total number of sites.
+
+    :param lons: an array of N longitudes
+    :param lats: an array of N latitudes
+    :param sites_per_cell: average number of sites per cell of the grid
+    """
+    def __init__(self, lons, lats, sites_per_cell=4):
+        self.lons = numpy.asarray(lons)
+        self.lats = numpy.asarray(lats)
+        self.sites_per_cell = sites_per_cell
+        self.min_lon, self.max_lon = self.lons.min(), self.lons.max()
+        self.grid = _Grid(self.lons, self.lats, sites_per_cell)
+
+    @property
+    def grid360(self):
+        """
+        The grid on the longitudes in the range [0, 360[, built only
+        if there are boxes crossing the international date line
+        """
+        if not hasattr(self, '_grid360'):
+            self._grid360 = _Grid(
+                self.lons % 360, self.lats, self.sites_per_cell)
+        return self._grid360
+
+    def query(self, bbox):
+        """
+        :param bbox: a quartet (min_lon, min_lat, max_lon, max_lat)
+        :returns: the ordered indices of the sites within the bounding box
+        """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        grid = self.grid
+        if cross_idl(self.min_lon, self.max_lon, min_lon, max_lon):
+            grid = self.grid360
+            min_lon, max_lon = min_lon % 360, max_lon % 360
+        if min_lon >= max_lon or min_lat >= max_lat:
+            return numpy.zeros(0, int)
+        return grid.query(min_lon, min_lat, max_lon, max_lat)
+
+    def query_many(self, bboxes):
+        """
+        :param bboxes: a sequence of B bounding boxes
+        :returns: (indices, offsets) in CSR format, i.e. the sites in the
+                  box number b are indices[offsets[b]:offsets[b + 1]]
+        """
+        arrays = [self.query(bbox) for bbox in bboxes]
+        offsets = numpy.zeros(len(arrays) + 1, int)
+        offsets[1:] = numpy.cumsum([len(arr) for arr in arrays])
+        indices = (numpy.concatenate(arrays) if arrays
+                   else numpy.zeros(0, int))
+        return indices, offsets
+
+
 class SourceFilter(object):
     """
     Filter objects have a .filter method yielding filtered sources,
@@ -276,9 +395,12 @@ class SourceFilter(object):
     within the given maximum distance. There is also a .new method
     that filters the sources in parallel and returns a dictionary
     grp_id -> filtered sources.
-    Filter the sources by using `self.sitecol.within_bbox` which is
-    based on numpy.
+    Filter the sources by using a :class:`SiteIndex` over the site
+    collection, built once and queried in bulk.
     """
+    BLOCKSIZE = 1000  # number of sources per bulk query
+    sids = None  # if set, consider only the given sites (i.e. a tile)
+
     def __init__(self, sitecol, integration_distance, filename=None):
         if sitecol is not None and len(sitecol) < len(sitecol.complete):
             raise ValueError('%s is not complete!' % sitecol)
@@ -292,14 +414,42 @@ class SourceFilter(object):
         if not filename:  # keep the sitecol in memory
             self.__dict__['sitecol'] = sitecol
 
+    @property
+    def index(self):
+        """
+        A :class:`SiteIndex` over the site collection, built only once
+        """
+        if 'index' not in vars(self):
+            sc = self.sitecol.complete
+            if self.sids is None:
+                self.__dict__['index'] = SiteIndex(sc.lons, sc.lats)
+            else:
+                self.__dict__['index'] = SiteIndex(
+                    sc.lons[self.sids], sc.lats[self.sids])
+        return self.__dict__['index']
+
+    def restrict(self, sids):
+        """
+        :param sids: an ordered array of site IDs, for instance of a tile
+        :returns: a new SourceFilter considering only the given sites
+        """
+        new = object.__new__(self.__class__)
+        vars(new).update(self.__getstate__())
+        new.sids = sids
+        return new
+
+    def _sids(self, idxs):
+        # convert indices in the index into site IDs
+        return idxs if self.sids is None else self.sids[idxs]
+
     def __getstate__(self):
         if self.filename:
             # in the engine self.filename is the .hdf5 cache file
-            return dict(filename=self.filename,
+            return dict(filename=self.filename, sids=self.sids,
                         integration_distance=self.integration_distance)
         else:
             # when using calc_hazard_curves without an .hdf5 cache file
-            return dict(filename=None, sitecol=self.sitecol,
+            return dict(filename=None, sitecol=self.sitecol, sids=self.sids,
                         integration_distance=self.integration_distance)
 
     @property
@@ -340,8 +490,10 @@ class SourceFilter(object):
         :yields: pairs (src, sites)
         """
         if not self.integration_distance:  # do not filter
+            sites = (self.sitecol if self.sids is None
+                     else self.sitecol.filtered(self.sids))
             for src in sources:
-                yield src, self.sitecol
+                yield src, sites
             return
         for src in self.filter(sources):
             yield src, self.sitecol.filtered(src.indices)
@@ -398,23 +550,36 @@ class SourceFilter(object):
         """
         :param sources: a sequence of sources
         :yields: sources with .indices
+
+        NB: a filter restricted to a tile yields copies of the sources,
+        since the same source objects can be sent to several tiles and
+        their .indices must not leak from a tile to the next one
         """
         if self.sitecol is None:  # nofilter
             yield from sources
             return
-        for src in sources:
-            if hasattr(src, 'indices'):   # already filtered
-                yield src
-                continue
-            try:
-                box = self.integration_distance.get_affected_box(src)
-            except BBoxError:  # too large, don't filter
-                src.indices = self.sitecol.sids
-                yield src
-                continue
-            indices = self.sitecol.within_bbox(box)
-            if len(indices):
-                src.indices = indices
+        for block in general.block_splitter(sources, self.BLOCKSIZE):
+            if self.sids is not None:  # tile, compute the indices again
+                block = [copy.copy(src) for src in block]
+            boxes = {}  # index in the block -> bounding box
+            for i, src in enumerate(block):
+                if self.sids is None and hasattr(src, 'indices'):
+                    continue  # already filtered
+                try:
+                    boxes[i] = self.integration_distance.get_affected_box(src)
+                except BBoxError:  # too large, don't filter
+                    src.indices = (self.sitecol.sids if self.sids is None
+                                   else self.sids)
+            # the site indices of the sources are views over a single array
+            indices, offsets = self.index.query_many(list(boxes.values()))
+            indices = self._sids(indices)
+            slices = dict(zip(boxes, zip(offsets[:-1], offsets[1:])))
+            for i, src in enumerate(block):
+                if i in slices:
+                    start, stop = slices[i]
+                    if stop == start:  # no close sites
+                        continue
+                    src.indices = indices[start:stop]
                 yield src
 
     def within_bbox(self, srcs):
@@ -445,7 +610,7 @@ class SourceFilter(object):
             raise BBoxError(
                 'The bounding box of the sources is larger than half '
                 'the globe: %d degrees' % (bbox[2] - bbox[0]))
-        return self.sitecol.within_bbox(bbox)
+        return self._sids(self.index.query(bbox))
 
 
 nofilter = SourceFilter(None, {})
@@ -91,6 +91,10 @@ class GmfComputer(object):
 
     :param amplifier:
         None or an instance of Amplifier
+
+    :param cache:
+        None or a dictionary rup_id -> (sids, distances), see
+        :meth:`openquake.hazardlib.contexts.ContextMaker.make_contexts`
     """
     # The GmfComputer is called from the OpenQuake Engine. In that case
     # the rupture is an higher level containing a
@@ -101,7 +105,7 @@ class GmfComputer(object):
     # seed is extracted from the underlying rupture.
     def __init__(self, rupture, sitecol, imts, cmaker,
                  truncation_level=None, correlation_model=None,
-                 amplifier=None):
+                 amplifier=None, cache=None):
         if len(sitecol) == 0:
             raise ValueError('No sites')
         elif len(imts) == 0:
@@ -124,7 +128,7 @@ class GmfComputer(object):
             self.e0 = 0
         self.seed = rupture.rup_id
         self.rctx, self.sctx, self.dctx = cmaker.make_contexts(
-            sitecol, rupture)
+            sitecol, rupture, cache)
         self.sids = self.sctx.sids
         if correlation_model:  # store the filtered sitecol
             self.sites = sitecol.complete.filtered(self.sids)
@@ -137,6 +141,8 @@ class GmfComputer(object):
         t0 = time.time()
         sids = self.sids
         eids_by_rlz = self.ebrupture.get_eids_by_rlz(rlzs_by_gsim, self.offset)
+        m = (len(min_iml),)
+        dt = [('sid', U32), ('eid', U32), ('gmv', (F32, m))]
         data = []
         for gs, rlzs in rlzs_by_gsim.items():
             num_events = sum(len(eids_by_rlz[rlzi]) for rlzi in rlzs)
@@ -144,31 +150,27 @@ class GmfComputer(object):
             # compute.compute outside of the loop over the realizations
             # it is better to have few calls producing big arrays
             array, sig, eps = self.compute(gs, num_events)
-            array = array.transpose(1, 0, 2)  # from M, N, E to N, M, E
-            for i, miniml in enumerate(min_iml):  # gmv < minimum
-                arr = array[:, i, :]
-                arr[arr < miniml] = 0
-            n = 0
-            for rlzi in rlzs:
-                eids = eids_by_rlz[rlzi] + self.e0
-                e = len(eids)
-                for ei, eid in enumerate(eids):
-                    gmf = array[:, :, n + ei]  # shape (N, M)
-                    tot = gmf.sum(axis=0)  # shape (M,)
-                    if not tot.sum():
-                        continue
-                    if sig_eps is not None:
-                        tup = tuple([eid, rlzi] + list(sig[:, n + ei]) +
-                                    list(eps[:, n + ei]))
-                        sig_eps.append(tup)
-                    for sid, gmv in zip(sids, gmf):
-                        if gmv.sum():
-                            data.append((sid, eid, gmv))
-                        # gmv can be zero due to the minimum_intensity, coming
-                        # from the job.ini or from the vulnerability functions
-                n += e
-        m = (len(min_iml),)
-        d = numpy.array(data, [('sid', U32), ('eid', U32), ('gmv', (F32, m))])
+            array = array.transpose(2, 1, 0)  # from M, N, E to E, N, M
+            array[array < numpy.array(min_iml, F32)] = 0  # gmv < minimum
+            # the events in the order of the realizations
+            eids = numpy.concatenate(
+                [eids_by_rlz[rlzi] + self.e0 for rlzi in rlzs])
+            rlzis = numpy.repeat(
+                rlzs, [len(eids_by_rlz[rlzi]) for rlzi in rlzs])
+            # gmv can be zero due to the minimum_intensity, coming
+            # from the job.ini or from the vulnerability functions
+            ok = array.sum(axis=2) != 0  # shape (E, N)
+            if sig_eps is not None:
+                evs, = ok.any(axis=1).nonzero()  # events with nonzero gmfs
+                sig_eps.extend(zip(eids[evs], rlzis[evs], *sig[:, evs],
+                                   *eps[:, evs]))
+            evs, sites = ok.nonzero()  # ordered by event and then by site
+            arr = numpy.zeros(len(evs), dt)
+            arr['sid'] = sids[sites]
+            arr['eid'] = eids[evs]
+            arr['gmv'] = array[evs, sites]
+            data.append(arr)
+        d = numpy.concatenate(data) if data else numpy.zeros(0, dt)
         return d, time.time() - t0
 
     def compute(self, gsim, num_events):
@@ -30,7 +30,7 @@ from scipy.interpolate import interp1d
 
 from openquake.baselib import hdf5, parallel
 from openquake.baselib.general import (
-    AccumDict, DictArray, groupby, groupby_bin)
+    AccumDict, DictArray, groupby, groupby_bin, block_splitter)
 from openquake.baselib.performance import Monitor
 from openquake.hazardlib import const, imt as imt_module
 from openquake.hazardlib.imt import from_string
@@ -43,6 +43,7 @@ from openquake.hazardlib.geo.surface import PlanarSurface
 bymag = operator.attrgetter('mag')
 bydist = operator.attrgetter('dist')
 I16 = numpy.int16
+MAX_ELEMENTS = 1_000_000  # maximum size of the PoEs array in PmapMaker
 KNOWN_DISTANCES = frozenset(
     'rrup rx ry0 rjb rhypo repi rcdpp azimuth azimuth_cp rvolc'.split())
 
@@ -160,6 +161,182 @@ def read_ctxs(dstore, rctx_or_magstr, gidx=0, req_site_params=None):
     return ctxs, close_ctxs
 
 
+def tabulable(gsim):
+    """
+    :returns:
+        True if the GSIM depends only on the magnitude, a single distance
+        and (possibly) the vs30, so that it can be replaced by a GsimTable
+    """
+    return (set(gsim.REQUIRES_RUPTURE_PARAMETERS) <= {'mag'} and
+            len(gsim.REQUIRES_DISTANCES) == 1 and
+            set(gsim.REQUIRES_SITES_PARAMETERS) <= {'vs30'})
+
+
+class GsimTable(object):
+    """
+    A lookup table of means and standard deviations for a tabulable GSIM.
+    For each magnitude (and vs30 node, if required) the GSIM is evaluated
+    on a grid of distances equispaced in log(1 + dist), which is refined
+    by splitting the cells where the linear interpolation at the middle
+    point has an error above a quarter of the given tolerance (in natural
+    log units). The values at a generic vs30 are linearly interpolated in
+    log(vs30) between the two nearest vs30 nodes: in this way a
+    continuously varying vs30 does not produce a table per site. The nodes
+    are determined once per magnitude in the same way, starting from
+    VS30_REF * exp(k * VS30_STEP), so that the reference rock is a node,
+    and splitting the cells in VS30_RANGE. Since the error in the middle of
+    a cell is at least half of the maximum error in the cell, also when the
+    GSIM has a breakpoint inside the cell, the errors in distance and in
+    vs30 are both below half of the tolerance and their sum is below the
+    tolerance. The exceptions are the discontinuities of the GSIM (i.e.
+    vs30=2000 for AtkinsonBoore2006), where the cells are split at most
+    MAX_SPLITS times, and the vs30 outside VS30_RANGE, which get the values
+    at the extremes.
+    The tables are built lazily, the first time a magnitude/vs30 node
+    combination is encountered, and at most MAX_TABLES are kept in memory,
+    discarding the oldest ones.
+
+    :param gsim: a tabulable GSIM instance
+    :param imts: a list of IMT instances
+    :param maxdist: the maximum distance of the grid
+    :param tolerance: the maximum interpolation error
+    """
+    MIN_POINTS = 17
+    MAX_POINTS = 1025
+    MAX_SPLITS = 20
+    MAX_TABLES = 1000
+    VS30_REF = 760.
+    VS30_STEP = .2  # initial spacing of the nodes in log(vs30)
+    VS30_RANGE = (100., 3000.)
+
+    def __init__(self, gsim, imts, maxdist, tolerance):
+        [self.dist_type] = gsim.REQUIRES_DISTANCES
+        self.vs30 = 'vs30' in gsim.REQUIRES_SITES_PARAMETERS
+        self.gsim = gsim
+        self.imts = imts
+        self.xmax = numpy.log1p(maxdist)
+        self.tolerance = tolerance
+        self.tables = {}  # (mag, node) -> (xs, array of shape (2, D, M))
+        self.nodes = {}  # mag -> array of log(vs30 / VS30_REF)
+
+    def _compute(self, mag, vs30, xs):
+        # vs30 can be a scalar or an array of the same length as xs
+        ctx = RuptureContext()
+        ctx.mag = mag
+        ctx.sids = numpy.arange(len(xs))
+        setattr(ctx, self.dist_type, numpy.expm1(xs))
+        if self.vs30:
+            ctx.vs30 = numpy.full(len(xs), vs30)
+        return ctx.get_mean_std(self.imts, [self.gsim])[..., 0]
+
+    def _get_nodes(self, mag):
+        # returns the vs30 nodes for the given magnitude, in log(vs30/ref)
+        try:
+            return self.nodes[mag]
+        except KeyError:
+            pass
+        xs = numpy.linspace(0, self.xmax, self.MIN_POINTS)
+        D = len(xs)
+        step = self.VS30_STEP
+        ymin, ymax = numpy.log(numpy.array(self.VS30_RANGE) / self.VS30_REF)
+        ys = numpy.arange(
+            numpy.floor(ymin / step), numpy.ceil(ymax / step) + 1) * step
+        for _ in range(self.MAX_SPLITS):
+            mids = (ys[1:] + ys[:-1]) / 2
+            zs = numpy.concatenate([ys, mids])
+            vs30s = self.VS30_REF * numpy.exp(numpy.repeat(zs, D))
+            arr = self._compute(mag, vs30s, numpy.tile(xs, len(zs)))
+            arr = arr.reshape(2, len(zs), D, -1)
+            table, mid = arr[:, :len(ys)], arr[:, len(ys):]
+            err = numpy.abs((table[:, 1:] + table[:, :-1]) / 2 - mid)
+            bad = err.max(axis=(0, 2, 3)) > self.tolerance / 4
+            if not bad.any():
+                break
+            ys = numpy.sort(numpy.concatenate([ys, mids[bad]]))
+        self.nodes[mag] = ys
+        return ys
+
+    def _build(self, mag, vs30):
+        xs = numpy.linspace(0, self.xmax, self.MIN_POINTS)
+        table = self._compute(mag, vs30, xs)
+        for _ in range(self.MAX_SPLITS):
+            xmid = (xs[1:] + xs[:-1]) / 2
+            mid = self._compute(mag, vs30, xmid)
+            err = numpy.abs((table[:, 1:] + table[:, :-1]) / 2 - mid)
+            bad = err.max(axis=(0, 2)) > self.tolerance / 4
+            if not bad.any() or len(xs) + bad.sum() > self.MAX_POINTS:
+                break
+            # split the bad cells by adding their middle points
+            xs = numpy.concatenate([xs, xmid[bad]])
+            table = numpy.concatenate([table, mid[:, bad]], axis=1)
+            order = numpy.argsort(xs)
+            xs, table = xs[order], table[:, order]
+        return xs, table
+
+    def _get_table(self, mag, node):
+        key = mag, node
+        try:
+            return self.tables[key]
+        except KeyError:
+            if len(self.tables) >= self.MAX_TABLES:
+                del self.tables[next(iter(self.tables))]  # the oldest
+            vs30 = (self.VS30_REF * numpy.exp(self.nodes[mag][node])
+                    if self.vs30 else None)
+            self.tables[key] = tbl = self._build(mag, vs30)
+            return tbl
+
+    def get_mean_std(self, mags, dists, vs30s):
+        """
+        :param mags: N magnitudes
+        :param dists: N distances of kind .dist_type
+        :param vs30s: N vs30 values (ignored if vs30 is not required)
+        :returns: an array of shape (2, N, M) with means and stddevs
+        """
+        N = len(mags)
+        out = numpy.zeros((2, N, len(self.imts)))
+        if self.vs30:
+            # each point contributes to the two nearest vs30 nodes
+            y = numpy.log(vs30s / self.VS30_REF)
+            hi = numpy.zeros(N, int)
+            w = numpy.zeros(N)
+            umags, inv = numpy.unique(mags, return_inverse=True)
+            for u, mag in enumerate(umags):
+                ys = self._get_nodes(mag)
+                ok = inv == u
+                i = numpy.clip(numpy.searchsorted(ys, y[ok]), 1, len(ys) - 1)
+                hi[ok] = i
+                w[ok] = numpy.clip(
+                    (y[ok] - ys[i - 1]) / (ys[i] - ys[i - 1]), 0., 1.)
+            idxs = numpy.tile(numpy.arange(N), 2)
+            nodes = numpy.concatenate([hi - 1, hi])
+            ws = numpy.concatenate([1. - w, w])
+            mags = numpy.tile(mags, 2)
+            ok = ws > 0  # discard the nodes with zero weight
+            idxs, nodes, ws, mags = idxs[ok], nodes[ok], ws[ok], mags[ok]
+        else:
+            idxs = numpy.arange(N)
+            nodes = numpy.zeros(N, int)
+            ws = numpy.ones(N)
+        # group the points by (mag, node) with a single sort
+        order = numpy.lexsort((nodes, mags))
+        mags, nodes = mags[order], nodes[order]
+        idxs, ws = idxs[order], ws[order]
+        change = (mags[1:] != mags[:-1]) | (nodes[1:] != nodes[:-1])
+        bounds = numpy.concatenate(
+            [[0], numpy.flatnonzero(change) + 1, [len(order)]])
+        xs = numpy.log1p(dists)
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            grid, table = self._get_table(mags[start], nodes[start])
+            idx = idxs[start:stop]  # unique indices within the group
+            x = xs[idx]
+            i = numpy.clip(numpy.searchsorted(grid, x), 1, len(grid) - 1)
+            w = numpy.clip((x - grid[i - 1]) / (grid[i] - grid[i - 1]),
+                           0., 1.)[:, None]
+            out[:, idx] += ws[start:stop, None] * (
+                table[:, i - 1] * (1. - w) + table[:, i] * w)
+        return out
+
+
 class ContextMaker(object):
     """
     A class to manage the creation of contexts for distances, sites, rupture.
@@ -205,6 +382,15 @@ class ContextMaker(object):
         self.ctx_mon = monitor('make_contexts', measuremem=False)
         self.loglevels = DictArray(self.imtls)
         self.shift_hypo = param.get('shift_hypo')
+        # gsim -> GsimTable, used only if gsim_table_tolerance is set
+        self.gsim_tables = {}
+        tolerance = param.get('gsim_table_tolerance')
+        if tolerance:
+            maxdist = self.maximum_distance(trt)
+            for gsim in gsims:
+                if tabulable(gsim):
+                    self.gsim_tables[gsim] = GsimTable(
+                        gsim, self.imts, maxdist, tolerance)
         with warnings.catch_warnings():
             # avoid RuntimeWarning: divide by zero encountered in log
             warnings.simplefilter("ignore")
@@ -212,6 +398,39 @@ class ContextMaker(object):
                 if imt != 'MMI':
                     self.loglevels[imt] = numpy.log(imls)
 
+    def get_mean_std(self, ctxs):
+        """
+        :param ctxs: a list of contexts
+        :returns: an array of shape (2, N, M, G) with N the total number
+                  of sites in the contexts
+        """
+        if not self.gsim_tables:
+            return numpy.concatenate(
+                [ctx.get_mean_std(self.imts, self.gsims) for ctx in ctxs],
+                axis=1)
+        N = sum(len(ctx.sids) for ctx in ctxs)
+        arr = numpy.zeros((2, N, len(self.imts), len(self.gsims)))
+        others = [gsim for gsim in self.gsims if gsim not in self.gsim_tables]
+        if others:
+            start = 0
+            for ctx in ctxs:
+                stop = start + len(ctx.sids)
+                ms = ctx.get_mean_std(self.imts, others)
+                for i, gsim in enumerate(others):
+                    arr[:, start:stop, :, self.gsims.index(gsim)] = ms[..., i]
+                start = stop
+        mags = numpy.concatenate([numpy.full(len(ctx.sids), ctx.mag)
+                                  for ctx in ctxs])
+        for g, gsim in enumerate(self.gsims):
+            table = self.gsim_tables.get(gsim)
+            if table:
+                dists = numpy.concatenate(
+                    [getattr(ctx, table.dist_type) for ctx in ctxs])
+                vs30s = numpy.concatenate(
+                    [ctx.vs30 for ctx in ctxs]) if table.vs30 else None
+                arr[..., g] = table.get_mean_std(mags, dists, vs30s)
+        return arr
+
     def get_ctx_params(self):
         """
         :returns: the interesting attributes of the context
@@ -299,7 +518,7 @@ class ContextMaker(object):
             setattr(ctx, param, value)
         return ctx
 
-    def make_contexts(self, sites, rupture):
+    def make_contexts(self, sites, rupture, cache=None):
         """
         Filter the site collection with respect to the rupture and
         create context objects.
@@ -311,6 +530,11 @@ class ContextMaker(object):
             Instance of
             :class:`openquake.hazardlib.source.rupture.BaseRupture`
 
+        :param cache:
+            if not None, a dictionary rup_id -> (sids, distances) with the
+            distances already computed for the rupture; it is populated
+            when the rupture is not there
+
         :returns:
             Tuple of three items: rupture, sites and distances context.
 
@@ -318,10 +542,20 @@ class ContextMaker(object):
             If any of declared required parameters (site, rupture and
             distance parameters) is unknown.
         """
-        sites, dctx = self.filter(sites, rupture)
-        for param in self.REQUIRES_DISTANCES - set([self.filter_distance]):
-            distances = get_distances(rupture, sites, param)
-            setattr(dctx, param, distances)
+        cached = None if cache is None else cache.get(rupture.rup_id)
+        if cached is None:
+            sites, dctx = self.filter(sites, rupture)
+        elif len(cached[0]) == 0:
+            raise FarAwayRupture('%d: cached' % rupture.rup_id)
+        else:
+            sites = sites.complete.filtered(cached[0])
+            dctx = DistancesContext(cached[1].items())
+        for param in self.REQUIRES_DISTANCES | {self.filter_distance}:
+            if not hasattr(dctx, param):
+                setattr(dctx, param, get_distances(rupture, sites, param))
+        if cache is not None:
+            # store the distances before the reqv replacement below
+            cache[rupture.rup_id] = sites.sids, dict(vars(dctx))
         reqv_obj = (self.reqv.get(self.trt) if self.reqv else None)
         if reqv_obj and isinstance(rupture.surface, PlanarSurface):
             reqv = reqv_obj.get(dctx.repi, rupture.mag)
@@ -482,6 +716,37 @@ def print_finite_size(rups):
     print('total finite size ruptures = ', sum(c.values()))
 
 
+def get_pnes(ctxs, sizes, poes):
+    """
+    :param ctxs: a list of contexts
+    :param sizes: the number of sites affected by each context
+    :param poes: an array of shape (N, L, G) with N = sum(sizes)
+    :returns: an array of probabilities of no exceedance of shape (N, L, G)
+
+    The Poissonian parametric ruptures are managed with a single numpy
+    operation, the other ruptures context by context.
+    """
+    pnes = numpy.zeros_like(poes)
+    rates = numpy.zeros(len(poes))
+    poisson = numpy.zeros(len(poes), bool)
+    start = 0
+    for ctx, size in zip(ctxs, sizes):
+        slc = slice(start, start + size)
+        tom = ctx.temporal_occurrence_model
+        if (type(tom) is PoissonTOM and
+                not numpy.isnan(ctx.occurrence_rate)):
+            rates[slc] = ctx.occurrence_rate * tom.time_span
+            poisson[slc] = True
+        else:  # nonparametric rupture or other TOM
+            pnes[slc] = ctx.get_probability_no_exceedance(poes[slc])
+        start += size
+    if poisson.all():
+        pnes = numpy.exp(-rates[:, None, None] * poes)
+    elif poisson.any():
+        pnes[poisson] = numpy.exp(-rates[poisson, None, None] * poes[poisson])
+    return pnes
+
+
 class PmapMaker(object):
     """
     A class to compute the PoEs from a given source
@@ -503,38 +768,65 @@ class PmapMaker(object):
         # compute PoEs and update pmap
         if pmap is None:  # for src_indep
             pmap = self.pmap
+        L, G = len(self.loglevels.array), len(self.gsims)
+        if self.cmaker.af:  # the amplification works on single sites
+            blocks = [[ctx] for ctx in ctxs]
+        else:  # stack together contexts, up to MAX_ELEMENTS poes
+            blocks = block_splitter(ctxs, max(MAX_ELEMENTS // (L * G), 1),
+                                    lambda ctx: len(ctx.sids))
+        for block in blocks:
+            self._update_pmap_block(block, pmap)
+
+    def _update_pmap_block(self, ctxs, pmap):
+        # the poes of all the contexts are computed with a single call to
+        # get_poes, then the pnes are composed site by site with reduceat
         rup_indep = self.rup_indep
-        for ctx in ctxs:
-            # this must be fast since it is inside an inner loop
-            with self.gmf_mon:
-                # shape (2, N, M, G)
-                mean_std = ctx.get_mean_std(self.imts, self.gsims)
-            with self.poe_mon:
-                ll = self.loglevels
-                af = self.cmaker.af
-                if af:
-                    [sitecode] = ctx.sites['ampcode']  # single-site only
-                else:
-                    sitecode = None
-                poes = base.get_poes(mean_std, ll, self.trunclevel, self.gsims,
-                                     af, ctx.mag, sitecode, ctx.rrup)
-                for g, gsim in enumerate(self.gsims):
-                    for m, imt in enumerate(ll):
-                        if hasattr(gsim, 'weight') and gsim.weight[imt] == 0:
-                            # set by the engine when parsing the gsim logictree
-                            # when 0 ignore the gsim: see _build_trts_branches
-                            poes[:, ll(imt), g] = 0
-
-            with self.pne_mon:
-                # pnes and poes of shape (N, L, G)
-                pnes = ctx.get_probability_no_exceedance(poes)
-                for sid, pne in zip(ctx.sids, pnes):
-                    for grp_id in ctx.grp_ids:
-                        probs = pmap[grp_id].setdefault(sid, rup_indep).array
-                        if rup_indep:
-                            probs *= pne
-                        else:  # rup_mutex
-                            probs += (1. - pne) * ctx.weight
+        sizes = [len(ctx.sids) for ctx in ctxs]
+        with self.gmf_mon:
+            # shape (2, N, M, G) with N the total number of affected sites
+            mean_std = self.cmaker.get_mean_std(ctxs)
+        with self.poe_mon:
+            ll = self.loglevels
+            af = self.cmaker.af
+            if af:
+                [ctx] = ctxs
+                [sitecode] = ctx.sites['ampcode']  # single-site only
+                mag, rrup = ctx.mag, ctx.rrup
+            else:
+                sitecode = mag = rrup = None
+            poes = base.get_poes(mean_std, ll, self.trunclevel, self.gsims,
+                                 af, mag, sitecode, rrup)
+            for g, gsim in enumerate(self.gsims):
+                for m, imt in enumerate(ll):
+                    if hasattr(gsim, 'weight') and gsim.weight[imt] == 0:
+                        # set by the engine when parsing the gsim logictree;
+                        # when 0 ignore the gsim: see _build_trts_branches
+                        poes[:, ll(imt), g] = 0
+
+        with self.pne_mon:
+            # pnes and poes of shape (N, L, G)
+            pnes = get_pnes(ctxs, sizes, poes)
+            sids = numpy.concatenate([ctx.sids for ctx in ctxs])
+            if rup_indep:
+                probs = pnes
+            else:  # rup_mutex
+                weights = numpy.repeat([ctx.weight for ctx in ctxs], sizes)
+                probs = (1. - pnes) * weights[:, None, None]
+            order = numpy.argsort(sids, kind='stable')
+            usids, start = numpy.unique(sids[order], return_index=True)
+            if rup_indep:
+                composed = numpy.multiply.reduceat(probs[order], start)
+            else:
+                composed = numpy.add.reduceat(probs[order], start)
+            # all the contexts in a call to _update_pmap have the same grp_ids
+            for grp_id in ctxs[0].grp_ids:
+                pm = pmap[grp_id]
+                for sid, arr in zip(usids, composed):
+                    probs = pm.setdefault(sid, rup_indep).array
+                    if rup_indep:
+                        probs *= arr
+                    else:  # rup_mutex
+                        probs += arr
 
     def _ruptures(self, src, filtermag=None):
         with self.cmaker.mon('iter_ruptures', measuremem=False):
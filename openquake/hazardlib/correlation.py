@@ -19,6 +19,13 @@ spatially-distributed ground-shaking intensities.
 """
 import abc
 import numpy
+from scipy.spatial import cKDTree
+from scipy import sparse
+from scipy.sparse.linalg import spsolve_triangular
+
+from openquake.hazardlib.geo.geodetic import spherical_to_cartesian
+
+BLOCKSIZE = 10000  # number of sites per block in get_vecchia_factor
 
 
 class BaseCorrelationModel(metaclass=abc.ABCMeta):
@@ -26,6 +33,8 @@ class BaseCorrelationModel(metaclass=abc.ABCMeta):
     Base class for correlation models for spatially-distributed ground-shaking
     intensities.
     """
+    num_neighbours = 0  # if positive, use the Vecchia approximation
+
     def apply_correlation(self, sites, imt, residuals, stddev_intra=0):
         """
         Apply correlation to randomly sampled residuals.
@@ -49,7 +58,15 @@ class BaseCorrelationModel(metaclass=abc.ABCMeta):
         NB: the correlation matrix is cached. It is computed only once
         per IMT for the complete site collection and then the portion
         corresponding to the sites is multiplied by the residuals.
+        If .num_neighbours is positive, the dense matrix is replaced by
+        the sparse Vecchia factor of the given sites, see
+        :func:`get_vecchia_factor`.
         """
+        if self.num_neighbours:
+            factor = get_vecchia_factor(
+                sites, lambda dist: self._get_correlation_matrix(dist, imt),
+                self.num_neighbours)
+            return apply_vecchia_factor(factor, residuals)
         # intra-event residual for a single relization is a product
         # of lower-triangle decomposed correlation matrix and vector
         # of N random numbers (where N is equal to number of sites).
@@ -84,9 +101,13 @@ class JB2009CorrelationModel(BaseCorrelationModel):
         Boolean value to indicate whether "Case 1" or "Case 2" from page 1700
         should be applied. ``True`` value means that Vs 30 values show or are
         expected to show clustering ("Case 2"), ``False`` means otherwise.
+    :param num_neighbours:
+        If positive, use the Vecchia approximation with the given number of
+        neighbours instead of the dense Cholesky decomposition.
     """
-    def __init__(self, vs30_clustering):
+    def __init__(self, vs30_clustering, num_neighbours=0):
         self.vs30_clustering = vs30_clustering
+        self.num_neighbours = num_neighbours
         self.cache = {}  # imt -> correlation model
 
     def _get_correlation_matrix(self, sites, imt):
@@ -116,6 +137,75 @@ class JB2009CorrelationModel(BaseCorrelationModel):
         return numpy.linalg.cholesky(self._get_correlation_matrix(sites, imt))
 
 
+def get_vecchia_factor(sites, correlation, num_neighbours):
+    """
+    Build the Vecchia approximation of the correlation matrix of the given
+    sites, where each site is conditioned only on its `num_neighbours`
+    nearest neighbours among the previous sites. The neighbours are found
+    with a KDTree and the distances are the chord distances in km, so that
+    the memory and time are linear in the number of sites.
+
+    :param sites: a (possibly filtered) SiteCollection
+    :param correlation: a function distances -> correlation coefficients
+    :param num_neighbours: the maximum size of the conditioning sets
+    :returns: a pair (A, sqrtd) where A is a sparse lower triangular
+              matrix and sqrtd the conditional standard deviations, such
+              that A^-1 diag(sqrtd^2) A^-T approximates the correlation
+    """
+    xyz = spherical_to_cartesian(sites.lons, sites.lats)
+    n = len(xyz)
+    m = min(num_neighbours, n - 1)
+    if m == 0:  # a single site
+        return sparse.identity(n, format='csr'), numpy.ones(n)
+    # search 3m neighbours and keep the first m preceding the site
+    _, idxs = cKDTree(xyz).query(xyz, min(3 * m + 1, n))
+    prev = idxs < numpy.arange(n)[:, None]
+    order = numpy.argsort(~prev, axis=1, kind='stable')[:, :m]
+    nbs = numpy.take_along_axis(idxs, order, axis=1)  # shape (n, m)
+    valid = numpy.take_along_axis(prev, order, axis=1)  # shape (n, m)
+    nbs[~valid] = 0  # dummy neighbour, with zero weight below
+    rows, cols, vals = [], [], []
+    sqrtd = numpy.zeros(n)
+    for start in range(0, n, BLOCKSIZE):
+        sl = slice(start, start + BLOCKSIZE)
+        nb, ok = nbs[sl], valid[sl]
+        pts = xyz[nb]  # shape (b, m, 3)
+        cnn = correlation(numpy.linalg.norm(
+            pts[:, :, None] - pts[:, None], axis=-1))  # shape (b, m, m)
+        cin = correlation(numpy.linalg.norm(
+            pts - xyz[sl, None], axis=-1))  # shape (b, m)
+        cnn[~(ok[:, :, None] & ok[:, None, :])] = 0
+        cin[~ok] = 0
+        # the invalid neighbours are decoupled by a unit diagonal; the
+        # small jitter avoids singular matrices for coincident sites
+        diag = numpy.arange(m)
+        cnn[:, diag, diag] = numpy.where(ok, 1. + 1E-10, 1.)
+        b = numpy.linalg.solve(cnn, cin[:, :, None])[:, :, 0]
+        sqrtd[sl] = numpy.sqrt(numpy.clip(1. - (b * cin).sum(axis=1), 0, 1))
+        i, j = ok.nonzero()
+        rows.append(i + start)
+        cols.append(nb[i, j])
+        vals.append(-b[i, j])
+    rows.append(numpy.arange(n))
+    cols.append(numpy.arange(n))
+    vals.append(numpy.ones(n))
+    A = sparse.csr_matrix(
+        (numpy.concatenate(vals),
+         (numpy.concatenate(rows), numpy.concatenate(cols))), shape=(n, n))
+    return A, sqrtd
+
+
+def apply_vecchia_factor(factor, residuals):
+    """
+    :param factor: a pair (A, sqrtd) returned by :func:`get_vecchia_factor`
+    :param residuals: an array of independent residuals of shape (n, s)
+    :returns: an array of correlated residuals of shape (n, s)
+    """
+    A, sqrtd = factor
+    res = sqrtd[:, None] * residuals.reshape(len(sqrtd), -1)
+    return spsolve_triangular(A, res, lower=True).reshape(residuals.shape)
+
+
 def jbcorrelation(sites_or_distances, imt, vs30_clustering=False):
     """
      Returns the Jayaram-Baker correlation model.
@@ -159,9 +249,14 @@ class HM2018CorrelationModel(BaseCorrelationModel):
         Value to be multiplied by the uncertainty in the correlation parameter
         beta. If uncertainty_multiplier = 0 (default), the median value is
         used as a constant value.
+    :param num_neighbours:
+        If positive, use the Vecchia approximation with the given number of
+        neighbours instead of the dense Cholesky decomposition (only when
+        uncertainty_multiplier is 0).
     """
-    def __init__(self, uncertainty_multiplier=0):
+    def __init__(self, uncertainty_multiplier=0, num_neighbours=0):
         self.uncertainty_multiplier = uncertainty_multiplier
+        self.num_neighbours = num_neighbours
         self.distance_matrix = {}
         self.cache = {}
 
@@ -192,6 +287,13 @@ class HM2018CorrelationModel(BaseCorrelationModel):
             # corresponding standard deviation element.
             residuals_norm = residuals / stddev_intra[sites.sids, None]
 
+            if self.num_neighbours:
+                factor = get_vecchia_factor(
+                    sites, lambda dist: self._get_correlation_matrix(
+                        dist, imt), self.num_neighbours)
+                return stddev_intra[sites.sids, None] * apply_vecchia_factor(
+                    factor, residuals_norm)
+
             # Lower diagonal of the Cholesky decomposition from/to cache
             try:
                 cormaLow = self.cache[imt]
@@ -30,6 +30,41 @@ EARTH_RADIUS = 6371.0
 #: Maximum elevation on Earth in km.
 EARTH_ELEVATION = -8.848
 
+#: Maximum number of elements of the distance matrices kept in memory
+#: by :func:`cdist_min` and :func:`cdist_argmin` (80 MB of floats).
+MAX_DISTANCES = 10_000_000
+
+
+def _cdist_reduce(a, b, func):
+    # apply func to the columns of cdist(a, b), computed in blocks of
+    # columns so that at most MAX_DISTANCES distances are in memory;
+    # the result is identical to func(cdist(a, b), axis=0)
+    blocksize = max(MAX_DISTANCES // max(len(a), 1), 1)
+    if len(b) <= blocksize:
+        return func(cdist(a, b), axis=0)
+    return numpy.concatenate([func(cdist(a, b[i: i + blocksize]), axis=0)
+                              for i in range(0, len(b), blocksize)])
+
+
+def cdist_min(a, b):
+    """
+    :param a: an array of cartesian coordinates of shape (A, 3)
+    :param b: an array of cartesian coordinates of shape (B, 3)
+    :returns: the minimum distance from the points in `a` for each
+              point in `b`, without storing a matrix of shape (A, B)
+    """
+    return _cdist_reduce(a, b, numpy.min)
+
+
+def cdist_argmin(a, b):
+    """
+    :param a: an array of cartesian coordinates of shape (A, 3)
+    :param b: an array of cartesian coordinates of shape (B, 3)
+    :returns: the index of the closest point in `a` for each point
+              in `b`, without storing a matrix of shape (A, B)
+    """
+    return _cdist_reduce(a, b, numpy.argmin)
+
 
 def geodetic_distance(lons1, lats1, lons2, lats2, diameter=2*EARTH_RADIUS):
     """
@@ -233,7 +268,7 @@ def min_geodetic_distance(a, b):
         a = spherical_to_cartesian(a[0].flatten(), a[1].flatten())
     if isinstance(b, tuple):
         b = spherical_to_cartesian(b[0].flatten(), b[1].flatten())
-    return cdist(a, b).min(axis=0)
+    return cdist_min(a, b)
 
 
 def distance_matrix(lons, lats, diameter=2*EARTH_RADIUS):
@@ -22,14 +22,16 @@ to several geographical primitives and some other low-level spatial operations.
 """
 import math
 import logging
-import operator
 import collections
+import multiprocessing.dummy
 
 import numpy
 from scipy.spatial import cKDTree
 import shapely.geometry
+from shapely.vectorized import contains
 
 from openquake.baselib.hdf5 import vstr
+from openquake.baselib.python3compat import decode
 from openquake.hazardlib.geo import geodetic
 
 U32 = numpy.uint32
@@ -101,6 +103,36 @@ class _GeographicObjects(object):
         min_dist, idx = self.kdtree.query(xyz)
         return self.objects[idx], min_dist
 
+    def get_closest_many(self, lons, lats, chunksize=1_000_000):
+        """
+        Vectorized version of .get_closest, working on chunks of points
+        to keep the memory occupation bounded.
+
+        :param lons: an array of N longitudes
+        :param lats: an array of N latitudes
+        :param chunksize: the number of points per query
+        :returns: (indices of the closest objects, distances)
+        """
+        idxs = numpy.zeros(len(lons), int)
+        dists = numpy.zeros(len(lons))
+        slices = [slice(start, start + chunksize)
+                  for start in range(0, len(lons), chunksize)]
+
+        def query(slc):
+            xyz = spherical_to_cartesian(lons[slc], lats[slc])
+            return self.kdtree.query(xyz)
+
+        if len(slices) > 1:
+            # the KD-tree queries release the GIL, so threads are enough
+            with multiprocessing.dummy.Pool() as pool:
+                results = pool.map(query, slices)
+        else:
+            results = map(query, slices)
+        for slc, (dist, idx) in zip(slices, results):
+            dists[slc] = dist
+            idxs[slc] = idx
+        return idxs, dists
+
     def assoc(self, sitecol, assoc_dist, mode):
         """
         :param sitecol: a (filtered) site collection
@@ -109,72 +141,74 @@ class _GeographicObjects(object):
         :returns: filtered site collection, filtered objects, discarded
         """
         assert mode in 'strict warn filter', mode
-        dic = {}
+        sids, lons, lats = sitecol.sids, sitecol.lons, sitecol.lats
+        idxs, distances = self.get_closest_many(lons, lats)
+        if assoc_dist is None:
+            ok = numpy.ones(len(sids), bool)  # associate all
+        else:
+            ok = distances <= assoc_dist  # associate within
         discarded = []
-        for sid, lon, lat in zip(sitecol.sids, sitecol.lons, sitecol.lats):
-            obj, distance = self.get_closest(lon, lat)
-            if assoc_dist is None:
-                dic[sid] = obj  # associate all
-            elif distance <= assoc_dist:
-                dic[sid] = obj  # associate within
-            elif mode == 'warn':
-                dic[sid] = obj  # associate outside
+        for i in numpy.where(~ok)[0]:
+            obj = self.objects[idxs[i]]
+            if mode == 'warn':
+                ok[i] = True  # associate outside
                 logging.warning(
                     'The closest vs30 site (%.1f %.1f) is distant more than %d'
                     ' km from site #%d (%.1f %.1f)', obj['lon'], obj['lat'],
-                    int(distance), sid, lon, lat)
+                    int(distances[i]), sids[i], lons[i], lats[i])
             elif mode == 'filter':
                 discarded.append(obj)
             elif mode == 'strict':
                 raise SiteAssociationError(
                     'There is nothing closer than %s km '
-                    'to site (%s %s)' % (assoc_dist, lon, lat))
-        if not dic:
+                    'to site (%s %s)' % (assoc_dist, lons[i], lats[i]))
+        if not ok.any():
             raise SiteAssociationError(
                 'No sites could be associated within %s km' % assoc_dist)
-        sids = sorted(dic)
-        return (sitecol.filtered(sids), numpy.array([dic[s] for s in sids]),
-                discarded)
+        order = numpy.argsort(sids[ok], kind='stable')
+        return (sitecol.filtered(sids[ok][order]),
+                self.objects[idxs[ok][order]], discarded)
 
-    def assoc2(self, assets_by_site, assoc_dist, mode):
+    def assoc2(self, assets, assoc_dist, mode):
         """
-        Associated a list of assets by site to the site collection used
+        Associated an array of assets to the site collection used
         to instantiate GeographicObjects.
 
-        :param assets_by_sites: a list of lists of assets
+        :param assets: an array of assets with fields lon, lat, site_id
         :param assoc_dist: the maximum distance for association
-        :param mode: 'strict', 'warn' or 'filter'
-        :returns: filtered site collection, filtered assets by site, discarded
+        :param mode: 'strict' or 'filter'
+        :returns: filtered site collection, filtered assets, discarded
         """
         assert mode in 'strict filter', mode
         self.objects.filtered  # self.objects must be a SiteCollection
         asset_dt = numpy.dtype(
             [('asset_ref', vstr), ('lon', F32), ('lat', F32)])
-        assets_by_sid = collections.defaultdict(list)
-        discarded = []
-        for assets in assets_by_site:
-            lon, lat = assets[0].location
-            obj, distance = self.get_closest(lon, lat)
-            if distance <= assoc_dist:
-                # keep the assets, otherwise discard them
-                assets_by_sid[obj['sids']].extend(assets)
-            elif mode == 'strict':
-                raise SiteAssociationError(
-                    'There is nothing closer than %s km '
-                    'to site (%s %s)' % (assoc_dist, lon, lat))
-            else:
-                discarded.extend(assets)
-        sids = sorted(assets_by_sid)
-        if not sids:
+        # query one location per exposure site
+        _uniq, idx, inv = numpy.unique(
+            assets['site_id'], return_index=True, return_inverse=True)
+        lons, lats = assets['lon'][idx], assets['lat'][idx]
+        idxs, distances = self.get_closest_many(lons, lats)
+        ok = distances <= assoc_dist
+        if mode == 'strict' and not ok.all():
+            i = numpy.where(~ok)[0][0]
+            raise SiteAssociationError(
+                'There is nothing closer than %s km '
+                'to site (%s %s)' % (assoc_dist, lons[i], lats[i]))
+        if not ok.any():
             raise SiteAssociationError(
                 'Could not associate any site to any assets within the '
                 'asset_hazard_distance of %s km' % assoc_dist)
-        assets_by_site = [
-            sorted(assets_by_sid[sid], key=operator.attrgetter('ordinal'))
-            for sid in sids]
-        data = [(asset.asset_id,) + asset.location for asset in discarded]
-        discarded = numpy.array(data, asset_dt)
-        return self.objects.filtered(sids), assets_by_site, discarded
+        keep = ok[inv]
+        new = assets[keep]
+        new['site_id'] = self.objects.sids[idxs][inv[keep]]
+        new = new[numpy.argsort(new['site_id'], kind='stable')]
+        lost = assets[~keep]
+        discarded = numpy.zeros(len(lost), asset_dt)
+        discarded['asset_ref'] = [decode(aid) for aid in lost['id']]
+        discarded['lon'] = lost['lon']
+        discarded['lat'] = lost['lat']
+        sids = numpy.unique(new['site_id'])
+        return self.objects.filtered(sids), new, discarded
 
 
 def assoc(objects, sitecol, assoc_dist, mode):
@@ -182,8 +216,8 @@ def assoc(objects, sitecol, assoc_dist, mode):
     Associate geographic objects to a site collection.
 
     :param objects:
-        something with .lons, .lats or ['lon'] ['lat'], or a list of lists
-        of objects with a .location attribute (i.e. assets_by_site)
+        something with .lons, .lats or ['lon'] ['lat'], or an asset array
+        with fields lon, lat, site_id
     :param assoc_dist:
         the maximum distance for association
     :param mode:
@@ -191,12 +225,13 @@ def assoc(objects, sitecol, assoc_dist, mode):
         if 'error' fail if all sites are not associated
     :returns: (filtered site collection, filtered objects)
     """
-    if isinstance(objects, numpy.ndarray) or hasattr(objects, 'lons'):
-        # objects is a geo array with lon, lat fields; used for ShakeMaps
-        return _GeographicObjects(objects).assoc(sitecol, assoc_dist, mode)
-    else:  # objects is the list assets_by_site
+    if hasattr(objects, 'dtype') and 'site_id' in objects.dtype.names:
+        # objects is an asset array
         return _GeographicObjects(sitecol).assoc2(
             objects, assoc_dist, mode)
+    else:
+        # objects is a geo array with lon, lat fields; used for ShakeMaps
+        return _GeographicObjects(objects).assoc(sitecol, assoc_dist, mode)
 
 
 def clean_points(points):
@@ -675,3 +710,44 @@ def geohash(lon, lat, length):
             bit = 0
             ch = 0
     return chars
+
+
+def geohashes(lons, lats, length):
+    """
+    Vectorized version of :func:`geohash`, performing the bisections
+    for all the points at once.
+
+    >>> geohashes([10, -10], [45, -45], length=5)
+    array([b'spzpg', b'5zbzu'], dtype='|S5')
+    """
+    lons = numpy.array(lons, float)
+    lats = numpy.array(lats, float)
+    n = len(lons)
+    intervals = [numpy.full((2, n), -180.), numpy.full((2, n), -90.)]
+    intervals[0][1], intervals[1][1] = 180., 90.
+    codes = numpy.zeros((n, length), numpy.uint8)
+    for b in range(5 * length):
+        # even bits refer to the longitudes, odd bits to the latitudes
+        coords, (low, high) = (lons, lats)[b % 2], intervals[b % 2]
+        mid = (low + high) / 2
+        up = coords > mid
+        low[up] = mid[up]
+        high[~up] = mid[~up]
+        codes[:, b // 5] |= up.astype(numpy.uint8) << (4 - b % 5)
+    chars = numpy.frombuffer(b''.join(BASE32), numpy.uint8)[codes]
+    return chars.view((numpy.string_, length)).reshape(n)
+
+
+def within_region(lons, lats, region):
+    """
+    Vectorized containment test, equivalent to
+    `[Point(lon, lat).within(region) for lon, lat in zip(lons, lats)]`
+    but using a prepared geometry.
+
+    :param lons: an array of N longitudes
+    :param lats: an array of N latitudes
+    :param region: a shapely geometry, typically a polygon
+    :returns: a boolean array of N elements
+    """
+    return contains(region, numpy.array(lons, float),
+                    numpy.array(lats, float))
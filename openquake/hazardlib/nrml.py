@@ -82,7 +82,8 @@ import numpy
 from openquake.baselib import hdf5
 from openquake.baselib.general import CallableDict, groupby, gettemp
 from openquake.baselib.node import (
-    node_to_xml, Node, striptag, ValidatingXmlParser, floatformat)
+    node_to_xml, Node, striptag, ValidatingXmlParser, floatformat,
+    split_xml, read_xml_block)
 from openquake.hazardlib import valid, sourceconverter, InvalidFile
 
 F64 = numpy.float64
@@ -307,6 +308,17 @@ validators = {
 }
 
 
+def _check_investigation_time(sm, fname, converter):
+    # check investigation time for NonParametricSeismicSources
+    cit = converter.investigation_time
+    np = [s for sg in sm.src_groups for s in sg if hasattr(s, 'data')]
+    if np and sm.investigation_time != cit:
+        raise ValueError(
+            'The source model %s contains an investigation_time '
+            'of %s, while the job.ini has %s' % (
+                fname, sm.investigation_time, cit))
+
+
 def read_source_models(fnames, converter):
     """
     :param fnames:
@@ -322,18 +334,106 @@ def read_source_models(fnames, converter):
         else:
             raise ValueError('Unrecognized extension in %s' % fname)
         sm.fname = fname
-
-        # check investigation time for NonParametricSeismicSources
-        cit = converter.investigation_time
-        np = [s for sg in sm.src_groups for s in sg if hasattr(s, 'data')]
-        if np and sm.investigation_time != cit:
-            raise ValueError(
-                'The source model %s contains an investigation_time '
-                'of %s, while the job.ini has %s' % (
-                    fname, sm.investigation_time, cit))
+        _check_investigation_time(sm, fname, converter)
         yield sm
 
 
+def _splittable(tag, attrib):
+    # the sources in a sourceModel or sourceGroup can be read in blocks,
+    # except for the groups that must be kept together
+    if tag.endswith('sourceModel'):
+        return True
+    elif tag.endswith('sourceGroup'):
+        return not ('srcs_weights' in attrib or attrib.get('cluster') ==
+                    'true' or 'mutex' in (attrib.get('src_interdep'),
+                                          attrib.get('rup_interdep')))
+    return False
+
+
+def split_source_model(fname, blocksize):
+    """
+    Split a source model file in blocks of contiguous sources of around
+    `blocksize` bytes, to be read in parallel with :func:`read_source_block`
+    and recombined with :func:`merge_source_model`. Mutex and cluster
+    groups are never split.
+
+    :param fname: path to a source model file
+    :param blocksize: the approximate size of the blocks in bytes
+    :returns: a list of :class:`openquake.baselib.node.XmlBlock` objects
+    """
+    return split_xml(fname, _splittable, blocksize)
+
+
+def read_source_block(fname, block, converter):
+    """
+    :param fname: path to a source model file
+    :param block: an XmlBlock returned by :func:`split_source_model`
+    :param converter: a SourceConverter instance
+    :returns: a SourceModel with the sources in the block
+    """
+    data = io.BytesIO(read_xml_block(fname, block))
+    data.name = fname  # used in the error messages
+    [node] = read(data)
+    sm = node_to_obj(node, fname, converter)
+    sm.fname = fname
+    _check_investigation_time(sm, fname, converter)
+    return sm
+
+
+def merge_source_model(blocks, sms):
+    """
+    Merge the SourceModels read from the blocks of the same file, i.e.
+    reassemble the source groups split across several blocks.
+
+    :param blocks: the XmlBlocks, in the order of the file
+    :param sms: the associated SourceModels
+    :returns: a SourceModel equivalent to the one read from the whole file
+    """
+    sm = sms[0]
+    if b'nrml/0.4' in blocks[0].header:  # the groups are built by TRT
+        source_ids = set()
+        srcs_by_trt = {}
+        for grp in (grp for sm_ in sms for grp in sm_.src_groups):
+            for src in grp:
+                if src.source_id in source_ids:
+                    raise DuplicatedID(
+                        'The source ID %s is duplicated!' % src.source_id)
+                source_ids.add(src.source_id)
+            srcs_by_trt.setdefault(grp.trt, []).extend(grp)
+            min_mag = grp.min_mag
+        sm.src_groups = sorted(
+            sourceconverter.SourceGroup(trt, srcs, min_mag=min_mag)
+            for trt, srcs in srcs_by_trt.items())
+        return sm
+    groups = []
+    grp_by_key = {}
+    for block, sm_ in zip(blocks, sms):
+        for grp in sm_.src_groups:
+            if block.tag != 'sourceGroup':  # groups kept together
+                groups.append(grp)
+            elif block.key in grp_by_key:  # a group split in several blocks
+                for src in grp:
+                    grp_by_key[block.key].update(src)
+            else:
+                grp_by_key[block.key] = grp
+                groups.append(grp)
+    sm.src_groups = sorted(groups)
+    return sm
+
+
+def iterparse(source, tag):
+    """
+    Yield the validated nodes with the given tag contained in a NRML file,
+    without keeping the entire tree in memory.
+
+    :param source:
+        a file name or file object open for reading
+    :param tag:
+        the tag of the nodes to yield, without namespace (i.e. 'asset')
+    """
+    return ValidatingXmlParser(validators).iterparse(source, tag)
+
+
 def read(source, stop=None):
     """
     Convert a NRML file into a validated Node object. Keeps
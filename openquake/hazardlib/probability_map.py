@@ -221,7 +221,7 @@ class ProbabilityMap(dict):
 
     def filter(self, sids):
         """
-        Extracs a submap of self for the given sids.
+        Extracts a submap of self for the given sids.
         """
         dic = self.__class__(self.shape_y, self.shape_z)
         for sid in sids:
@@ -352,6 +352,266 @@ class ProbabilityMap(dict):
                                     self.shape_y, self.shape_z)
 
 
+class DenseProbabilityMap(object):
+    """
+    A ProbabilityMap stored as a single contiguous array of shape
+    (N, L, I) plus a sorted array of N site IDs. It has the same reading
+    API of :class:`ProbabilityMap` (iteration on the sids, `pmap[sid]`
+    returning a ProbabilityCurve, `.sids`, `.array`, `.nbytes`) but the
+    operators `|`, `*`, `~` and the methods `.extract`, `.filter`,
+    `.convert` work on the whole array at once, without instantiating
+    a ProbabilityCurve per site. The curves returned by `pmap[sid]` are
+    views over the underlying array, so they can be modified in place.
+    When used as an accumulator, the curves of the new sites are appended
+    to a buffer growing geometrically and the sorting is postponed to
+    the first access to `.sids` or `.array`, so that `|=` costs only
+    the size of the right operand.
+
+    >>> pmap = DenseProbabilityMap(numpy.array([[[.1]], [[.2]]]), [3, 1])
+    >>> pmap.sids
+    array([1, 3], dtype=uint32)
+    >>> (pmap | pmap)[3]
+    <ProbabilityCurve
+    [[0.19]]>
+    """
+    def __init__(self, array, sids):
+        sids = numpy.array(sids, numpy.uint32)
+        if len(sids) != len(array):
+            raise ValueError('Passed %d site IDs, but the array has length %d'
+                             % (len(sids), len(array)))
+        if len(array.shape) == 2:  # shape (N, L) -> (N, L, 1)
+            array = array.reshape(array.shape + (1,))
+        order = numpy.argsort(sids)
+        self._sids = sids[order]
+        self._array = array[order]
+        self._size = len(sids)  # number of used rows in the buffers
+        self._sorted = True
+        self._rowidx = None  # sid -> row in the buffers, -1 if missing
+
+    @classmethod
+    def build(cls, shape_y, shape_z, sids, initvalue=0., dtype=F64):
+        """
+        :param shape_y: the total number of intensity measure levels
+        :param shape_z: the number of inner levels
+        :param sids: a set of site indices
+        :param initvalue: the initial value of the probability (default 0)
+        :returns: a DenseProbabilityMap
+        """
+        array = numpy.empty((len(sids), shape_y, shape_z), dtype)
+        array.fill(initvalue)
+        return cls(array, sorted(sids))
+
+    @classmethod
+    def from_pmap(cls, pmap, shape_y=None, shape_z=None):
+        """
+        :param pmap: a ProbabilityMap or a DenseProbabilityMap
+        :returns: a DenseProbabilityMap with a copy of the data
+        """
+        if len(pmap) == 0:
+            return cls.build(shape_y or pmap.shape_y,
+                             shape_z or pmap.shape_z, [])
+        return cls(numpy.array(pmap.array), pmap.sids)
+
+    @property
+    def sids(self):
+        """The sorted array of site IDs"""
+        self._sort()
+        return self._sids
+
+    @property
+    def array(self):
+        """The array of shape (N, L, I) aligned to the sids"""
+        self._sort()
+        return self._array
+
+    @property
+    def shape_y(self):
+        return self._array.shape[1]
+
+    @property
+    def shape_z(self):
+        return self._array.shape[2]
+
+    @property
+    def nbytes(self):
+        """The size of the underlying array"""
+        return self.array.nbytes
+
+    def _sort(self):
+        # remove the unused rows and sort the buffers by site ID
+        n = self._size
+        if self._sorted and len(self._sids) == n:
+            return
+        order = numpy.argsort(self._sids[:n], kind='stable')
+        self._sids = self._sids[:n][order]
+        self._array = self._array[:n][order]
+        self._sorted = True
+        self._rowidx = None
+
+    def _rows(self, sids):
+        # returns the rows of the given sids in the buffers, -1 if missing
+        maxsid = sids.max() + 1
+        if self._rowidx is None:
+            n = self._size
+            size = max(maxsid, self._sids[:n].max() + 1 if n else 0)
+            self._rowidx = numpy.full(size, -1)
+            self._rowidx[self._sids[:n]] = numpy.arange(n)
+        elif maxsid > len(self._rowidx):  # grow geometrically
+            rowidx = numpy.full(max(maxsid, 2 * len(self._rowidx)), -1)
+            rowidx[:len(self._rowidx)] = self._rowidx
+            self._rowidx = rowidx
+        return self._rowidx[sids]
+
+    def _indices(self, sids):
+        # returns the indices of the given sids in self.sids and a mask
+        # with the sids which are present
+        idx = numpy.searchsorted(self.sids, sids)
+        ok = idx < len(self.sids)
+        ok[ok] = self.sids[idx[ok]] == sids[ok]
+        return idx, ok
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return iter(self.sids.tolist())
+
+    def __contains__(self, sid):
+        idx, ok = self._indices(numpy.array([sid]))
+        return bool(ok[0])
+
+    def __getitem__(self, sid):
+        idx, ok = self._indices(numpy.array([sid]))
+        if not ok[0]:
+            raise KeyError(sid)
+        return ProbabilityCurve(self.array[idx[0]])
+
+    def get(self, sid, default=None):
+        try:
+            return self[sid]
+        except KeyError:
+            return default
+
+    def items(self):
+        for sid, array in zip(self.sids.tolist(), self.array):
+            yield sid, ProbabilityCurve(array)
+
+    def filter(self, sids):
+        """
+        Extracts a submap of self for the given sids.
+        """
+        ok = numpy.isin(self.sids, sids)
+        return self.__class__(self.array[ok], self.sids[ok])
+
+    def extract(self, inner_idx):
+        """
+        Extracts a component of the underlying array, specified by the
+        index `inner_idx`.
+        """
+        return self.__class__(self.array[:, :, [inner_idx]], self.sids)
+
+    def convert(self, imtls, nsites, idx=0):
+        """
+        Convert a probability map into a composite array of length `nsites`
+        and dtype `imtls.dt`.
+
+        :param imtls:
+            DictArray instance
+        :param nsites:
+            the total number of sites
+        :param idx:
+            index on the z-axis (default 0)
+        """
+        curves = numpy.zeros(nsites, imtls.dt)
+        for imt in curves.dtype.names:
+            curves[imt][self.sids] = self.array[:, imtls(imt), idx]
+        return curves
+
+    def _union(self, other, fill):
+        # returns the union of the sids and two arrays aligned to it,
+        # where the missing curves are filled with the given value
+        sids = numpy.union1d(self.sids, other.sids).astype(numpy.uint32)
+        shape = (len(sids), self.shape_y, self.shape_z)
+        arrays = []
+        for pmap in (self, other):
+            if len(pmap.sids) == len(sids):
+                arrays.append(pmap.array)
+            else:
+                array = numpy.empty(shape, pmap.array.dtype)
+                array.fill(fill)
+                array[numpy.searchsorted(sids, pmap.sids)] = pmap.array
+                arrays.append(array)
+        return sids, arrays
+
+    def __ior__(self, other):
+        if not other:
+            return self
+        if (other.shape_y, other.shape_z) != (self.shape_y, self.shape_z):
+            raise ValueError('%s has inconsistent shape with %s' %
+                             (other, self))
+        sids, array = numpy.array(other.sids), other.array
+        rows = self._rows(sids)
+        ok = rows >= 0
+        if ok.any():
+            i = rows[ok]
+            self._array[i] = 1. - (1. - self._array[i]) * (1. - array[ok])
+        if not ok.all():
+            new = sids[~ok]
+            n = self._size
+            m = n + len(new)
+            if m > len(self._sids):  # grow the buffers geometrically
+                size = max(m, 2 * len(self._sids))
+                sids_ = numpy.empty(size, numpy.uint32)
+                sids_[:n] = self._sids[:n]
+                array_ = numpy.empty((size,) + self._array.shape[1:],
+                                     self._array.dtype)
+                array_[:n] = self._array[:n]
+                self._sids, self._array = sids_, array_
+            self._sids[n:m] = new
+            self._array[n:m] = array[~ok]
+            self._rowidx[new] = numpy.arange(n, m)
+            self._sorted = (self._sorted and
+                            (n == 0 or new[0] > self._sids[n - 1]) and
+                            (new[1:] > new[:-1]).all())
+            self._size = m
+        return self
+
+    def __or__(self, other):
+        new = self.__class__(self.array.copy(), self.sids)
+        new |= other
+        return new
+
+    __ror__ = __or__
+
+    def __mul__(self, other):
+        if isinstance(other, (ProbabilityMap, DenseProbabilityMap)):
+            sids, (arr1, arr2) = self._union(other, 1.)
+            return self.__class__(arr1 * arr2, sids)
+        assert 0. <= other <= 1., other  # must be a probability
+        return self.__class__(self.array * other, self.sids)
+
+    def __pow__(self, n):
+        return self.__class__(self.array ** n, self.sids)
+
+    def __invert__(self):
+        ok = (self.array != 1.).any(axis=(1, 2))  # store only nonzero probs
+        return self.__class__(1. - self.array[ok], self.sids[ok])
+
+    def __toh5__(self):
+        return dict(array=self.array, sids=self.sids), {}
+
+    def __fromh5__(self, dic, attrs):
+        self._array = dic['array'][()]
+        self._sids = dic['sids'][()]
+        self._size = len(self._sids)
+        self._sorted = True
+        self._rowidx = None
+
+    def __repr__(self):
+        return '<%s %d, %d, %d>' % (self.__class__.__name__, len(self),
+                                    self.shape_y, self.shape_z)
+
+
 def get_shape(pmaps):
     """
     :param pmaps: a set of homogenous ProbabilityMaps
@@ -20,11 +20,10 @@
 Module :mod:`openquake.hazardlib.site` defines :class:`Site`.
 """
 import numpy
-from shapely import geometry
 from openquake.baselib.general import (
     split_in_blocks, not_equal, get_duplicates)
 from openquake.hazardlib.geo.utils import (
-    fix_lon, cross_idl, _GeographicObjects, geohash)
+    fix_lon, cross_idl, _GeographicObjects, geohashes, within_region)
 from openquake.hazardlib.geo.mesh import Mesh
 
 U32LIMIT = 2 ** 32
@@ -361,14 +360,24 @@ class SiteCollection(object):
         return (self.depths == 0).all()
 
     # used in the engine when computing the hazard statistics
-    def split_in_tiles(self, hint):
+    def split_in_tiles(self, hint, by_locality=False):
         """
         Split a SiteCollection into a set of tiles (SiteCollection instances).
 
         :param hint: hint for how many tiles to generate
+        :param by_locality:
+            if True, order the sites along the Z-order curve of their
+            geohashes, so that each tile covers a compact region;
+            otherwise the tiles are contiguous ranges of site indices
         """
+        if not by_locality:
+            seqs = split_in_blocks(range(len(self)), hint or 1)
+        else:
+            order = numpy.argsort(self.geohash(8), kind='stable')
+            seqs = [numpy.sort(seq) for seq in numpy.array_split(
+                order, min(max(int(hint), 1), len(self)))]
         tiles = []
-        for seq in split_in_blocks(range(len(self)), hint or 1):
+        for seq in seqs:
             sc = SiteCollection.__new__(SiteCollection)
             sc.array = self.array[numpy.array(seq, int)]
             sc.complete = self
@@ -452,10 +461,7 @@ class SiteCollection(object):
         :param region: a shapely polygon
         :returns: a filtered SiteCollection of sites within the region
         """
-        mask = numpy.array([
-            geometry.Point(rec['lon'], rec['lat']).within(region)
-            for rec in self.array])
-        return self.filter(mask)
+        return self.filter(within_region(self.lons, self.lats, region))
 
     def within_bbox(self, bbox):
         """
@@ -478,9 +484,7 @@ class SiteCollection(object):
         :param length: length of the geohash in the range 1..8
         :returns: an array of N geohashes, one per site
         """
-        lst = [geohash(lon, lat, length)
-               for lon, lat in zip(self['lon'], self['lat'])]
-        return numpy.array(lst, (numpy.string_, length))
+        return geohashes(self['lon'], self['lat'], length)
 
     def num_geohashes(self, length):
         """
@@ -88,14 +88,21 @@ def quantile_curve(quantile, curves, weights=None):
     else:
         weights = numpy.array(weights)
         assert len(weights) == R, (len(weights), R)
-    result = numpy.zeros(curves.shape[1:])
-    for idx, _ in numpy.ndenumerate(result):
-        data = numpy.array([a[idx] for a in curves])
-        sorted_idxs = numpy.argsort(data)
-        cum_weights = numpy.cumsum(weights[sorted_idxs])
-        # get the quantile from the interpolated CDF
-        result[idx] = numpy.interp(quantile, cum_weights, data[sorted_idxs])
-    return result
+    # the quantile is interpolated from the CDF of each element,
+    # for all the elements at once
+    sorted_idxs = numpy.argsort(curves, axis=0)
+    data = numpy.take_along_axis(curves, sorted_idxs, axis=0)
+    cum_weights = numpy.cumsum(weights[sorted_idxs], axis=0)
+    # index of the first cumulative weight >= quantile
+    j = (cum_weights < quantile).sum(axis=0)[None]
+    hi = numpy.take_along_axis(data, numpy.minimum(j, R - 1), axis=0)[0]
+    lo = numpy.take_along_axis(data, numpy.maximum(j - 1, 0), axis=0)[0]
+    whi = numpy.take_along_axis(cum_weights, numpy.minimum(j, R - 1), 0)[0]
+    wlo = numpy.take_along_axis(cum_weights, numpy.maximum(j - 1, 0), 0)[0]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        frac = numpy.clip((quantile - wlo) / (whi - wlo), 0., 1.)
+    frac = numpy.where((j[0] == 0) | (j[0] == R) | (whi == wlo), 1., frac)
+    return lo + (hi - lo) * frac
 
 
 def max_curve(values, weights=None):
@@ -28,6 +28,8 @@ from openquake.hazardlib.imt import PGA, SA
 from openquake.hazardlib.site import Site
 from openquake.hazardlib.gsim.bradley_2013 import Bradley2013
 from openquake.hazardlib import sourceconverter
+from openquake.hazardlib.contexts import RuptureContext
+from openquake.hazardlib.tom import PoissonTOM
 
 DATA_PATH = os.path.dirname(__file__)
 
@@ -117,6 +119,54 @@ class DisaggregateTestCase(unittest.TestCase):
         aaae(matrix.sum(), 6.14179818e-11)
 
 
+class DisaggBySiteTestCase(unittest.TestCase):
+    # the vectorized multi-site kernel must agree with the single-site one
+    def test_same_as_disaggregate(self):
+        RuptureContext.temporal_occurrence_model = PoissonTOM(50)
+        rng = numpy.random.default_rng(42)
+        N, M, P, Z, G = 5, 2, 2, 3, 2
+        ctxs = []
+        for u in range(20):
+            ctx = RuptureContext()
+            ctx.sids = numpy.sort(rng.choice(N, rng.integers(1, N + 1),
+                                             replace=False))
+            n = len(ctx.sids)
+            ctx.rrup = rng.random(n) * 100
+            ctx.clon = rng.random(n) * 2 - 1
+            ctx.clat = rng.random(n) * 2 - 1
+            ctx.mean_std = numpy.array([rng.normal(-2, .5, (n, M, G)),
+                                        rng.random((n, M, G)) * .5 + .3])
+            ctx.idx = {sid: i for i, sid in enumerate(ctx.sids)}
+            if u % 7 == 0:  # nonparametric rupture
+                ctx.occurrence_rate = numpy.nan
+                ctx.probs_occur = numpy.array([.6, .3, .1])
+            else:
+                ctx.occurrence_rate = rng.random() * 1E-3
+            ctxs.append(ctx)
+        imts = [PGA(), SA(1.0)]
+        hmap4 = rng.random((N, M, P, Z)) * .3
+        hmap4[2, 1, 0, 1] = 0  # zero hazard
+        gidx = numpy.array([[(s + z) % G for z in range(Z)]
+                            for s in range(N)])
+        gidx[3] = -1  # no gsims for site 3
+        gidx[4, 2] = -1
+        eps3 = disagg._eps3(3, 4)
+        dist_edges = numpy.arange(0, 110, 10.)
+        edges = {s: numpy.linspace(-1, 1, 5) for s in range(N)}
+        bin_edges = dist_edges, edges, edges, eps3[1]
+        # using a tiny memory budget to have many blocks
+        res = dict(disagg.disagg_by_site(
+            ctxs, numpy.log(hmap4), gidx, eps3, bin_edges, maxsize=1000))
+        self.assertEqual(sorted(res), [0, 1, 2, 4])
+        for sid in res:
+            g_by_z = {z: g for z, g in enumerate(gidx[sid]) if g >= 0}
+            mat = disagg.disaggregate(
+                [ctx for ctx in ctxs if sid in ctx.idx], g_by_z,
+                dict(zip(imts, hmap4[sid])), eps3, sid,
+                (dist_edges, edges[sid], edges[sid], eps3[1]))
+            numpy.testing.assert_allclose(res[sid], mat)
+
+
 class PMFExtractorsTestCase(unittest.TestCase):
     def setUp(self):
         super().setUp()
@@ -16,14 +16,26 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import copy
 import unittest
+import numpy
 from numpy.testing import assert_almost_equal as aae
-from openquake.baselib.general import gettemp
+from openquake.baselib.general import gettemp, DictArray
 from openquake.hazardlib import nrml
+from openquake.hazardlib.const import TRT
+from openquake.hazardlib.geo import NodalPlane
 from openquake.hazardlib.geo.point import Point
+from openquake.hazardlib.mfd import TruncatedGRMFD
+from openquake.hazardlib.pmf import PMF
+from openquake.hazardlib.scalerel import WC1994
+from openquake.hazardlib.source import PointSource
+from openquake.hazardlib.tom import PoissonTOM
+from openquake.hazardlib.gsim.sadigh_1997 import SadighEtAl1997
+from openquake.hazardlib.calc.hazard_curve import classical
 from openquake.hazardlib.site import Site, SiteCollection
 from openquake.hazardlib.calc.filters import (
-    MagDepDistance, SourceFilter, angular_distance, split_sources)
+    MagDepDistance, SourceFilter, SiteIndex, angular_distance,
+    split_sources)
 
 
 class AngularDistanceTestCase(unittest.TestCase):
@@ -56,6 +68,84 @@ class SourceFilterTestCase(unittest.TestCase):
         sites = srcfilter.get_close_sites(src)
         self.assertIsNotNone(sites)
 
+    def test_tiles(self):
+        # filtering tile by tile gives the same sites as the full filter
+        fname = gettemp(characteric_source)
+        [[src]] = nrml.to_python(fname)
+        os.remove(fname)
+        rng = numpy.random.default_rng(42)
+        sitecol = SiteCollection.from_points(
+            rng.uniform(160, 179, 1000), rng.uniform(-55, -25, 1000))
+        srcfilter = SourceFilter(sitecol, MagDepDistance.new('100'))
+        [expected] = srcfilter.filter([copy.copy(src)])
+        sids = []
+        tiles = sitecol.split_in_tiles(10, by_locality=True)
+        for tile in tiles:
+            for s in srcfilter.restrict(tile.sids).filter([copy.copy(src)]):
+                sids.extend(s.indices)
+        numpy.testing.assert_equal(sorted(sids), expected.indices)
+        # the source affects less than half of the tiles
+        self.assertLess(
+            sum(1 for tile in tiles if srcfilter.restrict(
+                tile.sids).get_close_sites(copy.copy(src)) is not None), 5)
+
+    def test_tiled_curves(self):
+        # the same source object is sent to all tiles, as it happens
+        # without pickling: the tiled curves must be the untiled ones
+        src = PointSource(
+            'P', 'point', TRT.ACTIVE_SHALLOW_CRUST,
+            TruncatedGRMFD(a_val=3, b_val=1, min_mag=5, max_mag=7,
+                           bin_width=.5),
+            2., WC1994(), 1.5, PoissonTOM(50.), 0., 20., Point(0, 0),
+            PMF([(1., NodalPlane(0, 90, 0))]), PMF([(1., 10.)]))
+        sitecol = SiteCollection([
+            Site(Point(lon, 0), 760., z1pt0=40., z2pt5=1.)
+            for lon in [0, .1, .2, 2, 2.1, 2.2]])
+        srcfilter = SourceFilter(sitecol, MagDepDistance.new('300'))
+        gsims = [SadighEtAl1997()]
+        param = dict(imtls=DictArray({'PGA': [.01, .1, .2]}),
+                     truncation_level=3.)
+        [expected] = classical(
+            [copy.copy(src)], srcfilter, gsims, dict(param))['pmap'].values()
+        tiles = sitecol.split_in_tiles(2, by_locality=True)
+        self.assertEqual(len(tiles), 2)
+        pmap = None
+        for tile in tiles:
+            [pm] = classical([src], srcfilter.restrict(tile.sids), gsims,
+                             dict(param))['pmap'].values()
+            self.assertEqual(sorted(pm), list(tile.sids))
+            pmap = pm if pmap is None else pmap | pm
+        self.assertEqual(sorted(pmap), sorted(expected))
+        for sid in expected:
+            aae(pmap[sid].array, expected[sid].array)
+
+
+class SiteIndexTestCase(unittest.TestCase):
+    # the index must give the same results as SiteCollection.within_bbox
+    def check(self, lons, lats, bboxes):
+        sitecol = SiteCollection.from_points(lons, lats)
+        index = SiteIndex(lons, lats)
+        indices, offsets = index.query_many(bboxes)
+        for b, bbox in enumerate(bboxes):
+            numpy.testing.assert_equal(
+                indices[offsets[b]:offsets[b + 1]], sitecol.within_bbox(bbox))
+
+    def test_random(self):
+        rng = numpy.random.default_rng(42)
+        lons = rng.uniform(-30, 40, 2000)
+        lats = rng.uniform(-10, 50, 2000)
+        corners = rng.uniform([-40, -20], [50, 60], (100, 2))
+        sizes = rng.uniform(0, 20, (100, 2))
+        self.check(lons, lats, numpy.hstack([corners, corners + sizes]))
+
+    def test_international_date_line(self):
+        rng = numpy.random.default_rng(42)
+        lons = rng.uniform(170, 190, 500)
+        lons[lons > 180] -= 360
+        lats = rng.uniform(-50, -30, 500)
+        self.check(lons, lats, [(175, -45, -175, -35), (-179, -50, -170, 0),
+                                (-175, -45, 175, -35), (170, -40, 179, -30)])
+
 
 # from https://groups.google.com/d/msg/openquake-users/P03SxJsfW_s/nCdcxj8WAAAJ
 characteric_source = '''\
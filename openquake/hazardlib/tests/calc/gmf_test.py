@@ -0,0 +1,100 @@
+# The Hazard Library
+# Copyright (C) 2020 GEM Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+import numpy
+from openquake.hazardlib import const
+from openquake.hazardlib.calc.gmf import GmfComputer
+from openquake.hazardlib.contexts import ContextMaker
+from openquake.hazardlib.geo import Point, Line
+from openquake.hazardlib.geo.surface import SimpleFaultSurface
+from openquake.hazardlib.gsim.boore_atkinson_2008 import BooreAtkinson2008
+from openquake.hazardlib.gsim.akkar_bommer_2010 import AkkarBommer2010
+from openquake.hazardlib.site import Site, SiteCollection
+from openquake.hazardlib.source.rupture import (
+    ParametricProbabilisticRupture, EBRupture)
+from openquake.hazardlib.tom import PoissonTOM
+
+
+def make_ebrupture(n_occ):
+    surface = SimpleFaultSurface.from_fault_data(
+        Line([Point(0, 0), Point(0.3, 0)]), 3., 15., dip=90.,
+        mesh_spacing=2.)
+    rup = ParametricProbabilisticRupture(
+        mag=6.5, rake=180.,
+        tectonic_region_type=const.TRT.ACTIVE_SHALLOW_CRUST,
+        hypocenter=Point(0.15, 0, 9.), surface=surface, occurrence_rate=.01,
+        temporal_occurrence_model=PoissonTOM(50))
+    rup.rup_id = 42
+    ebr = EBRupture(rup, 'src', 0, n_occ)
+    ebr.e0 = 100
+    return ebr
+
+
+def compute_all_loop(computer, min_iml, rlzs_by_gsim, sig_eps):
+    # reference implementation looping on realizations, events and sites
+    eids_by_rlz = computer.ebrupture.get_eids_by_rlz(rlzs_by_gsim)
+    data = []
+    for gs, rlzs in rlzs_by_gsim.items():
+        num_events = sum(len(eids_by_rlz[rlzi]) for rlzi in rlzs)
+        array, sig, eps = computer.compute(gs, num_events)
+        array = array.transpose(1, 0, 2)
+        for i, miniml in enumerate(min_iml):
+            arr = array[:, i, :]
+            arr[arr < miniml] = 0
+        n = 0
+        for rlzi in rlzs:
+            eids = eids_by_rlz[rlzi] + computer.e0
+            for ei, eid in enumerate(eids):
+                gmf = array[:, :, n + ei]
+                if not gmf.sum():
+                    continue
+                sig_eps.append(tuple([eid, rlzi] + list(sig[:, n + ei]) +
+                                     list(eps[:, n + ei])))
+                for sid, gmv in zip(computer.sids, gmf):
+                    if gmv.sum():
+                        data.append((sid, eid, gmv))
+            n += len(eids)
+    return data
+
+
+class GmfComputerTestCase(unittest.TestCase):
+    def test_compute_all(self):
+        sites = SiteCollection(
+            [Site(Point(lon, lat), 760., z1pt0=40., z2pt5=1.)
+             for lon in numpy.linspace(-.5, .8, 7)
+             for lat in numpy.linspace(-.4, .4, 5)])
+        gsims = [AkkarBommer2010(), BooreAtkinson2008()]
+        imtls = {'PGA': [.1], 'SA(1.0)': [.1]}
+        cmaker = ContextMaker(const.TRT.ACTIVE_SHALLOW_CRUST, gsims,
+                              dict(imtls=imtls, truncation_level=3.))
+        computer = GmfComputer(make_ebrupture(n_occ=20), sites, list(imtls),
+                               cmaker, truncation_level=3.)
+        rlzs_by_gsim = {gsims[0]: [0, 2], gsims[1]: [1]}
+        min_iml = [.05, .02]  # discard many small ground motion values
+        sig_eps = []
+        data, _dt = computer.compute_all(min_iml, rlzs_by_gsim, sig_eps)
+        expected_sig_eps = []
+        expected = compute_all_loop(
+            computer, min_iml, rlzs_by_gsim, expected_sig_eps)
+        self.assertGreater(len(data), 0)
+        self.assertLess(len(data), 60 * len(sites))  # some zeros discarded
+        self.assertEqual(len(data), len(expected))
+        for row, (sid, eid, gmv) in zip(data, expected):
+            self.assertEqual(row['sid'], sid)
+            self.assertEqual(row['eid'], eid)
+            numpy.testing.assert_array_equal(row['gmv'], gmv)
+        numpy.testing.assert_array_equal(
+            numpy.array(sig_eps), numpy.array(expected_sig_eps))
@@ -21,7 +21,9 @@ import numpy
 from openquake.baselib.general import DictArray
 from openquake.hazardlib.tom import PoissonTOM
 from openquake.hazardlib.contexts import (
-    Effect, RuptureContext, _collapse, make_pmap)
+    Effect, RuptureContext, ContextMaker, _collapse, make_pmap, get_pnes)
+from openquake.hazardlib.gsim.atkinson_boore_2006 import AtkinsonBoore2006
+from openquake.hazardlib.gsim.toro_2002 import ToroEtAl2002
 from openquake.hazardlib import valid
 
 aac = numpy.testing.assert_allclose
@@ -46,6 +48,57 @@ class EffectTestCase(unittest.TestCase):
         numpy.testing.assert_allclose(dist, [0, 10, 13.225806, 16.666667])
 
 
+class GsimTableTestCase(unittest.TestCase):
+    def test_get_mean_std(self):
+        gsims = [AtkinsonBoore2006(), ToroEtAl2002()]
+        imtls = {'PGA': [.1, .2], 'SA(0.2)': [.1, .2]}
+        cmaker = ContextMaker('TRT', gsims, dict(
+            imtls=imtls, gsim_table_tolerance=.001,
+            maximum_distance=valid.MagDepDistance.new('300')))
+        self.assertEqual(len(cmaker.gsim_tables), 2)
+        ctxs = []
+        for mag, vs30 in [(5.05, 760.), (6.15, 760.), (5.05, 400.)]:
+            ctx = RuptureContext([('mag', mag)])
+            ctx.rrup = ctx.rjb = numpy.array([0., 3.5, 12.3, 77.7, 290.])
+            ctx.vs30 = numpy.full(5, vs30)
+            ctx.sids = numpy.arange(5)
+            ctxs.append(ctx)
+        expected = numpy.concatenate(
+            [ctx.get_mean_std(cmaker.imts, gsims) for ctx in ctxs], axis=1)
+        aac(cmaker.get_mean_std(ctxs), expected, atol=.001)
+        # 760 is a vs30 node, while 400 is interpolated between two nodes
+        self.assertEqual(len(cmaker.gsim_tables[gsims[0]].tables), 4)
+        self.assertEqual(len(cmaker.gsim_tables[gsims[1]].tables), 2)
+
+    def test_continuous_vs30(self):
+        gsims = [AtkinsonBoore2006()]
+        imtls = {'PGA': [.1, .2], 'SA(0.2)': [.1, .2]}
+        cmaker = ContextMaker('TRT', gsims, dict(
+            imtls=imtls, gsim_table_tolerance=.001,
+            maximum_distance=valid.MagDepDistance.new('300')))
+        rng = numpy.random.default_rng(42)
+        ctxs = []
+        for mag in (5.05, 6.15):
+            ctx = RuptureContext([('mag', mag)])
+            ctx.rrup = rng.uniform(0, 300, 1000)
+            ctx.vs30 = rng.uniform(150, 1500, 1000)
+            ctx.sids = numpy.arange(1000)
+            ctxs.append(ctx)
+        expected = numpy.concatenate(
+            [ctx.get_mean_std(cmaker.imts, gsims) for ctx in ctxs], axis=1)
+        table = cmaker.gsim_tables[gsims[0]]
+        aac(cmaker.get_mean_std(ctxs), expected, atol=table.tolerance)
+        # the tables are bounded by the vs30 nodes, not by the sites
+        nodes = sum(len(ys) for ys in table.nodes.values())
+        self.assertLessEqual(len(table.tables), nodes)
+
+        # the oldest tables are discarded when exceeding MAX_TABLES
+        table.MAX_TABLES = 10
+        table.tables.clear()
+        aac(cmaker.get_mean_std(ctxs), expected, atol=table.tolerance)
+        self.assertEqual(len(table.tables), 10)
+
+
 def compose(ctxs, poe):
     pnes = [ctx.get_probability_no_exceedance(poe) for ctx in ctxs]
     return 1. - numpy.prod(pnes), pnes
@@ -88,6 +141,19 @@ class CollapseTestCase(unittest.TestCase):
             c2, pnes2 = compose(_collapse(ctxs), poe)
             aac(c1, c2)  # the same
 
+    def test_get_pnes(self):
+        # the vectorized pnes are the same as the ones context by context
+        ctxs = [RuptureContext([('occurrence_rate', .001)]),
+                RuptureContext([('occurrence_rate', numpy.nan),
+                                ('probs_occur', [.999, .001])]),
+                RuptureContext([('occurrence_rate', .002)])]
+        sizes = [2, 1, 3]
+        poes = numpy.random.random((6, 4, 2))
+        expected = numpy.concatenate([
+            ctx.get_probability_no_exceedance(poes[start: start + size])
+            for ctx, start, size in zip(ctxs, [0, 2, 3], sizes)])
+        aac(get_pnes(ctxs, sizes, poes), expected)
+
     def test_make_pmap(self):
         trunclevel = 3
         imtls = DictArray({'PGA': [0.01]})
@@ -19,7 +19,8 @@ import numpy
 
 from openquake.hazardlib.imt import SA, PGA
 from openquake.hazardlib.correlation import JB2009CorrelationModel, \
-                                            HM2018CorrelationModel
+                                            HM2018CorrelationModel, \
+                                            get_vecchia_factor
 from openquake.hazardlib.site import Site, SiteCollection
 from openquake.hazardlib.geo import Point
 
@@ -100,6 +101,32 @@ class JB2009CorrelationMatrixTestCase(unittest.TestCase):
         self.assertTrue((corma == corma2).all())
 
 
+class VecchiaTestCase(unittest.TestCase):
+    SITECOL = SiteCollection([Site(Point(2, -40), 1, 1, 1),
+                              Site(Point(2, -40.1), 1, 1, 1),
+                              Site(Point(2.1, -40), 1, 1, 1),
+                              Site(Point(2, -39.9), 1, 1, 1)])
+
+    def test_exact(self):
+        # conditioning on all the previous sites the approximation is exact
+        cormo = JB2009CorrelationModel(vs30_clustering=False)
+        A, sqrtd = get_vecchia_factor(
+            self.SITECOL, lambda d: cormo._get_correlation_matrix(d, PGA()),
+            num_neighbours=3)
+        L = numpy.linalg.inv(A.toarray()) * sqrtd
+        aaae(L @ L.T, cormo._get_correlation_matrix(self.SITECOL, PGA()))
+
+    def test_apply_correlation(self):
+        numpy.random.seed(13)
+        cormo = JB2009CorrelationModel(vs30_clustering=False,
+                                       num_neighbours=2)
+        sampled = numpy.random.normal(size=(4, 100000))
+        correlated = cormo.apply_correlation(self.SITECOL, PGA(), sampled)
+        self.assertAlmostEqual(correlated.std(), 1, delta=0.005)
+        actual = cormo._get_correlation_matrix(self.SITECOL, PGA())
+        aaae(numpy.corrcoef(correlated), actual, decimal=2)
+
+
 class JB2009LowerTriangleCorrelationMatrixTestCase(unittest.TestCase):
     SITECOL = SiteCollection([Site(Point(2, -40), 1, 1, 1),
                               Site(Point(2, -40.1), 1, 1, 1),
@@ -154,6 +154,25 @@ class TestDistance(unittest.TestCase):
         self.assertAlmostEqual(distance, 65.0295143)
 
 
+class CdistMinTestCase(unittest.TestCase):
+    def test_blocks(self):
+        # the results must not depend on the memory ceiling
+        a = numpy.random.RandomState(42).random_sample((100, 3))
+        b = numpy.random.RandomState(43).random_sample((250, 3))
+        mins = geodetic.cdist_min(a, b)
+        idxs = geodetic.cdist_argmin(a, b)
+        orig = geodetic.MAX_DISTANCES
+        try:
+            for maxsize in (1, 150, 1000):
+                geodetic.MAX_DISTANCES = maxsize
+                numpy.testing.assert_equal(geodetic.cdist_min(a, b), mins)
+                numpy.testing.assert_equal(geodetic.cdist_argmin(a, b), idxs)
+        finally:
+            geodetic.MAX_DISTANCES = orig
+        numpy.testing.assert_allclose(
+            mins, numpy.linalg.norm(a[idxs] - b, axis=1))
+
+
 class MinDistanceToSegmentTest(unittest.TestCase):
 
     def setUp(self):
@@ -19,7 +19,7 @@ import collections
 import numpy
 import shapely.geometry
 
-from openquake.hazardlib import geo
+from openquake.hazardlib import geo, site
 from openquake.hazardlib.geo import utils
 
 Point = collections.namedtuple("Point",  'lon lat')
@@ -438,4 +438,60 @@ class PlaneFit(unittest.TestCase):
         self.assertAlmostEqual(self.c[-1], -sum(par*pnt), 2)
 
 
+class VectorizedTestCase(unittest.TestCase):
+    # the vectorized functions must agree with the scalar versions
+    def setUp(self):
+        rng = numpy.random.default_rng(42)
+        self.lons = rng.uniform(-180, 180, 1000)
+        self.lats = rng.uniform(-90, 90, 1000)
+        self.lons[:3] = [0, 180, 10]  # points on the bisections
+        self.lats[:3] = [0, -90, 45]
+
+    def test_geohashes(self):
+        for length in (1, 5, 8):
+            expected = [utils.geohash(lon, lat, length)
+                        for lon, lat in zip(self.lons, self.lats)]
+            self.assertEqual(
+                list(utils.geohashes(self.lons, self.lats, length)), expected)
+
+    def test_within_region(self):
+        region = shapely.geometry.Polygon(
+            [(-100, -50), (100, -50), (100, 60), (-100, 60)],
+            [[(-10, -10), (10, -10), (10, 10), (-10, 10)]])  # with a hole
+        expected = [shapely.geometry.Point(lon, lat).within(region)
+                    for lon, lat in zip(self.lons, self.lats)]
+        self.assertEqual(
+            list(utils.within_region(self.lons, self.lats, region)), expected)
+
+    def test_get_closest_many(self):
+        sites = geo.Mesh(self.lons[:100], self.lats[:100])
+        objs = utils._GeographicObjects(sites)
+        idxs, dists = objs.get_closest_many(
+            self.lons, self.lats, chunksize=300)  # 4 chunks
+        for lon, lat, idx, dist in zip(self.lons, self.lats, idxs, dists):
+            expected_dist = objs.kdtree.query(
+                utils.spherical_to_cartesian(lon, lat))[0]
+            self.assertAlmostEqual(dist, expected_dist)
+        numpy.testing.assert_equal(idxs[:100], numpy.arange(100))
+
+    def test_assoc_assets(self):
+        sitecol = site.SiteCollection.from_points([0, 1, 2], [0, 0, 0])
+        assets = numpy.zeros(4, [('id', 'S20'), ('lon', numpy.float32),
+                                 ('lat', numpy.float32),
+                                 ('site_id', numpy.uint32)])
+        assets['id'] = [b'a0', b'a1', b'a2', b'a3']
+        assets['lon'] = [2.01, 0.01, 5, 2.01]
+        assets['site_id'] = [1, 0, 2, 1]
+        sites, assoc, discarded = utils.assoc(sitecol, sitecol, 10, 'filter')
+        self.assertEqual(len(sites), 3)
+        sites, assoc, discarded = utils.assoc(assets, sitecol, 10, 'filter')
+        numpy.testing.assert_equal(sites.sids, [0, 2])
+        numpy.testing.assert_equal(assoc['id'], [b'a1', b'a0', b'a3'])
+        numpy.testing.assert_equal(assoc['site_id'], [0, 2, 2])
+        self.assertEqual(list(discarded['asset_ref']), ['a2'])
+        numpy.testing.assert_equal(assets['site_id'], [1, 0, 2, 1])
+        with self.assertRaises(utils.SiteAssociationError):
+            utils.assoc(assets, sitecol, 10, 'strict')
+
+
 # NB: utils.assoc is tested in the engine
@@ -159,9 +159,9 @@ class MakeContextsTestCase(_FakeGSIMTestCase):
         self.gsim_class.DEFINED_FOR_TECTONIC_REGION_TYPE = const.TRT.VOLCANIC
         self.fake_surface = FakeSurface
 
-    def make_contexts(self, site_collection, rupture):
+    def make_contexts(self, site_collection, rupture, cache=None):
         return ContextMaker('faketrt', [self.gsim_class]).make_contexts(
-            site_collection, rupture)
+            site_collection, rupture, cache)
 
     def test_unknown_distance_error(self):
         self.gsim_class.REQUIRES_DISTANCES = frozenset(
@@ -230,6 +230,25 @@ class MakeContextsTestCase(_FakeGSIMTestCase):
                           'get_joyner_boore_distance': 1,
                           'get_rx_distance': 1, 'get_strike': 1})
 
+    def test_cache(self):
+        self.gsim_class.REQUIRES_DISTANCES = set('rjb rx'.split())
+        self.gsim_class.REQUIRES_RUPTURE_PARAMETERS = set()
+        self.gsim_class.REQUIRES_SITES_PARAMETERS = set()
+        sites = SiteCollection([self.site1, self.site2])
+        self.rupture.rup_id = 42
+        cache = {}
+        self.make_contexts(sites, self.rupture, cache)
+        self.assertEqual(sorted(cache[42][1]), ['rjb', 'rrup', 'rx'])
+        # the second time the distances are not recomputed
+        rctx, sctx, dctx = self.make_contexts(sites, self.rupture, cache)
+        aac(sctx.sids, [0, 1])
+        aac(dctx.rx, (4, 5))
+        aac(dctx.rjb, (6, 7))
+        self.assertEqual(self.fake_surface.call_counts,
+                         {'get_min_distance': 1,
+                          'get_joyner_boore_distance': 1,
+                          'get_rx_distance': 1})
+
 
 class ContextTestCase(unittest.TestCase):
     def test_equality(self):
@@ -18,7 +18,8 @@
 
 import unittest
 import numpy
-from openquake.hazardlib.probability_map import ProbabilityMap
+from openquake.hazardlib.probability_map import (
+    ProbabilityMap, DenseProbabilityMap)
 
 
 class ProbabilityMapTestCase(unittest.TestCase):
@@ -40,3 +41,51 @@ class ProbabilityMapTestCase(unittest.TestCase):
         # test pmap power
         pmap = pmap1 ** 2
         numpy.testing.assert_almost_equal(pmap[0].array, [[.16], [0], [0]])
+
+
+class DenseProbabilityMapTestCase(unittest.TestCase):
+    def test_same_as_pmap(self):
+        pmap1 = ProbabilityMap.build(3, 2, sids=[0, 1, 2])
+        pmap1[0].array[0] = .4
+        pmap1[2].array[1] = .1
+        pmap2 = ProbabilityMap.build(3, 2, sids=[1, 3])
+        pmap2[1].array[0] = .5
+        pmap2[3].array[2] = 1.
+        dense1 = DenseProbabilityMap.from_pmap(pmap1)
+        dense2 = DenseProbabilityMap.from_pmap(pmap2)
+
+        def aac(dense, pmap):
+            numpy.testing.assert_equal(dense.sids, pmap.sids)
+            numpy.testing.assert_almost_equal(dense.array, pmap.array)
+
+        aac(dense1 | dense2, pmap1 | pmap2)
+        aac(dense1 | pmap2, pmap1 | pmap2)
+        aac(dense1 * dense2, pmap1 * pmap2)
+        aac(~dense2, ~pmap2)
+        aac(dense1.extract(1), pmap1.extract(1))
+        aac(dense1.filter([1, 2, 5]), pmap1.filter([1, 2, 5]))
+        self.assertEqual(list(dense1), [0, 1, 2])
+        self.assertNotIn(3, dense1)
+
+        # the curves are views over the underlying array
+        dense1[1].array[:] = .2
+        self.assertEqual(dense1.array[1].sum(), 1.2)
+
+    def test_accumulate(self):
+        # the result does not depend on the growth of the buffers
+        rng = numpy.random.default_rng(42)
+        acc = DenseProbabilityMap.build(3, 2, [])
+        expected = ProbabilityMap(3, 2)
+        for i in range(20):
+            sids = numpy.unique(rng.integers(0, 100, 10))
+            pmap = ProbabilityMap.build(3, 2, sids)
+            for sid in sids:
+                pmap[sid].array[:] = rng.random((3, 2))
+            acc |= pmap
+            expected |= pmap
+            self.assertEqual(len(acc), len(expected))
+            if i % 5 == 0:  # reading sorts the buffers
+                self.assertEqual(list(acc), sorted(expected))
+        numpy.testing.assert_equal(acc.sids, sorted(expected))
+        numpy.testing.assert_almost_equal(
+            acc.array, numpy.array([expected[sid].array for sid in acc]))
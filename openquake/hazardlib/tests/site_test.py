@@ -147,6 +147,9 @@ class SiteCollectionCreationTestCase(unittest.TestCase):
         tiles = cll.split_in_tiles(2)
         self.assertEqual(len(tiles), 2)
 
+        tiles = cll.split_in_tiles(2, by_locality=True)
+        self.assertEqual(sorted(sid for t in tiles for sid in t.sids), [0, 1])
+
         # test geohash
         assert_eq(cll.geohash(4), numpy.array([b's5x1', b'7zrh']))
 
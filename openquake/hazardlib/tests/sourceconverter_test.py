@@ -253,6 +253,28 @@ class SourceConverterTestCase(unittest.TestCase):
         self.assertEqual(
             'There were repeated values %s in %s:%s', w.call_args[0][0])
 
+    def test_split_source_model(self):
+        # reading a source model in blocks gives the same groups
+        testfile = os.path.join(testdir, 'mixed.xml')
+        sc = SourceConverter(area_source_discretization=10.)
+        sm = nrml.to_python(testfile, sc)
+        blocks = nrml.split_source_model(testfile, blocksize=1000)
+        self.assertGreater(len(blocks), len(sm))
+        sms = [nrml.read_source_block(testfile, b, sc) for b in blocks]
+        sm2 = nrml.merge_source_model(blocks, sms)
+        self.assertEqual([(sg.trt, [s.source_id for s in sg]) for sg in sm],
+                         [(sg.trt, [s.source_id for s in sg]) for sg in sm2])
+
+    def test_split_source_model_lineno(self):
+        # the line numbers in the error messages are preserved
+        testfile = os.path.join(testdir, 'wrong-trt.xml')
+        blocks = nrml.split_source_model(testfile, blocksize=1)
+        self.assertEqual(len(blocks), 2)
+        with self.assertRaises(ValueError) as ctx:
+            nrml.read_source_block(testfile, blocks[1], SourceConverter())
+        self.assertIn('node pointSource: Found Cratonic, expected '
+                      'Active Shallow Crust, line 67', str(ctx.exception))
+
     def test_dupl_values_hddist(self):
         testfile = os.path.join(testdir, 'wrong-hddist.xml')
         with unittest.mock.patch('logging.warning') as w:
@@ -21,7 +21,7 @@ import logging
 import csv
 import os
 import numpy
-from shapely import wkt, geometry
+from shapely import wkt
 
 from openquake.baselib import hdf5, general
 from openquake.baselib.node import Node, context
@@ -348,13 +348,17 @@ class TagCollection(object):
 
 
 class AssetCollection(object):
-    def __init__(self, exposure, assets_by_site, time_event):
+    def __init__(self, exposure, array, tot_sites, time_event=None):
         self.tagcol = exposure.tagcol
-        self.tagcol.site_id = ['?'] + list(range(len(assets_by_site)))
+        self.tagcol.site_id = ['?'] + list(range(tot_sites))
         self.time_event = time_event
-        self.tot_sites = len(assets_by_site)
-        self.array, self.occupancy_periods = build_asset_array(
-            assets_by_site, exposure.tagcol.tagnames, time_event)
+        self.tot_sites = tot_sites
+        self.array = array[numpy.argsort(array['site_id'], kind='stable')]
+        self.array['ordinal'] = numpy.arange(len(self.array))
+        # see scenario_risk test_case_2d for the discarded occupants_None
+        self.occupancy_periods = ' '.join(
+            f[10:] for f in self.array.dtype.names
+            if f.startswith('occupants_') and f != 'occupants_None')
         exp_periods = exposure.occupancy_periods
         if self.occupancy_periods and not exp_periods:
             logging.warning('Missing <occupancyPeriods>%s</occupancyPeriods> '
@@ -480,9 +484,7 @@ class AssetCollection(object):
         """
         :returns: a reduced AssetCollection on the given sitecol
         """
-        ok_indices = numpy.sum(
-            [self.array['site_id'] == sid for sid in sitecol.sids],
-            axis=0, dtype=bool)
+        ok_indices = numpy.isin(self.array['site_id'], sitecol.sids)
         new = object.__new__(self.__class__)
         vars(new).update(vars(self))
         new.array = self.array[ok_indices]
@@ -500,12 +502,14 @@ class AssetCollection(object):
             # do not reduce the assetcol, just fix the site IDs
             self.array['site_id'] = numpy.arange(len(uniq))[inv]
         else:  # the sitecol is shorter, like in case_shakemap
-            arrays = []
-            for idx, sid in enumerate(sitecol.sids):
-                arr = self[self['site_id'] == sid]
-                arr['site_id'] = idx
-                arrays.append(arr)
-            self.array = numpy.concatenate(arrays)
+            idx = numpy.zeros(max(uniq.max(), sitecol.sids.max()) + 1, int)
+            idx[:] = -1
+            idx[sitecol.sids] = numpy.arange(len(sitecol))
+            new_sids = idx[self['site_id']]
+            ok, = numpy.where(new_sids >= 0)
+            order = ok[numpy.argsort(new_sids[ok], kind='stable')]
+            self.array = self.array[order]
+            self.array['site_id'] = new_sids[order]
             self.array['ordinal'] = numpy.arange(len(self.array))
             self.tot_sites = len(sitecol)
         sitecol.make_complete()
@@ -545,28 +549,19 @@ class AssetCollection(object):
         return '<%s with %d asset(s)>' % (self.__class__.__name__, len(self))
 
 
-def build_asset_array(assets_by_site, tagnames=(), time_event=None):
+def build_asset_array(assets, tagnames=(), time_event=None):
     """
-    :param assets_by_site: a list of lists of assets
+    :param assets: a list of assets
     :param tagnames: a list of tag names
-    :returns: an array `assetcol`
+    :returns: an array `assetcol` with the site_id field set to 0
     """
-    for assets in assets_by_site:
-        if len(assets):
-            first_asset = assets[0]
-            break
-    else:  # no break
+    if not assets:
         raise ValueError('There are no assets!')
+    first_asset = assets[0]
     loss_types = []
-    occupancy_periods = []
     for name in sorted(first_asset.values):
         if name.startswith('occupants_'):
-            period = name.split('_', 1)[1]
-            if period != 'None':
-                # see scenario_risk test_case_2d
-                occupancy_periods.append(period)
             loss_types.append(name)
-            # discard occupants for different time periods
         else:
             loss_types.append('value-' + name)
     # loss_types can be ['value-business_interruption', 'value-contents',
@@ -580,41 +575,34 @@ def build_asset_array(assets_by_site, tagnames=(), time_event=None):
         [('id', '<S20'), ('ordinal', U32), ('lon', F32), ('lat', F32),
          ('site_id', U32), ('number', F32), ('area', F32)] + [
              (str(name), float) for name in float_fields] + int_fields)
-    num_assets = sum(len(assets) for assets in assets_by_site)
+    num_assets = len(assets)
     assetcol = numpy.zeros(num_assets, asset_dt)
-    asset_ordinal = 0
-    fields = set(asset_dt.fields)
-    for sid, assets_ in enumerate(assets_by_site):
-        for asset in assets_:
-            asset.ordinal = asset_ordinal
-            record = assetcol[asset_ordinal]
-            asset_ordinal += 1
-            for field in fields:
-                if field == 'id':
-                    value = asset.asset_id
-                elif field == 'ordinal':
-                    value = asset.ordinal
-                elif field == 'number':
-                    value = asset.number
-                elif field == 'area':
-                    value = asset.area
-                elif field == 'site_id':
-                    value = sid
-                elif field == 'lon':
-                    value = asset.location[0]
-                elif field == 'lat':
-                    value = asset.location[1]
-                elif field.startswith('occupants_'):
-                    value = asset.values[field]
-                elif field == 'retrofitted':
-                    value = asset.retrofitted()
-                elif field in tagnames:
-                    value = asset.tagidxs[tagi[field]]
-                else:
-                    name, lt = field.split('-')
-                    value = asset.value(lt, time_event)
-                record[field] = value
-    return assetcol, ' '.join(occupancy_periods)
+    assetcol['ordinal'] = numpy.arange(num_assets)
+    # populate the array column by column
+    for field in asset_dt.names:
+        if field == 'id':
+            column = [asset.asset_id for asset in assets]
+        elif field in ('ordinal', 'site_id'):
+            continue  # already set
+        elif field == 'number':
+            column = [asset.number for asset in assets]
+        elif field == 'area':
+            column = [asset.area for asset in assets]
+        elif field == 'lon':
+            column = [asset.location[0] for asset in assets]
+        elif field == 'lat':
+            column = [asset.location[1] for asset in assets]
+        elif field.startswith('occupants_'):
+            column = [asset.values[field] for asset in assets]
+        elif field == 'retrofitted':
+            column = [asset.retrofitted() for asset in assets]
+        elif field in tagnames:
+            column = [asset.tagidxs[tagi[field]] for asset in assets]
+        else:
+            name, lt = field.split('-')
+            column = [asset.value(lt, time_event) for asset in assets]
+        assetcol[field] = column
+    return assetcol
 
 
 # ########################### exposure ############################ #
@@ -725,9 +713,11 @@ def _minimal_tagcol(fnames, by_country):
 
 def assets2array(asset_nodes, fields, retrofitted, ignore_missing_costs):
     """
+    :param asset_nodes: an iterable over asset nodes, possibly a stream
     :returns: an array of assets from the asset nodes
     """
-    first_asset = asset_nodes[0]
+    asset_nodes = iter(asset_nodes)
+    first_asset = next(asset_nodes, None)
     for occ in getattr(first_asset, 'occupancies', []):
         name = 'occupants_' + occ['period']
         if name not in fields:
@@ -735,9 +725,11 @@ def assets2array(asset_nodes, fields, retrofitted, ignore_missing_costs):
     dtlist = [(f, object) for f in fields]
     if retrofitted:
         dtlist.append(('retrofitted', object))
-    nodes = list(asset_nodes)
-    array = numpy.zeros(len(nodes), dtlist)
-    for asset, rec in zip(nodes, array):
+    names = [name for name, _ in dtlist]
+    first = [] if first_asset is None else [first_asset]
+    recs = []
+    for asset in itertools.chain(first, asset_nodes):
+        rec = dict.fromkeys(names, 0)
         # fix asset.attrib
         for occ in getattr(asset, 'occupancies', []):
             asset.attrib['occupants_' + occ['period']] = occ['occupants']
@@ -765,6 +757,10 @@ def assets2array(asset_nodes, fields, retrofitted, ignore_missing_costs):
                         raise
             else:
                 rec[field] = asset.attrib.get(field, '?')
+        recs.append(tuple(rec[name] for name in names))
+    array = numpy.zeros(len(recs), dtlist)
+    for i, rec in enumerate(recs):
+        array[i] = rec
     return array
 
 
@@ -843,16 +839,17 @@ class Exposure(object):
             param['region'] = None
         param['fname'] = fname
         param['ignore_missing_costs'] = set(ignore_missing_costs)
-        exposure, assetnodes = _get_exposure(param['fname'])
+        exposure, _ = _get_exposure(param['fname'], stop='asset')
         if tagcol:
             exposure.tagcol = tagcol
-        if assetnodes:
+        if exposure.datafiles:
+            array = exposure._read_csv()
+        else:  # stream the asset nodes without keeping the tree in memory
             array = assets2array(
-                assetnodes, exposure._csv_header(),
+                nrml.iterparse(param['fname'], 'asset'),
+                exposure._csv_header(),
                 exposure.retrofitted or calculation_mode == 'classical_bcr',
                 ignore_missing_costs)
-        else:
-            array = exposure._read_csv()
         param['relevant_cost_types'] = set(exposure.cost_types['name']) - set(
             ['occupants'])
         exposure._populate_from(array, param, check_dupl)
@@ -934,6 +931,9 @@ class Exposure(object):
 
     def _populate_from(self, asset_array, param, check_dupl):
         asset_refs = set()
+        if param['region']:  # check all the locations at once
+            inside = geo.utils.within_region(
+                asset_array['lon'], asset_array['lat'], param['region'])
         for idx, asset in enumerate(asset_array):
             asset_id = asset['id']
             # check_dupl is False only in oq prepare_site_model since
@@ -941,6 +941,9 @@ class Exposure(object):
             if check_dupl and asset_id in asset_refs:
                 raise nrml.DuplicatedID(asset_id)
             asset_refs.add(param['asset_prefix'] + asset_id)
+            if param['region'] and not inside[idx]:
+                param['out_of_region'] += 1
+                continue
             self._add_asset(idx, asset, param)
 
     def _add_asset(self, idx, asset, param):
@@ -956,10 +959,6 @@ class Exposure(object):
         taxonomy = asset['taxonomy']
         number = asset['number']
         location = asset['lon'], asset['lat']
-        if param['region'] and not geometry.Point(*location).within(
-                param['region']):
-            param['out_of_region'] += 1
-            return
         dic = {tagname: asset[tagname] for tagname in self.tagcol.tagnames
                if tagname not in ('country', 'exposure') and
                asset[tagname] != '?'}
@@ -999,15 +998,18 @@ class Exposure(object):
                     area, retrofitted, self.cost_calculator)
         self.assets.append(ass)
 
-    def get_mesh_assets_by_site(self):
+    def get_mesh_assets(self, time_event=None):
         """
-        :returns: (Mesh instance, assets_by_site list)
+        :returns: (Mesh instance, asset array with the site_id field)
         """
-        assets_by_loc = general.groupby(self, key=lambda a: a.location)
-        mesh = geo.Mesh.from_coords(list(assets_by_loc))
-        assets_by_site = [
-            assets_by_loc[lonlat] for lonlat in zip(mesh.lons, mesh.lats)]
-        return mesh, assets_by_site
+        # the locations are sorted by (lon, lat), as in Mesh.from_coords
+        lonlats = numpy.array([a.location for a in self.assets])
+        uniq, inv = numpy.unique(lonlats, axis=0, return_inverse=True)
+        mesh = geo.Mesh(uniq[:, 0], uniq[:, 1])
+        array = build_asset_array(self.assets, self.tagcol.tagnames,
+                                  time_event)
+        array['site_id'] = inv.reshape(-1)
+        return mesh, array
 
     def __iter__(self):
         return iter(self.assets)
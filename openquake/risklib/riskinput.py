@@ -106,6 +106,60 @@ def get_output(crmodel, assets_by_taxo, haz, rlzi=None):
     return hdf5.ArrayWrapper((), dic)
 
 
+def get_ratios_by_taxo(crmodel, assets_by_sid, haz_by_sid):
+    """
+    Evaluate the vulnerability functions once per taxonomy and loss type
+    on the GMFs of all the sites hosting the taxonomy, instead of once per
+    site. Valid only if the loss ratios are the same for all the assets
+    of a taxonomy, i.e. if there are no epsilons and the vulnerability
+    functions are lognormal.
+
+    :param crmodel: a CompositeRiskModel instance
+    :param assets_by_sid: a list of pairs (sid, assets on the site)
+    :param haz_by_sid: a dictionary sid -> GMFs sorted by event ID
+    :returns: a dictionary (taxonomy, sid) -> list of L arrays of ratios
+    """
+    sids_by_taxo = AccumDict(accum=[])
+    for sid, assets in assets_by_sid:
+        for taxo in numpy.unique(assets['taxonomy']):
+            sids_by_taxo[taxo].append(sid)
+    ratios = AccumDict(accum=[])
+    for taxo, sids in sids_by_taxo.items():
+        hazs = [haz_by_sid[sid] for sid in sids]
+        gmvs = numpy.concatenate([haz['gmv'] for haz in hazs])  # (G, M)
+        eids = numpy.concatenate([haz['eid'] for haz in hazs])
+        splits = numpy.cumsum([len(haz) for haz in hazs])[:-1]
+        rmodels, weights = crmodel.get_rmodels_weights(taxo)
+        for lt in crmodel.loss_types:
+            # a single fake asset, since the ratios are the same for all
+            arrays = [rm(lt, [None], gmvs[:, rm.imti[lt]], eids, ())
+                      for rm in rmodels]
+            res = arrays[0] if len(arrays) == 1 else numpy.average(
+                arrays, weights=weights, axis=0)
+            for sid, arr in zip(sids, numpy.split(res[0], splits)):
+                ratios[taxo, sid].append(arr)
+    return ratios
+
+
+def get_batched_output(crmodel, sid, assets, ratios, haz, slc=slice(None)):
+    """
+    :param sid: a site ID
+    :param assets: an array of assets on the site, ordered by ordinal
+    :param ratios: a dictionary returned by :func:`get_ratios_by_taxo`
+    :param haz: the GMFs on the site, sorted by event ID
+    :param slc: a slice over the GMFs
+    :returns: an ArrayWrapper loss_type -> array of shape (A, E), like
+              :func:`get_output` but without calling the risk functions
+    """
+    taxos, inv = numpy.unique(assets['taxonomy'], return_inverse=True)
+    dic = dict(eids=haz['eid'][slc], assets=assets,
+               loss_types=crmodel.loss_types)
+    for l, lt in enumerate(crmodel.loss_types):
+        dic[lt] = numpy.array(
+            [ratios[taxo, sid][l][slc] for taxo in taxos])[inv]
+    return hdf5.ArrayWrapper((), dic)
+
+
 class RiskInput(object):
     """
     Contains all the assets and hazard values associated to a given
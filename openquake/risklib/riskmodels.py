@@ -286,16 +286,20 @@ class RiskModel(object):
         means, covs, idxs = vf.interpolate(gmvs)
         if len(means) == 0:  # all gmvs are below the minimum imls, 0 ratios
             pass
+        elif vf.distribution_name in ('BT', 'PM'):
+            # the ratios are sampled with generators keyed by asset and
+            # indexed by event ID
+            loss_ratios[:, idxs] = vf.sample(
+                means, covs, idxs, None, numpy.asarray(eids)[idxs],
+                assets['ordinal'])
         elif self.ignore_covs or covs.sum() == 0 or len(epsilons) == 0:
             # the ratios are equal for all assets
             ratios = vf.sample(means, covs, idxs, None)  # right shape
             for a in range(A):
                 loss_ratios[a, idxs] = ratios
         else:
-            # take into account the epsilons
-            for a, asset in enumerate(assets):
-                loss_ratios[a, idxs] = vf.sample(
-                    means, covs, idxs, epsilons[a])
+            # take into account the epsilons of all assets at once
+            loss_ratios[:, idxs] = vf.sample(means, covs, idxs, epsilons)
         return loss_ratios
 
     ebrisk = event_based_risk
@@ -364,9 +368,12 @@ class RiskModel(object):
         vf = self.risk_functions[loss_type, 'vulnerability']
         means, covs, idxs = vf.interpolate(gmvs)
         loss_ratio_matrix = numpy.zeros((len(assets), E))
-        if len(epsilons):
-            for a, eps in enumerate(epsilons):
-                loss_ratio_matrix[a, idxs] = vf.sample(means, covs, idxs, eps)
+        if vf.distribution_name in ('BT', 'PM'):
+            loss_ratio_matrix[:, idxs] = vf.sample(
+                means, covs, idxs, None, numpy.asarray(eids)[idxs],
+                assets['ordinal'])
+        elif len(epsilons):
+            loss_ratio_matrix[:, idxs] = vf.sample(means, covs, idxs, epsilons)
         else:
             ratios = vf.sample(means, covs, idxs, numpy.zeros(len(means), F32))
             for a in range(len(assets)):
@@ -549,10 +556,10 @@ class CompositeRiskModel(collections.abc.Mapping):
 
     def compute_csq(self, asset, fractions, loss_type):
         """
-        :param asset: asset record
-        :param fractions: array of probabilies of shape (E, D)
+        :param asset: asset record or array of A asset records
+        :param fractions: array of probabilies of shape (E, D) or (A, E, D)
         :param loss_type: loss type as a string
-        :returns: a dict consequence_name -> array of length E
+        :returns: a dict consequence_name -> array of shape E or (A, E)
         """
         csq = {}  # cname -> values per event
         for byname, coeffs in self.cons_model.items():
@@ -560,7 +567,7 @@ class CompositeRiskModel(collections.abc.Mapping):
                 cname, tagname = byname.split('_by_')
                 func = scientific.consequence[cname]
                 coeffs = coeffs[asset[tagname] - 1][loss_type]
-                csq[cname] = func(coeffs, asset, fractions[:, 1:], loss_type)
+                csq[cname] = func(coeffs, asset, fractions[..., 1:], loss_type)
         return csq
 
     def init(self, oqparam):
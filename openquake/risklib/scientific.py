@@ -29,7 +29,7 @@ from functools import lru_cache
 
 import numpy
 from numpy.testing import assert_equal
-from scipy import interpolate, stats, random
+from scipy import interpolate, stats
 
 from openquake.baselib.general import CallableDict, cached_property
 from openquake.hazardlib.stats import compute_stats2
@@ -153,7 +153,7 @@ class VulnerabilityFunction(object):
         self.distribution.epsilons = (numpy.array(epsilons)
                                       if epsilons is not None else None)
         assert self.seed is not None, self
-        numpy.random.seed(self.seed)  # set by CompositeRiskModel.init
+        self.distribution.seed = self.seed  # set by CompositeRiskModel.init
 
     def interpolate(self, gmvs):
         """
@@ -169,7 +169,7 @@ class VulnerabilityFunction(object):
         gmvs_curve = gmvs_curve[idxs]
         return self._mlr_i1d(gmvs_curve), self._cov_for(gmvs_curve), idxs
 
-    def sample(self, means, covs, idxs, epsilons=None):
+    def sample(self, means, covs, idxs, epsilons=None, eids=None, aids=None):
         """
         Sample the epsilons and apply the corrections to the means.
         This method is called only if there are nonzero covs.
@@ -181,13 +181,19 @@ class VulnerabilityFunction(object):
         :param idxs:
            array of E booleans with E >= E'
         :param epsilons:
-           array of E floats (or None)
+           array of E floats, or matrix of shape (A, E), or None
+        :param eids:
+           array of E' event IDs (used by the BT distribution)
+        :param aids:
+           array of A asset ordinals (used by the BT distribution)
         :returns:
-           array of E' loss ratios
+           array of E' loss ratios, or matrix of shape (A, E')
         """
         if self.distribution_name == 'LN' and epsilons is None:
             return means
         self.set_distribution(epsilons)
+        self.distribution.eids = eids
+        self.distribution.aids = aids
         res = self.distribution.sample(means, covs, means * covs, idxs)
         return res
 
@@ -416,7 +422,8 @@ class VulnerabilityFunctionWithPMF(VulnerabilityFunction):
         gmvs_curve = gmvs_curve[idxs]
         return self._probs_i1d(gmvs_curve), numpy.zeros_like(gmvs_curve), idxs
 
-    def sample(self, probs, _covs, idxs, epsilons):
+    def sample(self, probs, _covs, idxs, epsilons=None, eids=None,
+               aids=None):
         """
         Sample the .loss_ratios with the given probabilities.
 
@@ -427,11 +434,17 @@ class VulnerabilityFunctionWithPMF(VulnerabilityFunction):
         :param idxs:
            array of E booleans with E >= E'
         :param epsilons:
-           array of E floats
+           ignored, it is there only for API consistency
+        :param eids:
+           array of E' event IDs
+        :param aids:
+           array of A asset ordinals
         :returns:
-           array of E' probabilities
+           array of E' loss ratios, or matrix of shape (A, E')
         """
         self.set_distribution(epsilons)
+        self.distribution.eids = eids
+        self.distribution.aids = aids
         return self.distribution.sample(self.loss_ratios, probs)
 
     @lru_cache()
@@ -752,6 +765,32 @@ class FragilityModel(dict):
 DISTRIBUTIONS = CallableDict()
 
 
+def uniform_by_event(seed, aid, eids, n=None):
+    """
+    Draw uniform numbers in [0, 1) from a counter-based generator, i.e. a
+    Philox bit generator keyed by (seed, aid) with the counter set by the
+    event ID. The numbers of an event depend only on the seed, the asset
+    and the event, not on how the events are split in blocks.
+
+    :param seed: a non-negative integer, usually the master_seed
+    :param aid: the asset ordinal
+    :param eids: an array of E event IDs
+    :param n: number of uniform numbers per event (None means one)
+    :returns: an array of shape E or (E, n)
+    """
+    bitgen = numpy.random.Philox(key=[seed, aid])
+    rng = numpy.random.Generator(bitgen)
+    state = bitgen.state
+    out = numpy.zeros(len(eids) if n is None else (len(eids), n))
+    for e, eid in enumerate(eids):
+        # the event ID is in the second word of the counter, so that the
+        # first word leaves 2^64 numbers to each event
+        state['state']['counter'][:] = [0, eid, 0, 0]
+        bitgen.state = state
+        out[e] = rng.random(n)
+    return out
+
+
 class Distribution(metaclass=abc.ABCMeta):
     """
     A Distribution class models continuous probability distribution of
@@ -759,6 +798,21 @@ class Distribution(metaclass=abc.ABCMeta):
     usually registered with a name (e.g. LN, BT, PM) by using
     :class:`openquake.baselib.general.CallableDict`
     """
+    seed = None  # set by VulnerabilityFunction.set_distribution
+    eids = None  # event IDs, set by VulnerabilityFunction.sample
+    aids = None  # asset ordinals, set by VulnerabilityFunction.sample
+
+    def uniform(self, E):
+        """
+        :param E: the number of events
+        :returns: uniform numbers of shape E, or (A, E) if .aids is set
+        """
+        seed = self.seed or 0
+        eids = numpy.arange(E) if self.eids is None else self.eids
+        if self.aids is None:
+            return uniform_by_event(seed, 0, eids)
+        return numpy.array([uniform_by_event(seed, aid, eids)
+                            for aid in self.aids])
 
     @abc.abstractmethod
     def sample(self, means, covs, stddevs, idxs):
@@ -829,7 +883,7 @@ class LogNormalDistribution(Distribution):
         if self.epsilons is None:
             raise ValueError("A LogNormalDistribution must be initialized "
                              "before you can use it")
-        eps = self.epsilons[idxs]
+        eps = self.epsilons[..., idxs]  # shape E' or (A, E')
         sigma = numpy.sqrt(numpy.log(covs ** 2.0 + 1.0))
         probs = means / numpy.sqrt(1 + covs ** 2) * numpy.exp(eps * sigma)
         return probs
@@ -855,8 +909,9 @@ class BetaDistribution(Distribution):
     def sample(self, means, _covs, stddevs, _idxs=None):
         alpha = self._alpha(means, stddevs)
         beta = self._beta(means, stddevs)
-        res = numpy.random.beta(alpha, beta, size=None)
-        return res
+        # inverse transform sampling, with one uniform number per
+        # asset and event; returns an array of shape E' or (A, E')
+        return stats.beta.ppf(self.uniform(len(means)), alpha, beta)
 
     def survival(self, loss_ratio, mean, stddev):
         return stats.beta.sf(loss_ratio,
@@ -874,17 +929,14 @@ class BetaDistribution(Distribution):
 
 @DISTRIBUTIONS.add('PM')
 class DiscreteDistribution(Distribution):
-    seed = None  # to be set
-
     def sample(self, loss_ratios, probs):
-        ret = []
-        r = numpy.arange(len(loss_ratios))
-        for i in range(probs.shape[1]):
-            random.seed(self.seed + i)
-            # the seed is set inside the loop to avoid block-size dependency
-            pmf = stats.rv_discrete(name='pmf', values=(r, probs[:, i])).rvs()
-            ret.append(loss_ratios[pmf])
-        return ret
+        # inverse transform sampling, with one uniform number per
+        # asset and event; returns an array of shape E' or (A, E')
+        cdf = probs.cumsum(axis=0)  # shape (M, E')
+        cdf /= cdf[-1]
+        uniform = self.uniform(probs.shape[1])[..., None, :]
+        idx = (cdf <= uniform).sum(axis=-2)
+        return numpy.asarray(loss_ratios)[idx]
 
     def survival(self, loss_ratios, probs):
         """
@@ -1485,6 +1537,7 @@ class LossesByAsset(object):
     :param assetcol: an AssetCollection instance
     :param policy_name: the name of the policy field (can be empty)
     :param policy_dict: dict loss_type -> array(deduct, limit) (can be empty)
+    :param aggregate_by: a list of tag names (can be empty)
     """
     alt = None  # set by the ebrisk calculator
     losses_by_E = None  # set by the ebrisk calculator
@@ -1496,12 +1549,24 @@ class LossesByAsset(object):
         """
         return numpy.zeros((self.A, len(self.loss_names)), F32)
 
-    def __init__(self, assetcol, loss_names, policy_name='', policy_dict={}):
+    def __init__(self, assetcol, loss_names, policy_name='', policy_dict={},
+                 aggregate_by=()):
         self.A = len(assetcol)
         self.policy_name = policy_name
         self.policy_dict = policy_dict
         self.loss_names = loss_names
         self.lni = {ln: i for i, ln in enumerate(loss_names)}
+        self.aggregate_by = aggregate_by
+        self.agg_shape = assetcol.tagcol.agg_shape((), aggregate_by)
+
+    def get_aggkeys(self, tagidxs):
+        """
+        :param tagidxs: a composite array with fields .aggregate_by
+        :returns: an array of integer aggregation keys, one per asset
+        """
+        return numpy.ravel_multi_index(
+            [tagidxs[tagname] - 1 for tagname in self.aggregate_by],
+            self.agg_shape)
 
     def gen_losses(self, out):
         """
@@ -1525,26 +1590,50 @@ class LossesByAsset(object):
 
     def aggregate(self, out, eidx, minimum_loss, tagidxs, ws):
         """
-        Populate .losses_by_A, .losses_by_E and .alt
+        Populate .losses_by_A, .losses_by_E and .alt. The aggregate losses
+        are stored in .alt as pairs (keys, losses) where the keys encode
+        the triple (aggkey, event index, loss name index).
         """
         numlosses = numpy.zeros(2, int)
+        E, L = self.losses_by_E.shape
+        if tagidxs is not None:
+            kids = self.get_aggkeys(tagidxs) * E
         for lni, losses in self.gen_losses(out):
             if ws is not None:  # compute avg_losses, really fast
                 aids = out.assets['ordinal']
                 self.losses_by_A[aids, lni] += losses @ ws
             self.losses_by_E[eidx, lni] += losses.sum(axis=0)
             if tagidxs is not None:
-                # this is the slow part, depending on minimum_loss
-                for a, asset in enumerate(out.assets):
-                    idx = ','.join(map(str, tagidxs[a])) + ','
-                    kept = 0
-                    for loss, eid in zip(losses[a], out.eids):
-                        if loss >= minimum_loss[lni]:
-                            self.alt[idx][eid][lni] += loss
-                            kept += 1
-                    numlosses += numpy.array([kept, len(losses[a])])
+                ok = losses >= minimum_loss[lni]
+                a, e = ok.nonzero()
+                keys = (kids[a] + eidx[e]) * L + lni
+                self.alt.append(_sum_by_key(keys, losses[a, e]))
+                numlosses += numpy.array([len(keys), losses.size])
         return numlosses
 
+    def pop_alt(self):
+        """
+        Reduce the pairs (keys, losses) in .alt and empty it.
+
+        :returns: three arrays aggkeys, event indices, losses of shape (K, L)
+        """
+        E, L = self.losses_by_E.shape
+        if self.alt:
+            keys, losses = _sum_by_key(*map(numpy.concatenate, zip(*self.alt)))
+        else:
+            keys, losses = numpy.zeros(0, int), numpy.zeros(0, F32)
+        self.alt.clear()
+        ukeys, inv = numpy.unique(keys // L, return_inverse=True)
+        out = numpy.zeros((len(ukeys), L), F32)
+        out[inv, keys % L] = losses  # the keys are unique
+        return ukeys // E, ukeys % E, out
+
+
+def _sum_by_key(keys, values):
+    # sum the values with the same key; returns the unique keys and sums
+    ukeys, inv = numpy.unique(keys, return_inverse=True)
+    return ukeys, numpy.bincount(inv, values, len(ukeys)).astype(F32)
+
 
 # ####################### Consequences ##################################### #
 
@@ -1554,10 +1643,12 @@ consequence = CallableDict()
 @consequence.add('losses')
 def economic_losses(coeffs, asset, dmgdist, loss_type):
     """
-    :param coeffs: coefficients per damage state
-    :param asset: asset record
-    :param dmgdist: an array of probabilies of shape (E, D - 1)
+    :param coeffs: coefficients per damage state, of shape D - 1 or (A, D - 1)
+    :param asset: asset record or array of A asset records
+    :param dmgdist: an array of probabilies of shape (E, D - 1) or
+                    (A, E, D - 1)
     :param loss_type: loss type string
-    :returns: array of economic losses of length E
+    :returns: array of economic losses of shape E or (A, E)
     """
-    return dmgdist @ coeffs * asset['value-' + loss_type]
+    values = numpy.asarray(asset['value-' + loss_type])
+    return (dmgdist @ coeffs[..., None])[..., 0] * values[..., None]
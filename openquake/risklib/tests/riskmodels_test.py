@@ -24,10 +24,13 @@ import numpy
 from numpy.testing import assert_almost_equal
 from openquake.baselib.general import gettemp
 from openquake.hazardlib import InvalidFile, nrml
-from openquake.risklib import riskmodels, nrml_examples
+from openquake.risklib import (
+    riskmodels, riskinput, scientific, nrml_examples)
 from openquake.qa_tests_data.scenario_damage import case_4b
 
 FF_DIR = os.path.dirname(case_4b.__file__)
+U32 = numpy.uint32
+F32 = numpy.float32
 
 
 class ParseCompositeRiskModelTestCase(unittest.TestCase):
@@ -348,3 +351,36 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
         ratios2 = rm('structural', assets, gmvs2, eids2, eps2)
         numpy.testing.assert_allclose(ratios1, self.expected_ratios[:, :2])
         numpy.testing.assert_allclose(ratios2, self.expected_ratios[:, 2:])
+
+    def test_batched_output(self):
+        # the ratios computed once per taxonomy on all sites are the same
+        # as the ratios computed site by site
+        vf = scientific.VulnerabilityFunction(
+            'RC/A', 'PGA', [0.005, 0.007, 0.0098, 0.0137],
+            [0.01, 0.06, 0.18, 0.36], [0.3, 0.3, 0.3, 0.3])
+        vf.seed = 42
+        vf.init()
+        rm = riskmodels.RiskModel(
+            'event_based_risk', 'RC/A', {('structural', 'vulnerability'): vf},
+            ignore_covs=False)
+        rm.imti = {'structural': 0}
+        crmodel = mock.Mock(loss_types=['structural'])
+        crmodel.get_rmodels_weights.return_value = [rm], [1.]
+        assets = numpy.zeros(3, [('ordinal', U32), ('taxonomy', U32)])
+        assets['ordinal'] = [0, 1, 2]
+        assets['taxonomy'] = [1, 2, 1]
+        gmf_dt = [('sid', U32), ('eid', U32), ('gmv', (F32, (1,)))]
+        haz_by_sid = {
+            0: numpy.array([(0, 1, [.004]), (0, 3, [.1])], gmf_dt),
+            1: numpy.array([(1, 2, [.008]), (1, 3, [.01])], gmf_dt)}
+        assets_by_sid = [(0, assets), (1, assets[:2])]
+        ratios = riskinput.get_ratios_by_taxo(
+            crmodel, assets_by_sid, haz_by_sid)
+        for sid, ass in assets_by_sid:
+            out = riskinput.get_output(
+                crmodel, riskinput.get_assets_by_taxo(ass), haz_by_sid[sid])
+            batched = riskinput.get_batched_output(
+                crmodel, sid, ass, ratios, haz_by_sid[sid])
+            numpy.testing.assert_array_equal(batched.eids, out.eids)
+            numpy.testing.assert_array_equal(
+                batched['structural'], out['structural'])
@@ -47,10 +47,42 @@ class DegenerateDistributionTest(unittest.TestCase):
 
 class BetaDistributionTestCase(unittest.TestCase):
     def test_sample_one(self):
-        numpy.random.seed(0)
         numpy.testing.assert_allclose(
-            [0.057241368], scientific.BetaDistribution().sample(
-                numpy.array([0.1]), None, numpy.array([0.1])))
+            [0.00048846], scientific.BetaDistribution().sample(
+                numpy.array([0.1]), None, numpy.array([0.1])), rtol=1E-5)
+
+    def test_sample_local_seed(self):
+        # the global random state is not touched
+        dist = scientific.BetaDistribution()
+        dist.seed = 0
+        numpy.random.seed(1)
+        dist.sample(numpy.array([0.1]), None, numpy.array([0.1]))
+        self.assertEqual(numpy.random.random(),
+                         numpy.random.RandomState(1).random_sample())
+
+    def test_sample_by_event(self):
+        # the samples depend on the asset and on the event ID, not on
+        # the partition of the events
+        vf = scientific.VulnerabilityFunction(
+            'v1', 'PGA', [.1, .2, .3], [.05, .1, .2], [.1, .2, .3], 'BT')
+        vf.seed = 42
+        vf.init()
+        gmvs = numpy.array([.1, .15, .2, .25, .3, .12])
+        eids = numpy.array([3, 8, 10, 11, 20, 21])
+        aids = numpy.array([5, 7])
+        means, covs, idxs = vf.interpolate(gmvs)
+        ratios = vf.sample(means, covs, idxs, None, eids, aids)
+        self.assertEqual(ratios.shape, (2, 6))
+        self.assertFalse((ratios[0] == ratios[1]).any())
+        for slc in (slice(0, 2), slice(2, 5), slice(5, 6)):
+            means, covs, idxs = vf.interpolate(gmvs[slc])
+            numpy.testing.assert_array_equal(
+                vf.sample(means, covs, idxs, None, eids[slc], aids),
+                ratios[:, slc])
+        # an asset gets the same ratios when sampled alone
+        means, covs, idxs = vf.interpolate(gmvs)
+        numpy.testing.assert_array_equal(
+            vf.sample(means, covs, idxs, None, eids, aids[1:]), ratios[1:])
 
     def test_zero_ratios(self):
         # a loss ratio can be zero if the corresponding CoV is zero
@@ -336,6 +368,29 @@ class MeanLossTestCase(unittest.TestCase):
         aaae(mean3, mean)
 
 
+class VulnerabilityFunctionWithPMFTestCase(unittest.TestCase):
+    def test_sample_by_event(self):
+        # the samples depend on the asset and on the event ID, not on
+        # the partition of the events
+        probs = numpy.array([[.8, .5, .1], [.2, .3, .4], [0, .2, .5]])
+        vf = scientific.VulnerabilityFunctionWithPMF(
+            'v1', 'PGA', numpy.array([.1, .2, .3]),
+            numpy.array([0, .5, 1]), probs)
+        vf.seed = 42
+        gmvs = numpy.array([.1, .15, .2, .25, .3, .12, .3, .3])
+        eids = numpy.arange(8) * 3
+        aids = numpy.array([0, 1, 2])
+        probs, covs, idxs = vf.interpolate(gmvs)
+        ratios = vf.sample(probs, covs, idxs, None, eids, aids)
+        self.assertEqual(ratios.shape, (3, 8))
+        self.assertEqual(set(ratios.flat), {0, .5, 1})
+        for slc in (slice(0, 3), slice(3, 4), slice(4, 8)):
+            probs, covs, idxs = vf.interpolate(gmvs[slc])
+            numpy.testing.assert_array_equal(
+                vf.sample(probs, covs, idxs, None, eids[slc], aids),
+                ratios[:, slc])
+
+
 class LogNormalDistributionTestCase(unittest.TestCase):
 
     def test_init(self):
@@ -705,3 +760,17 @@ class ClassicalDamageTestCase(unittest.TestCase):
             fragility_functions, hazard_imls, hazard_poes,
             investigation_time, risk_investigation_time)
         aaae(poos, [0.56652127, 0.12513401, 0.1709355, 0.06555033, 0.07185889])
+
+
+class ConsequenceTestCase(unittest.TestCase):
+    def test_economic_losses_many_assets(self):
+        assets = numpy.zeros(3, [('value-structural', float)])
+        assets['value-structural'] = [100., 200., 50.]
+        coeffs = numpy.array([[.1, .5, 1.], [.2, .6, 1.], [0, .3, .9]])
+        dmgdist = numpy.random.RandomState(42).random_sample((3, 4, 3))
+        losses = scientific.consequence['losses'](
+            coeffs, assets, dmgdist, 'structural')  # shape (A, E)
+        self.assertEqual(losses.shape, (3, 4))
+        for asset, coe, dmg, loss in zip(assets, coeffs, dmgdist, losses):
+            aaae(scientific.consequence['losses'](
+                coe, asset, dmg, 'structural'), loss)
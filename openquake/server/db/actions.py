@@ -402,6 +402,21 @@ def log(db, job_id, timestamp, level, process, message):
        'VALUES (?X)', (job_id, timestamp, level, process, message))
 
 
+def log_many(db, records):
+    """
+    Write several log records in the database with a single INSERT.
+
+    :param db:
+        a :class:`openquake.server.dbapi.Db` instance
+    :param records:
+        a list of tuples (job_id, timestamp, level, process, message)
+    """
+    with db:  # a single transaction, not one commit per record
+        db('BEGIN')
+        db.insert('log', ['job_id', 'timestamp', 'level', 'process',
+                          'message'], records)
+
+
 def get_log(db, job_id):
     """
     Extract the logs as a big string